@@ -1,25 +1,52 @@
+import io
 import os
+import json
+import hashlib
 import shutil
 import csv
 import time
 import datetime
+import gc
 import collections
+import multiprocessing
+import concurrent.futures
 from bdb import BdbQuit
 
 from lxml import etree
-import requests
-import exchangerates
-import iatikit
 
 from iatiflattener.lib import variables
+from iatiflattener.lib import parallel
+from iatiflattener.lib import chunking
+from iatiflattener.lib import streaming
+from iatiflattener.lib import scheduling
+from iatiflattener.lib import run_report
+from iatiflattener.lib import shards
+from iatiflattener.lib import manifest
+from iatiflattener.lib import journal
+from iatiflattener.lib import reference
+from iatiflattener.lib import rates
+from iatiflattener.lib import conversion
+from iatiflattener.lib import parsing
+from iatiflattener.lib import sources
 from iatiflattener import model
-from iatiflattener.data_quality import report as data_quality_report
 
 EXCHANGE_RATES_URL = "https://codeforiati.org/imf-exchangerates/imf_exchangerates.csv"
 COUNTRIES_CURRENCIES_URL = "https://codeforiati.org/imf-exchangerates/currencies.json"
 EXCLUDED_PUBLISHERS=["aiddata"]
 CODELIST_URL_LANG = "https://codelists.codeforiati.org/api/json/{}/{}.json"
 CODELIST_URL = "https://codelists.codeforiati.org/api/json/en/{}.json"
+IATI_VERSIONS = ['2.01', '2.02', '2.03']
+
+
+def reference_data_urls(langs, refresh_rates):
+    """Returns the URLs of the reference data read by `FlattenIATIData.setup_codelists`"""
+    urls = [CODELIST_URL.format(codelist) for codelist in ("Country", "Region", "SectorGroup")]
+    urls += [CODELIST_URL_LANG.format(lang, "ReportingOrganisation")
+             for lang in ['en'] + [item for item in langs if item != 'en']]
+    urls += [COUNTRIES_CURRENCIES_URL, CODELIST_URL.format("ReportingOrganisationGroup")]
+    if refresh_rates:
+        urls.append(EXCHANGE_RATES_URL)
+    return urls
 
 
 class FlattenIATIData():
@@ -29,20 +56,21 @@ class FlattenIATIData():
     def get_exchange_rates(self, get_rates=True):
         if get_rates:
             print("Getting exchange rates data")
-            r_rates = requests.get(EXCHANGE_RATES_URL, stream=True)
-            with open(self.exchange_rates_filename, 'wb') as fd:
-                for chunk in r_rates.iter_content(chunk_size=128):
-                    fd.write(chunk)
+            shutil.copyfile(self.reference_data.get(EXCHANGE_RATES_URL).filename,
+                            self.exchange_rates_filename)
             print("Reading in exchange rates data")
-        return exchangerates.CurrencyConverter(
-        update=False, source=self.exchange_rates_filename)
+        # compiled to a memory-mapped table, which is only recompiled when the rates file changes
+        return rates.MemoizedRates(
+            rates.load_rates(self.exchange_rates_filename, rates.default_table_dir(self.exchange_rates_filename)))
 
     def setup_codelists(self, refresh_rates):
         self.activity_data = {}
-        country_req = requests.get(CODELIST_URL.format("Country"))
-        region_req = requests.get(CODELIST_URL.format("Region"))
-        sector_req = requests.get(CODELIST_URL.format("Sector"))
-        sector_groups_req = requests.get(CODELIST_URL.format("SectorGroup"))
+        # read in first, so that reading the exchange rates overlaps with any codelists still downloading
+        self.exchange_rates = self.get_exchange_rates(refresh_rates)
+
+        country_req = self.reference_data.get(CODELIST_URL.format("Country"))
+        region_req = self.reference_data.get(CODELIST_URL.format("Region"))
+        sector_groups_req = self.reference_data.get(CODELIST_URL.format("SectorGroup"))
 
         self.countries = list(map(lambda country: country['code'], country_req.json()["data"]))
         self.regions = list(map(lambda region: region['code'], region_req.json()["data"]))
@@ -53,51 +81,68 @@ class FlattenIATIData():
 
         required_languages = list(['en'] + [item for item in self.langs if item != 'en'])
         for lang in required_languages:
-            publishers_req = requests.get(CODELIST_URL_LANG.format(lang, "ReportingOrganisation"))
+            publishers_req = self.reference_data.get(CODELIST_URL_LANG.format(lang, "ReportingOrganisation"))
             def get_fallback(code):
                 return self.organisations.get('en', {}).get(code)
             self.organisations[lang] = dict(map(lambda org: (org['code'], org.get('name') or get_fallback(org['code'])), publishers_req.json()['data']))
 
-        self.exchange_rates = self.get_exchange_rates(refresh_rates)
-
-        countries_currencies_req = requests.get(COUNTRIES_CURRENCIES_URL)
+        countries_currencies_req = self.reference_data.get(COUNTRIES_CURRENCIES_URL)
         self.countries_currencies = countries_currencies_req.json()
 
-        reporting_org_groups_req = requests.get(CODELIST_URL.format("ReportingOrganisationGroup"))
+        reporting_org_groups_req = self.reference_data.get(CODELIST_URL.format("ReportingOrganisationGroup"))
         self.reporting_organisation_groups = dict([(org.get('code'), org.get('codeforiati:group-code')) for org in reporting_org_groups_req.json()['data']])
 
 
-    def setup_countries(self):
-        for country in self.countries:
-            with open(f'{self.output_dir}/csv/transaction-{country}.csv', 'w') as csvfile:
-                csvwriter = csv.writer(csvfile)
-                csvwriter.writerow(self.csv_headers)
-            with open(f'{self.output_dir}/csv/budget-{country}.csv', 'w') as csvfile:
-                csvwriter = csv.writer(csvfile)
-                csvwriter.writerow(self.csv_headers)
+    def write_csv_header(self, filename, headers):
+        """Creates a CSV file holding only its header, unless the file already exists"""
+        if os.path.exists(filename):
+            return
+        with open(filename, 'w') as csvfile:
+            csvwriter = csv.writer(csvfile)
+            csvwriter.writerow(headers)
+
 
+    def write_empty_files(self):
+        """Creates a CSV file holding only its header for each country, region
+        and reporting organisation which has no rows.
 
-    def setup_organisations(self):
+        CSV files are otherwise only created once rows are written to them;
+        this is for consumers which expect a file for every known code."""
+        for country in self.countries:
+            self.write_csv_header(f'{self.output_dir}/csv/transaction-{country}.csv', self.csv_headers)
+            self.write_csv_header(f'{self.output_dir}/csv/budget-{country}.csv', self.csv_headers)
         for organisation in self.organisations['en'].keys():
-            with open(f'{self.output_dir}/csv/activities/{organisation.replace("/", "_")}.csv', 'w') as csvfile:
-                csvwriter = csv.writer(csvfile)
-                csvwriter.writerow(self.activity_csv_headers)
+            self.write_csv_header(f'{self.output_dir}/csv/activities/{organisation.replace("/", "_")}.csv',
+                                  self.activity_csv_headers)
+
 
+    def activity_context(self, activity):
+        """Resolves the activity-level values of an activity, shared by all of its rows
 
-    def process_transaction(self, csvwriter, activity, transaction):
+        :rtype: model.ActivityContext
+        """
+        return model.ActivityContext(activity, self.activity_cache, self.organisations, self.langs,
+                                     self.reporting_organisation_groups)
+
+
+    def process_transaction(self, csvwriter, activity, transaction, activity_context=None):
         """Called once per <transaction> element in IATI activity XML file to process the transaction
 
         :param activity: the parent <iati-activity> element
         :type activity: lxml.etree._Element
         :param transaction: a <transaction> element
         :type transaction: lxml.etree._Element
+        :param activity_context: the activity's context, defaults to resolving it for this transaction
+        :type activity_context: model.ActivityContext
         """
 
         # type(activity) is lxml.etree._Element; type(transaction) is lxml.etree._Element
         _transaction = model.Transaction(activity, transaction, self.activity_cache,
                                          self.exchange_rates, self.countries_currencies,
                                          True, self.organisations, self.langs,
-                                         self.reporting_organisation_groups)
+                                         self.reporting_organisation_groups,
+                                         self.deferred_conversion,
+                                         activity_context)
 
         # the generate() method returns 'self' if successful, otherwise False; so on success,
         # `generated` refers to the same object as `_transaction`.
@@ -116,11 +161,13 @@ class FlattenIATIData():
                 transaction_csv.output()
 
 
-    def process_activity_for_budgets(self, csvwriter, activity):
+    def process_activity_for_budgets(self, csvwriter, activity, activity_context=None):
         _budget = model.ActivityBudget(activity, self.activity_cache,
                                        self.exchange_rates, self.countries_currencies,
                                        self.organisations, self.langs,
-                                       self.reporting_organisation_groups)
+                                       self.reporting_organisation_groups,
+                                       self.deferred_conversion,
+                                       activity_context)
         generated = _budget.generate()
         if generated is not False:
             _flat_budget = model.FlatBudget(_budget, self.category_group).flatten()
@@ -131,10 +178,11 @@ class FlattenIATIData():
             flat_transaction_budget=_part_flat_budget).output()
 
 
-    def process_activity(self, csvwriter, activity):
+    def process_activity(self, csvwriter, activity, activity_context=None):
         _activity = model.Activity(activity, self.activity_cache,
             self.organisations, self.langs,
-            self.reporting_organisation_groups)
+            self.reporting_organisation_groups,
+            activity_context)
         generated = _activity.generate()
         model.ActivityCSV(
             organisations = self.organisations['en'].keys(),
@@ -142,76 +190,532 @@ class FlattenIATIData():
             activity_data=_activity.as_csv_dict()).output()
 
 
-    def process_package(self, publisher, package, root_dir):
+    def process_package(self, publisher, package, root_dir=None, output_dir=None, byte_range=None):
         """Read the activity elements from XML and write out flattened rows to transaction-NN.csv and budget-NN.csv
 
         :param publisher: the publisher of the package being processed
         :type publisher: str
         :param package: the filename of the XML file (the package) to be processed
         :type package: str
+        :param root_dir: the directory holding the package, defaults to reading it from `self.package_source`
+        :type root_dir: str
+        :param output_dir: the directory to write CSV files to, defaults to `self.output_dir`
+        :type output_dir: str
+        :param byte_range: process only the activities in this chunk of the package (see `lib.chunking`)
+        :type byte_range: (int, int, int)
+        :return: False if the package was skipped because of its IATI version, otherwise True
+        :rtype: bool
+        """
+
+        if output_dir is None:
+            output_dir = self.output_dir
+        source = None
+        if (self.package_parser is not None) and (byte_range is None):
+            # already read and parsed, on the parse-ahead thread
+            self.package_version, doc = self.package_parser.get((publisher, package))
+        else:
+            source = self.package_input(publisher, package, root_dir, byte_range)
+            # check the version from the opening tag, so that unsupported packages are not parsed
+            self.package_version = streaming.peek_version(source)
+            doc = None
+        try:
+            if self.package_version not in IATI_VERSIONS: return False
+
+            if self.streaming:
+                # iterparse reads activities one at a time, clearing each once it has been processed
+                def read_activities():
+                    if hasattr(source, 'seek'):
+                        source.seek(0)
+                    return streaming.iterparse_activities(source)
+                # chunks are only made of packages whose identifiers are unique
+                single_pass = (byte_range is not None) or streaming.has_unique_identifiers(source)
+            else:
+                if doc is None:
+                    doc = etree.parse(source)
+                activities = list(doc.iter("iati-activity"))
+                read_activities = lambda: activities
+                single_pass = (len(set(activity.findtext("iati-identifier") for activity in activities)) ==
+                               len(activities))
+            self.process_activities(read_activities, output_dir, flush=self.streaming, single_pass=single_pass)
+            return True
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+
+
+    def package_input(self, publisher, package, root_dir=None, byte_range=None):
+        """Returns what to parse a package (or a chunk of one) from: the path to
+        the package, or a file-like object for a chunk or for a package which is
+        compressed or in an archive, which is streamed to the parser.
+
+        :param root_dir: the directory holding the package, defaults to reading it from `self.package_source`
+        :type root_dir: str
+        :return: a filename or file-like object
         """
+        if root_dir is not None:
+            filename = os.path.join(root_dir, package)
+        else:
+            filename = self.package_source.filename(publisher, package)
+        if byte_range is not None:
+            return io.BytesIO(chunking.read_chunk(filename, byte_range))
+        if filename is None:
+            return self.package_source.open(publisher, package)
+        return filename
+
 
-        doc = etree.parse(os.path.join(root_dir, "{}".format(package)))
-        if doc.getroot().get("version") not in ['2.01', '2.02', '2.03']: return
+    def parse_package(self, publisher_package):
+        """Reads and parses a package on the parse-ahead thread, unless its IATI version is not supported
+
+        :param publisher_package: the publisher and package
+        :type publisher_package: (str, str)
+        :return: the version, and the parsed package or None
+        :rtype: (str, lxml.etree._ElementTree)
+        """
+        source = self.package_input(*publisher_package)
+        try:
+            version = streaming.peek_version(source)
+            if version not in IATI_VERSIONS:
+                return version, None
+            return version, etree.parse(source)
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+
+
+    def process_activities(self, read_activities, output_dir, flush=False, single_pass=True):
+        """Write out the activity, transaction and budget rows of each activity in a single pass
+
+        Each activity is visited once, and all of its rows are generated
+        together from an `ActivityContext`, so that its activity-level values
+        are resolved once rather than for every transaction and budget.
+
+        Activities which share an identifier share the values cached for it
+        (see `model.ActivityCache`), and which of them caches a value first
+        changes the rows of the others. Packages in which an identifier is
+        repeated are therefore read in three passes, writing the rows of every
+        activity, then of every transaction, then of every activity's budgets,
+        each resolving its own activity-level values, as they always were.
+
+        :param read_activities: returns the `iati-activity` elements of a package, read afresh for each pass
+        :type read_activities: function
+        :param output_dir: the directory to write CSV files to
+        :type output_dir: str
+        :param flush: write out rows after each activity rather than at the end of the package
+        :type flush: bool
+        :param single_pass: False if an activity identifier is repeated within the package
+        :type single_pass: bool
+        """
         self.activity_cache = model.ActivityCache()
+        conversions = None
+        if self.deferred_conversion:
+            # transaction and budget values are converted together, once per batch of rows written out
+            conversions = conversion.DeferredConversions(
+                self.exchange_rates, self.countries_currencies, self.csv_headers)
+
+        # each csvwriter holds, for each file (indexed by country code or reporting org), a file handle,
+        # a csv writer object and a list of rows which are to be written out
+        # shards are written without headers, which are added as the shards are merged
+        write_header = (output_dir == self.output_dir)
+        activity_csvwriter = model.ActivityCSVFilesWriter(output_dir, headers=self.activity_csv_headers,
+                                                          write_header=write_header)
+        transaction_csvwriter = model.CSVFilesWriter(budget_transaction='transaction',
+                                                     headers=self.csv_headers,
+                                                     output_dir=output_dir,
+                                                     conversions=conversions,
+                                                     write_header=write_header)
+        budget_csvwriter = model.CSVFilesWriter(budget_transaction='budget',
+                                                headers=self.csv_headers,
+                                                output_dir=output_dir,
+                                                conversions=conversions,
+                                                write_header=write_header)
+        csvwriters = [activity_csvwriter, transaction_csvwriter, budget_csvwriter]
+
+        def flush_rows():
+            if conversions is not None:
+                conversions.convert()
+            for csvwriter in csvwriters:
+                csvwriter.flush()
+
+        if single_pass:
+            for activity in read_activities():
+                # type(activity) is lxml.etree._Element
+                activity_context = self.activity_context(activity)
+                self.process_activity(activity_csvwriter, activity, activity_context)
+                for transaction in activity_context.children.all("transaction"):
+                    self.process_transaction(transaction_csvwriter, activity, transaction, activity_context)
+                if activity_context.children.first("budget") is not None:
+                    self.process_activity_for_budgets(budget_csvwriter, activity, activity_context)
+                if flush:
+                    flush_rows()
+        else:
+            for activity in read_activities():
+                self.process_activity(activity_csvwriter, activity)
+                if flush:
+                    flush_rows()
+            for activity in read_activities():
+                for transaction in activity.iterchildren("transaction"):
+                    self.process_transaction(transaction_csvwriter, activity, transaction)
+                if flush:
+                    flush_rows()
+            for activity in read_activities():
+                if activity.find("budget") is not None:
+                    self.process_activity_for_budgets(budget_csvwriter, activity)
+                if flush:
+                    flush_rows()
+
+        if conversions is not None:
+            conversions.convert()
+        for csvwriter in csvwriters:
+            csvwriter.write()
+
+
+    def list_packages(self, publisher):
+        """Returns the sorted list of packages for a publisher, with their sizes
+
+        :param publisher: the publisher directory within the iatikit cache
+        :type publisher: str
+        :return: a list of (publisher, package, size) tuples, or None if the publisher is not a directory
+        :rtype: [(str, str, int)]
+        """
+        packages = self.package_source.list_packages(publisher)
+        if packages is None:
+            return None
+        return [(publisher, package, size) for package, size in packages]
 
-        activity_csvwriter = model.ActivityCSVFilesWriter(self.output_dir, headers=self.activity_csv_headers)
-        activities = doc.xpath("//iati-activity")
-        for activity in activities:
-            # type(activity) is lxml.etree._Element
-            self.process_activity(activity_csvwriter, activity)
 
-        activity_csvwriter.write()
+    def run_package(self, publisher, package, output_dir=None, byte_range=None):
+        """Processes a package (or a chunk of one), printing rather than raising any exception
 
-        # csvwriter is an instance of CSVFilesWriter; csvwriter.csvfiles is a dictionary indexed by country code
-        # which contains a CSV file handle for writing to the CSV ('file'), a csv writer object ('csv'), and a list
-        # rows, which is populated below with all the rows to be added to the CSV ('rows')
-        csvwriter = model.CSVFilesWriter(budget_transaction='transaction',
-                                         headers=self.csv_headers,
-                                         output_dir=self.output_dir)
+        :return: the result, with the `status` ('processed', 'skipped' or 'failed') and the time taken in `seconds`
+        :rtype: dict
+        """
+        start = time.time()
+        result = {
+            'publisher': publisher,
+            'package': package,
+            'status': 'processed'
+        }
+        try:
+            if self.process_package(publisher, package, output_dir=output_dir,
+                                    byte_range=byte_range) is False:
+                result['status'] = 'skipped'
+                result['version'] = self.package_version
+        except BdbQuit:
+            raise
+        except Exception as e:
+            print("Exception with package {}".format(package))
+            print("Exception was {}".format(repr(e)))
+            result['status'] = 'failed'
+            result['error'] = repr(e)
+        result['seconds'] = time.time() - start
+        return result
+
+
+    def shard_dir(self, publisher, package):
+        return os.path.join(self.output_dir, 'shards', publisher, package)
+
+
+    def finish_shard(self, publisher, package, results):
+        """Commits the shard of a package, or discards it if the package (or any chunk of it) failed,
+        so that a failed package leaves no partial rows behind.
+
+        :param results: the results from `run_package` for the package or each of its chunks
+        :type results: [dict]
+        """
+        if any(result['status'] == 'failed' for result in results):
+            shards.discard_shard(self.shard_dir(publisher, package))
+            if self.manifest is not None:
+                # also drop the shard from an earlier run, so that the output matches a full run
+                shards.remove_shard(self.shard_dir(publisher, package))
+                self.manifest.remove(publisher, package)
+        else:
+            shards.commit_shard(self.shard_dir(publisher, package))
+            if self.manifest is not None:
+                self.manifest.record(publisher, package,
+                    self.package_source.path(publisher, package), results[0])
+
+
+    def journal_package(self, result):
+        """Records a completed package in the journal. When rows are appended
+        directly to the CSV files, the new sizes of the files the package wrote
+        to are recorded too, once they are on disk. That takes a scan of the
+        output directory and an fsync of each file written to, so such runs
+        are only journaled when they are started with `resume`."""
+        sizes = None
+        if not self.shards:
+            if not self.resume:
+                return
+            sizes = {}
+            for filename, size in journal.output_sizes(self.output_dir).items():
+                if self.output_sizes.get(filename) != size:
+                    journal.fsync_file(os.path.join(self.output_dir, filename))
+                    sizes[filename] = size
+            self.output_sizes.update(sizes)
+        self.journal.record(result, sizes)
+
+
+    def is_completed(self, publisher, package):
+        """Checks whether a package was completed before a resumed run was interrupted,
+        adding its result to the run report if so"""
+        result = self.journal.completed(publisher, package)
+        if result is None:
+            return False
+        self.run_report.add(result)
+        if (self.manifest is not None) and (result['status'] != 'failed'):
+            self.manifest.record(publisher, package,
+                self.package_source.path(publisher, package), result)
+        return True
+
+
+    def is_unchanged(self, publisher, package):
+        """Checks whether a package has an up to date shard from an earlier incremental run"""
+        if self.manifest is None:
+            return False
+        return self.manifest.is_unchanged(publisher, package,
+            self.package_source.path(publisher, package))
+
+
+    def remove_stale_shards(self, publishers):
+        """Removes the shards of packages which no longer exist, or whose publishers are no longer processed"""
+        current = set()
+        for publisher in publishers:
+            current.update((publisher, package) for publisher, package, size in self.list_packages(publisher) or [])
+        for publisher, package, shard_dir in shards.list_shards(os.path.join(self.output_dir, 'shards')):
+            if (publisher, package) not in current:
+                shards.remove_shard(shard_dir)
+        for key in list(self.manifest.packages):
+            if tuple(key.split('/', 1)) not in current:
+                del self.manifest.packages[key]
+
+
+    def merge_shards(self):
+        """Appends the committed shards to the final CSV files, in sorted publisher and package order,
+        starting each file with its header.
+
+        A node of a multi-node run only writes the headers, as its shards are
+        merged with those of the other nodes by `iatiflattener.merge`. The
+        shards are kept for incremental runs and nodes, and removed otherwise.
+        """
+        shards_dir = os.path.join(self.output_dir, 'shards')
+        shard_dirs = [shard_dir for publisher, package, shard_dir in shards.list_shards(shards_dir)]
+        for filename in shards.shard_files(shard_dirs):
+            self.write_csv_header(os.path.join(self.output_dir, 'csv', filename),
+                self.activity_csv_headers if filename.startswith('activities') else self.csv_headers)
+        if self.shard is not None:
+            return
+        shards.merge_shards(shard_dirs, self.output_dir)
+        if self.manifest is None:
+            shutil.rmtree(shards_dir, ignore_errors=True)
+
+
+    def reference_fingerprint(self):
+        """Returns a hash of the reference data used to flatten packages, so
+        that incremental runs reprocess every package when it changes.
+
+        :rtype: str
+        """
+        reference_data = json.dumps({
+            'langs': self.langs,
+            'countries': self.countries,
+            'category_group': self.category_group,
+            'organisations': self.organisations,
+            'countries_currencies': self.countries_currencies,
+            'reporting_organisation_groups': self.reporting_organisation_groups,
+            'exchange_rates': manifest.file_sha1(self.exchange_rates_filename)
+        }, sort_keys=True)
+        return hashlib.sha1(reference_data.encode('utf-8')).hexdigest()
 
-        transactions = doc.xpath("//transaction")
-        for transaction in transactions:
-            # transaction.getparent() gets the <iati-activity> element
-            self.process_transaction(csvwriter, transaction.getparent(), transaction)
 
-        csvwriter.write()
+    def process_publisher(self, publisher, output_dir=None):
+        """Processes every package of a publisher, in sorted order
 
-        csvwriter = model.CSVFilesWriter(budget_transaction='budget',
-                                         headers=self.csv_headers,
-                                         output_dir=self.output_dir)
-        activities = doc.xpath("//iati-activity[budget]")
-        for activity in activities:
-            self.process_activity_for_budgets(csvwriter, activity)
+        In shard mode, each package is written to its own shard rather than
+        appended directly to the CSV files in `output_dir`.
 
-        csvwriter.write()
+        :param publisher: the publisher directory within the iatikit cache
+        :type publisher: str
+        :param output_dir: the directory to write CSV files to, defaults to `self.output_dir`
+        :type output_dir: str
+        """
+        start = time.time()
+        print("Processing {}".format(publisher))
+        packages = self.list_packages(publisher)
+        if packages is None:
+            return
+        if self.parse_ahead and not self.streaming:
+            # the packages which will be processed are read and parsed on a background thread,
+            # ahead of the package being flattened
+            self.package_parser = parsing.ParseAhead([
+                    ((publisher, package), size)
+                    for publisher, package, size in packages
+                    if (self.journal.completed(publisher, package) is None)
+                        and not self.is_unchanged(publisher, package)],
+                self.parse_package, self.parse_ahead, self.parse_ahead_bytes)
+        for publisher, package, size in packages:
+            if self.is_completed(publisher, package):
+                continue
+            if self.is_unchanged(publisher, package):
+                self.run_report.add(self.manifest.unchanged_result(publisher, package))
+                continue
+            if self.shards:
+                shard_tmp_dir = shards.start_shard(self.shard_dir(publisher, package))
+                result = self.run_package(publisher, package, shard_tmp_dir)
+                self.finish_shard(publisher, package, [result])
+            else:
+                result = self.run_package(publisher, package, output_dir)
+            self.journal_package(result)
+            self.run_report.add(result)
+            self.package_costs.record(publisher, package, size, result['seconds'])
+        if self.package_parser is not None:
+            self.package_parser.close()
+            self.package_parser = None
+        end = time.time()
+        print("Processing {} took {}s".format(publisher, end-start))
+
+
+    def package_chunks(self, publisher, package, size):
+        """Returns the byte ranges to split a package into, if it is larger than `self.chunk_size`
+
+        :return: a list of byte ranges, or [None] if the package is to be processed whole
+        """
+        if (self.chunk_size is None) or (size <= self.chunk_size):
+            return [None]
+        # packages which are compressed or in an archive are not split, as chunks are read by byte range
+        filename = self.package_source.filename(publisher, package)
+        if filename is None:
+            return [None]
+        try:
+            version = streaming.peek_version(filename)
+        except (etree.XMLSyntaxError, OSError):
+            # processed whole, so that the worker records the package as failed
+            return [None]
+        if version not in IATI_VERSIONS:
+            return [None]
+        byte_ranges = chunking.split_package(filename, self.chunk_size)
+        return byte_ranges or [None]
+
+
+    def pool_initargs(self, context):
+        """Returns the arguments with which `parallel.init_worker` sets up each worker.
+
+        Forked workers inherit the parent's reference data, sharing its pages
+        until they are written to; the objects set up so far are frozen, so
+        that garbage collection in the workers does not write to (and so copy)
+        them. Workers started otherwise are each sent a copy of the flattener,
+        and so of the codelists; only the exchange rate table is shared by
+        them, as each maps it rather than reading it in.
+
+        :param context: the multiprocessing context of the pool
+        :rtype: tuple
+        """
+        if context.get_start_method() == 'fork':
+            gc.collect()
+            gc.freeze()
+            return (self,)
+        return (parallel.worker_flattener(self),)
+
+
+    def run_packages_in_pool(self, publishers):
+        """Processes the packages of all publishers across a pool of `self.workers` processes.
+
+        Packages are scheduled largest first, using the timings of earlier runs
+        where they exist; packages larger than `self.chunk_size` are split into
+        chunks of activities which are processed separately, unless an activity
+        identifier is repeated within them. Each package is
+        written to its own shard, with a subdirectory for each chunk, so that
+        once the shards are merged in sorted order the output is the same as for
+        a serial run whatever the number of workers.
+        """
+        packages = []
+        for publisher in publishers:
+            for publisher, package, size in self.list_packages(publisher) or []:
+                if self.is_completed(publisher, package):
+                    continue
+                if self.is_unchanged(publisher, package):
+                    self.run_report.add(self.manifest.unchanged_result(publisher, package))
+                else:
+                    packages.append((publisher, package, size))
+        context = multiprocessing.get_context(self.start_method)
+        initargs = self.pool_initargs(context)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                    initializer=parallel.init_worker, initargs=initargs) as executor:
+                if self.package_source.sequential:
+                    # each worker then reads a compressed tar archive forward, rather than
+                    # decompressing it again from the start for every package
+                    scheduled = self.package_source.in_archive_order(packages)
+                else:
+                    scheduled = self.package_costs.schedule(packages)
+                futures = {}
+                for publisher, package, size in scheduled:
+                    byte_ranges = self.package_chunks(publisher, package, size)
+                    shard_tmp_dir = shards.start_shard(self.shard_dir(publisher, package),
+                                                       chunked=(byte_ranges != [None]))
+                    if byte_ranges == [None]:
+                        chunk_dirs = [shard_tmp_dir]
+                    else:
+                        chunk_dirs = [os.path.join(shard_tmp_dir, "{:05}".format(chunk))
+                                      for chunk in range(len(byte_ranges))]
+                    futures[(publisher, package)] = [executor.submit(
+                            parallel.process_package, publisher, package, chunk_dir, byte_range)
+                        for chunk_dir, byte_range in zip(chunk_dirs, byte_ranges)]
+                for publisher, package, size in packages:
+                    results = [future.result() for future in futures[(publisher, package)]]
+                    self.finish_shard(publisher, package, results)
+                    # a package split into chunks is reported and journaled once, as failed if any chunk failed
+                    failed = [result for result in results if result['status'] == 'failed']
+                    result = dict((failed or results)[0], seconds=sum(result['seconds'] for result in results))
+                    self.run_report.add(result)
+                    self.journal.record(result)
+                    self.package_costs.record(publisher, package, size, result['seconds'])
+        finally:
+            # also on failure, so that the parent's heap is not left frozen
+            gc.unfreeze()
+
+
+    def node_publishers(self, publishers):
+        """Returns this node's share of the publishers, balanced by the size of their packages
+
+        :param publishers: all of the publishers to be processed, across every node
+        :type publishers: [str]
+        :rtype: [str]
+        """
+        publisher_sizes = {}
+        for publisher in publishers:
+            packages = self.list_packages(publisher)
+            if packages is not None:
+                publisher_sizes[publisher] = sum(size for publisher, package, size in packages)
+        return scheduling.node_publishers(publisher_sizes, *scheduling.parse_node(self.shard))
 
 
     def run_for_publishers(self):
         print("BEGINNING PROCESS AT {}".format(datetime.datetime.utcnow()))
         beginning = time.time()
-        for publisher in self.publishers:
-            if publisher in EXCLUDED_PUBLISHERS: continue
-            start = time.time()
-            try:
-                print("Processing {}".format(publisher))
-                packages = os.listdir(os.path.join(self.iatikitcache_dir, "data", publisher))
-                packages.sort()
-                for package in packages:
-                    try:
-                        if package.endswith(".xml"):
-                            self.process_package(publisher, package,
-                                                 os.path.join(self.iatikitcache_dir, "data", publisher))
-                    except BdbQuit:
-                        raise
-                    except Exception as e:
-                        print("Exception with package {}".format(package))
-                        print("Exception was {}".format(repr(e)))
-                        continue
-            except NotADirectoryError:
-                continue
-            end = time.time()
-            print("Processing {} took {}s".format(publisher, end-start))
+        publishers = [publisher for publisher in self.publishers if publisher not in EXCLUDED_PUBLISHERS]
+        if self.shard is not None:
+            publishers = self.node_publishers(publishers)
+            print("Processing {} publishers as shard {}".format(len(publishers), self.shard))
+        if self.manifest is not None:
+            self.remove_stale_shards(publishers)
+        elif self.shards and not self.journal.entries:
+            # the shards of a resumed run are kept, as the journal refers to them
+            shutil.rmtree(os.path.join(self.output_dir, 'shards'), ignore_errors=True)
+        if (self.workers or 1) > 1:
+            self.run_packages_in_pool(publishers)
+        else:
+            for publisher in publishers:
+                self.process_publisher(publisher)
+        if self.shards:
+            self.merge_shards()
+        if self.empty_files:
+            self.write_empty_files()
+        if self.manifest is not None:
+            self.manifest.save()
+        self.package_costs.save()
+        self.run_report.save(os.path.join(self.output_dir, 'run-report.json'))
+        self.journal.remove()
+        print("Skipped {} packages with unsupported versions, {} packages failed, {} packages unchanged".format(
+            len(self.run_report.skipped), len(self.run_report.failed), self.run_report.unchanged))
         print("FINISHED PROCESS AT {}".format(datetime.datetime.utcnow()))
         finishing = time.time()
         print("PROCESSING TOOK {}".format(finishing-beginning))
@@ -224,25 +728,79 @@ class FlattenIATIData():
             publishers=None,
             langs=['en', 'fr'],
             run_publishers=True,
-            exchange_rates_filename='rates.csv'):
+            exchange_rates_filename='rates.csv',
+            workers=None,
+            chunk_size=None,
+            streaming=False,
+            shards=False,
+            incremental=False,
+            resume=False,
+            shard=None,
+            reference_data=None,
+            deferred_conversion=False,
+            start_method=None,
+            empty_files=False,
+            parse_ahead=0,
+            parse_ahead_bytes=parsing.DEFAULT_MAX_BYTES):
         self.exchange_rates_filename = exchange_rates_filename
+        # codelists and exchange rates are downloaded through an on-disk cache, shared with GroupFlatIATIData
+        self.reference_data = reference_data or reference.ReferenceDataCache()
+        # downloaded concurrently, while the output directory is set up, and read by setup_codelists
+        self.reference_data.prefetch(reference_data_urls(langs, refresh_rates))
         self.iatikitcache_dir = iatikitcache_dir
+        # packages are read from the iatikit cache directory, or streamed from an archive of it
+        self.package_source = sources.open_packages(iatikitcache_dir)
+        if incremental and isinstance(self.package_source, sources.PackageArchive):
+            raise ValueError("Incremental runs need an iatikit cache directory, not an archive")
         self.langs = langs
+        self.workers = workers
+        # the multiprocessing start method of the pool's workers, defaulting to the platform's
+        self.start_method = start_method
+        self.chunk_size = chunk_size
+        self.streaming = streaming
+        self.deferred_conversion = deferred_conversion
+        self.empty_files = empty_files
+        # the number of packages, and of bytes, to parse ahead when not streaming
+        self.parse_ahead = parse_ahead
+        self.parse_ahead_bytes = parse_ahead_bytes
+        self.package_parser = None
+        # a node of a multi-node run (shard='i/N') processes only some publishers, and
+        # keeps its shards to be merged with those of the other nodes
+        self.shard = shard
+        if shard is not None:
+            scheduling.parse_node(shard)
+        # the pool always writes to shards, as its workers cannot share the CSV files
+        self.shards = shards or incremental or (shard is not None) or ((workers or 1) > 1)
         self.csv_headers = variables.headers(langs)
         self.activity_csv_headers = variables.activity_headers(langs)
         self.output_dir = output
         os.makedirs(self.output_dir, exist_ok=True)
         os.makedirs(os.path.join(self.output_dir, 'csv', 'activities'), exist_ok=True)
+        self.package_costs = scheduling.PackageCosts(
+            os.path.join(self.output_dir, 'package-timings.json'))
+        self.run_report = run_report.RunReport()
+        self.journal = None
+        self.resume = resume
+        if run_publishers:
+            self.journal = journal.RunJournal(os.path.join(self.output_dir, 'journal.jsonl'), resume)
+        if resume and (self.journal is not None):
+            # remove the rows written after the last package completed before the run was interrupted
+            self.journal.truncate_output(self.output_dir)
+        else:
+            # CSV files are created as rows are first written to them, so any from an earlier run are removed
+            journal.remove_output(self.output_dir)
         print("Setting up codelists...")
         self.setup_codelists(refresh_rates=refresh_rates)
-        print("Setting up countries...")
-        self.setup_countries()
-        print("Setting up organisations...")
-        self.setup_organisations()
+        self.manifest = None
+        if incremental:
+            # shards are kept between runs, and only packages which have changed are reprocessed
+            self.manifest = manifest.PackageManifest(
+                os.path.join(self.output_dir, 'manifest.json'), self.reference_fingerprint())
+        self.output_sizes = journal.output_sizes(self.output_dir)
         if run_publishers is False: return
         print("Processing publishers...")
         if publishers is None:
-            self.publishers = os.listdir(os.path.join(self.iatikitcache_dir, "data"))
+            self.publishers = self.package_source.publishers()
         else:
             self.publishers = publishers
         self.publishers.sort()
@@ -1,4 +1,3 @@
-import requests
 import pandas as pd
 import numpy as np
 from pyexcelerate import Workbook
@@ -10,19 +9,25 @@ import os
 import math
 
 from iatiflattener.lib import variables
+from iatiflattener.lib import reference
 
 CODELISTS_URL = "https://codelists.codeforiati.org/api/json/{}/{}.json"
 
 
 class GroupFlatIATIData():
     def get_codelist_with_fallback(self, lang, codelist_name):
-        req = requests.get(CODELISTS_URL.format(lang, codelist_name))
+        req = self.reference_data.get(CODELISTS_URL.format(lang, codelist_name))
         if req.status_code == 404:
-            req = requests.get(CODELISTS_URL.format('en', codelist_name))
+            req = self.reference_data.get(CODELISTS_URL.format('en', codelist_name))
         return req
 
     def setup_codelists(self):
         self.country_names, self.column_codelist = {}, {}
+        # fetch every codelist concurrently, including the English fallbacks for other languages
+        codelist_names = ["Country", "Region", "Sector", "SectorGroup", "ReportingOrganisationGroup",
+            'OrganisationType', 'AidType', 'FinanceType', 'FlowType', 'TransactionType']
+        self.reference_data.prefetch([CODELISTS_URL.format(lang, codelist_name)
+            for lang in sorted(set(self.langs + ['en'])) for codelist_name in codelist_names])
         for lang in self.langs:
             country_req = self.get_codelist_with_fallback(lang, "Country")
             region_req = self.get_codelist_with_fallback(lang, "Region")
@@ -99,6 +104,9 @@ class GroupFlatIATIData():
 
     def get_dataframe(self, country_code, transaction_budget, lang):
         full_df = pd.DataFrame()
+        # the flattener only creates CSV files for countries and regions with data
+        if not os.path.exists(f"{self.output_folder}/csv/{transaction_budget}-{country_code}.csv"):
+            return full_df
         print("Read CSV {}-{}.csv (for {})".format(transaction_budget, country_code, lang))
                 
         for df in pd.read_csv(f"{self.output_folder}/csv/{transaction_budget}-{country_code}.csv",
@@ -187,8 +195,9 @@ class GroupFlatIATIData():
         print("FINISHED PROCESS AT {}".format(datetime.datetime.utcnow()))
 
 
-    def __init__(self, langs=['en'], country_codes=[], output_folder='output'):
+    def __init__(self, langs=['en'], country_codes=[], output_folder='output', reference_data=None):
         self.output_folder = output_folder
+        self.reference_data = reference_data or reference.ReferenceDataCache()
         self.langs = langs
         self.country_codes = country_codes
         self.CSV_HEADERS = variables.headers(langs)
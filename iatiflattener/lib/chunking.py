@@ -0,0 +1,106 @@
+import mmap
+import re
+
+
+# Activity start tags are the safe points at which a package can be split
+ACTIVITY_START = re.compile(rb'<iati-activity[\s>]')
+ACTIVITIES_END = b'</iati-activities'
+IATI_IDENTIFIER = re.compile(rb'<iati-identifier\s*>(.*?)</iati-identifier\s*>', re.S)
+
+
+def has_unique_identifiers(data, starts, end):
+    """Checks that no two activities share an identifier, which would share
+    values cached by identifier (see `model.ActivityCache`) and so cannot be
+    processed in separate chunks. Identifiers which cannot be read from the
+    raw bytes (escaped, or in CDATA sections) are taken to be repeated.
+
+    :param data: the package
+    :param starts: the offsets of the activities' start tags
+    :param end: the offset of the closing `iati-activities` tag
+    :rtype: bool
+    """
+    identifiers = set()
+    for start, next_start in zip(starts, starts[1:] + [end]):
+        match = IATI_IDENTIFIER.search(data, start, next_start)
+        if match is None:
+            return False
+        identifier = match.group(1)
+        if (b'&' in identifier) or (b'<' in identifier) or (identifier in identifiers):
+            return False
+        identifiers.add(identifier)
+    return True
+
+
+def package_has_unique_identifiers(filename):
+    """Checks, from the raw bytes of a package, that no two of its activities
+    share an identifier (see `has_unique_identifiers`)
+
+    :param filename: the path to the package
+    :type filename: str
+    :rtype: bool
+    """
+    with open(filename, 'rb') as package_file:
+        with mmap.mmap(package_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            starts = [match.start() for match in ACTIVITY_START.finditer(data)]
+            end = data.rfind(ACTIVITIES_END)
+            if not starts:
+                return True
+            if end < starts[-1]:
+                return False
+            return has_unique_identifiers(data, starts, end)
+
+
+def split_package(filename, chunk_size):
+    """Splits a package into byte ranges of about `chunk_size` bytes, each
+    holding whole activities.
+
+    Each byte range is a (header_end, start, end) tuple: the bytes up to
+    `header_end` hold the XML declaration and the opening `iati-activities`
+    tag, which are repeated for every chunk. This works on the raw bytes, so
+    an `<iati-activity` inside a comment or CDATA section would be taken to be
+    an activity boundary. Packages in which an activity identifier is repeated
+    are not split, so that their output is the same as for a serial run.
+
+    :param filename: the path to the package
+    :type filename: str
+    :param chunk_size: the approximate size of each chunk, in bytes
+    :type chunk_size: int
+    :return: a list of byte ranges, or None if the package cannot (or should not) be split
+    :rtype: [(int, int, int)]
+    """
+    with open(filename, 'rb') as package_file:
+        with mmap.mmap(package_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            starts = [match.start() for match in ACTIVITY_START.finditer(data)]
+            end = data.rfind(ACTIVITIES_END)
+            if len(starts) < 2 or end < starts[-1]:
+                return None
+            if not has_unique_identifiers(data, starts, end):
+                return None
+    header_end = starts[0]
+    byte_ranges = []
+    chunk_start = starts[0]
+    for boundary in starts[1:] + [end]:
+        if (boundary - chunk_start >= chunk_size) or (boundary == end):
+            byte_ranges.append((header_end, chunk_start, boundary))
+            chunk_start = boundary
+    return byte_ranges
+
+
+def range_size(byte_range):
+    header_end, start, end = byte_range
+    return end - start
+
+
+def read_chunk(filename, byte_range):
+    """Returns a chunk of a package as a complete XML document
+
+    :param byte_range: a (header_end, start, end) tuple from `split_package`
+    :type byte_range: (int, int, int)
+    :rtype: bytes
+    """
+    header_end, start, end = byte_range
+    with open(filename, 'rb') as package_file:
+        header = package_file.read(header_end)
+        package_file.seek(start)
+        data = package_file.read(end - start)
+    return header + data + ACTIVITIES_END + b'>'
@@ -0,0 +1,91 @@
+import datetime
+
+
+class DeferredConversions():
+    """Converts the values of flattened transaction and budget rows to USD, EUR
+    and local currency in batches, rather than one value at a time.
+
+    Rows are written holding only their original value, currency and value
+    date; `add` records each row, and `convert` then looks up the exchange
+    rates of the whole batch with `RatesTable.closest_rates` and fills in the
+    converted values as arrays.
+
+    Each value is converted with the same operations, in the same order, as
+    `model.FinancialValues` and the flattening of transactions and budgets, so
+    the output is identical:
+    `((((value_original / rate) * to_rate) / days) * days_in_quarter) * adjustment`,
+    where `days` and `days_in_quarter` are 1 for transactions."""
+
+    def add(self, row, flat_transaction_budget):
+        """Records a row whose values are to be converted
+
+        :param row: the row as it will be written to CSV, which is filled in by `convert`
+        :type row: list
+        :param flat_transaction_budget: the flattened transaction or budget the row was made from,
+            with its `conversion` as (value_original, days, days_in_quarter, adjustment)
+        :type flat_transaction_budget: dict
+        """
+        self.rows.append(row)
+        self.currencies.append(flat_transaction_budget['currency_original'])
+        self.dates.append(flat_transaction_budget['value_date'].toordinal())
+        self.local_currencies.append(self.countries_currencies.get(flat_transaction_budget['country_code']))
+        self.values.append(flat_transaction_budget['conversion'])
+
+    def convert(self):
+        """Fills in the converted values of the rows added since the last batch"""
+        if len(self.rows) == 0:
+            return
+        # imported here, as NumPy is slow to import and only needed once there are values to convert
+        import numpy as np
+        value_original, days, days_in_quarter, adjustment = np.array(self.values, dtype=np.float64).T
+        rates, closest_dates = self.exchange_rates.closest_rates(self.currencies, self.dates)
+        if not rates.all():
+            raise ZeroDivisionError("float division by zero")
+        value_usd = value_original / rates
+        eur_rates, _ = self.exchange_rates.closest_rates(["EUR"] * len(self.rows), self.dates)
+
+        # values in currencies without exchange rates are given as 0
+        known = np.array([self.exchange_rates.is_known(currency) for currency in self.local_currencies], dtype=bool)
+        local_rates = np.zeros(len(self.rows), dtype=np.float64)
+        if known.any():
+            local_rates[known], _ = self.exchange_rates.closest_rates(
+                [currency for currency, is_known in zip(self.local_currencies, known) if is_known],
+                np.array(self.dates)[known])
+        value_local = np.where(known, value_usd * local_rates, 0.0)
+
+        def apportion(values):
+            return ((values / days) * days_in_quarter) * adjustment
+
+        for row, exchange_rate, closest_date, usd, eur, local in zip(self.rows,
+                rates.tolist(), closest_dates.tolist(), apportion(value_usd).tolist(),
+                apportion(value_usd * eur_rates).tolist(), apportion(value_local).tolist()):
+            row[self.exchange_rate_index] = exchange_rate
+            row[self.exchange_rate_date_index] = self.isoformat(closest_date)
+            row[self.value_usd_index] = usd
+            row[self.value_eur_index] = eur
+            row[self.value_local_index] = local
+        self.rows, self.currencies, self.dates, self.local_currencies, self.values = [], [], [], [], []
+
+    def isoformat(self, ordinal):
+        if ordinal not in self.dates_isoformat:
+            self.dates_isoformat[ordinal] = datetime.date.fromordinal(ordinal).isoformat()
+        return self.dates_isoformat[ordinal]
+
+    def __init__(self, exchange_rates, countries_currencies, headers):
+        """
+        :param exchange_rates: exchange rates with `closest_rates` and `is_known`
+        :type exchange_rates: lib.rates.MemoizedRates
+        :param countries_currencies: the currency of each country, keyed by country code
+        :type countries_currencies: dict
+        :param headers: the headers of the CSV files the rows are written to
+        :type headers: [str]
+        """
+        self.exchange_rates = exchange_rates
+        self.countries_currencies = countries_currencies
+        self.exchange_rate_index = headers.index('exchange_rate')
+        self.exchange_rate_date_index = headers.index('exchange_rate_date')
+        self.value_usd_index = headers.index('value_usd')
+        self.value_eur_index = headers.index('value_eur')
+        self.value_local_index = headers.index('value_local')
+        self.dates_isoformat = {}
+        self.rows, self.currencies, self.dates, self.local_currencies, self.values = [], [], [], [], []
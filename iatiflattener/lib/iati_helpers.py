@@ -1,3 +1,5 @@
+from lxml import etree
+
 from .utils import get_first
 
 TRANSACTION_TYPES_RULES = {
@@ -15,6 +17,63 @@ TRANSACTION_TYPES_RULES = {
     "activity": {'provider': 'reporter', 'receiver': '4'}
 }
 
+# XPath expressions are compiled once, rather than each time they are evaluated
+NARRATIVES = etree.XPath("narrative")
+RECIPIENT_COUNTRIES = etree.XPath("recipient-country")
+RECIPIENT_REGIONS = etree.XPath("recipient-region[not(@vocabulary) or @vocabulary='1']")
+SECTORS = etree.XPath("sector[not(@vocabulary) or @vocabulary='1']")
+
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+
+class ChildIndex():
+    """The child elements of an element, grouped by tag in document order.
+
+    The children are read in a single pass, and each selection of them (by
+    vocabulary, role, type and so on) is kept once made, so that the fields
+    of an activity or transaction do not search its children again for every
+    lookup."""
+
+    def all(self, tag):
+        """Returns the children with a tag, like `findall(tag)`"""
+        return self.children.get(tag, [])
+
+    def first(self, tag):
+        """Returns the first child with a tag, or None, like `find(tag)`"""
+        children = self.children.get(tag)
+        if children:
+            return children[0]
+        return None
+
+    def default(self, tag, attribute='vocabulary', value='1'):
+        """Returns the children with a tag which do not have an attribute, or have it set to `value`,
+        e.g. sectors in the default vocabulary, like `xpath("sector[not(@vocabulary) or @vocabulary='1']")`"""
+        key = (tag, attribute, value, None)
+        if key not in self.selections:
+            self.selections[key] = [child for child in self.all(tag) if child.get(attribute) in (None, value)]
+        return self.selections[key]
+
+    def select(self, tag, **attributes):
+        """Returns the children with a tag whose attributes have the given values,
+        e.g. `select('participating-org', role='1')`"""
+        key = (tag,) + tuple(sorted(attributes.items()))
+        if key not in self.selections:
+            self.selections[key] = [child for child in self.all(tag)
+                                    if all(child.get(attribute) == value for attribute, value in attributes.items())]
+        return self.selections[key]
+
+    def __init__(self, element):
+        """
+        :param element: an `iati-activity`, `transaction` or `budget` element
+        :type element: lxml.etree._Element
+        """
+        self.element = element
+        self.children = {}
+        # comments and processing instructions are skipped
+        for child in element.iterchildren(tag=etree.Element):
+            self.children.setdefault(child.tag, []).append(child)
+        self.selections = {}
+
 
 def fix_narrative(ref, text):
     # We currently don't try to do anything clever with
@@ -27,31 +86,72 @@ def fix_narrative(ref, text):
     return ""
 
 
-def get_narrative(container, lang='en'):
-    narratives = container.xpath("narrative")
-    if len(narratives) == 0: return ""
+def get_narratives(container, langs):
+    """Returns the narrative of a container in each language, reading its
+    narratives once for all of the languages.
+
+    A narrative in the language is used if there is one, otherwise one in
+    English (or without a language), otherwise the first narrative. A
+    container with a single narrative uses it for every language.
+
+    :param container: an element holding `narrative` elements
+    :type container: lxml.etree._Element
+    :param langs: the languages, e.g. ['en', 'fr']
+    :type langs: [str]
+    :return: the text of the narrative for each language
+    :rtype: {str: str}
+    """
+    narratives = NARRATIVES(container)
+    if len(narratives) == 0: return dict((lang, "") for lang in langs)
     if len(narratives) == 1:
         if narratives[0].text:
-            return fix_narrative(container.get('ref'), narratives[0].text)
-        else: return ""
-
-    def filter_lang_non_en(element):
-        el_lang = element.get("{http://www.w3.org/XML/1998/namespace}lang")
+            text = fix_narrative(container.get('ref'), narratives[0].text)
+        else: text = ""
+        return dict((lang, text) for lang in langs)
+
+    # the position of the first narrative with each xml:lang
+    first = {}
+    for position, narrative in enumerate(narratives):
+        first.setdefault(narrative.get(XML_LANG), position)
+    english = [first[el_lang] for el_lang in (None, 'en', 'EN') if el_lang in first]
+    fallback = min(english) if english else 0
+
+    out = {}
+    for lang in langs:
         if lang != 'en':
-            return el_lang in (lang, lang.upper())
+            positions = [first[el_lang] for el_lang in (lang, lang.upper()) if el_lang in first]
+            position = min(positions) if positions else fallback
         else:
-            return el_lang in (None, 'en', 'EN')
+            position = fallback
+        out[lang] = fix_narrative(container.get('ref'), narratives[position].text)
+    return out
+
 
-    def filter_lang(element):
-        el_lang = element.get("{http://www.w3.org/XML/1998/namespace}lang")
-        return el_lang in (None, 'en', 'EN')
+def get_narrative(container, lang='en'):
+    return get_narratives(container, [lang])[lang]
+
+
+class NarrativeCache():
+    """The narratives of elements in each language, read once per element
+    with `get_narratives` and kept for the life of an activity, however many
+    fields and languages use them."""
+
+    def get(self, container):
+        """Returns the narrative of a container in each of the languages
 
-    filtered = list(filter(filter_lang_non_en, narratives))
-    if len(filtered) == 0:
-        filtered = list(filter(filter_lang, narratives))
-        if len(filtered)==0:
-            return fix_narrative(container.get('ref'), narratives[0].text)
-    return fix_narrative(container.get('ref'), filtered[0].text)
+        :rtype: {str: str}
+        """
+        if container not in self.narratives:
+            self.narratives[container] = get_narratives(container, self.langs)
+        return self.narratives[container]
+
+    def __init__(self, langs):
+        """
+        :param langs: the languages, e.g. ['en', 'fr']
+        :type langs: [str]
+        """
+        self.langs = langs
+        self.narratives = {}
 
 
 def get_org_name(organisations, ref, text=None):
@@ -65,11 +165,18 @@ def get_org_name(organisations, ref, text=None):
 
 
 def get_narrative_text(element):
-    if element.find("narrative") is not None:
-        return element.find("narrative").text
+    narrative = element.find("narrative")
+    if narrative is not None:
+        return narrative.text
     return None
 
 
+def get_attributes(elements):
+    """Returns copies of the attributes of a list of elements, which can be
+    kept after the elements themselves have been cleared."""
+    return [dict(element.attrib) for element in elements]
+
+
 def filter_none(item):
     return item is not None
 
@@ -112,20 +219,20 @@ def clean_countries(_countries, _regions=[]):
 
 def get_countries(activity, transaction):
     countries = get_first((
-        transaction.xpath("recipient-country"),
-        activity.xpath("recipient-country")),
+        RECIPIENT_COUNTRIES(transaction),
+        RECIPIENT_COUNTRIES(activity)),
         [])
     regions = get_first((
-        transaction.xpath("recipient-region[not(@vocabulary) or @vocabulary='1']"),
-        activity.xpath("recipient-region[not(@vocabulary) or @vocabulary='1']")),
+        RECIPIENT_REGIONS(transaction),
+        RECIPIENT_REGIONS(activity)),
         [])
     return clean_countries(countries, regions)
 
 
 def get_sectors(activity, transaction):
     sectors = get_first((
-        transaction.xpath("sector[not(@vocabulary) or @vocabulary='1']"),
-        activity.xpath("sector[not(@vocabulary) or @vocabulary='1']")),
+        SECTORS(transaction),
+        SECTORS(activity)),
         [])
     tr_sectors = clean_sectors(sectors)
     if len(tr_sectors) > 0:
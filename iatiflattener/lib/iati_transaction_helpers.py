@@ -1,108 +1,159 @@
 from .iati_helpers import value_in_usd
-from .utils import get_first, get_date
-from collections import defaultdict
-
-def get_codes_from_transactions(transactions, exchange_rates):
-    # If there is only one code, we just return that one as 100%
-    unique_codes = set(list(map(lambda transaction: transaction[0], transactions)))
-    if len(unique_codes) == 1:
-        return [{'percentage': 100.0, 'code': next(iter(unique_codes))}]
-    # If there is only one currency, we can just split by value, ignoring currency conversion
-    unique_currencies = set(list(map(lambda transaction: transaction[1], transactions)))
-    if len(unique_currencies) != 1:
-        transactions = list(map(lambda transaction: (
-            transaction[0],
-            'USD',
-            value_in_usd(
-                value=transaction[2],
-                currency=transaction[1],
-                value_date=get_date(transaction[3]),
-                exchange_rates=exchange_rates
-            ),
-            transaction[3]
-        ), transactions))
-
-    transactionSum = sum(map(lambda t: float(t[2]), transactions))
-    _out = defaultdict(dict)
-    for code, transaction_currency, transaction_value, transaction_value_date in transactions:
-        if _out.get(code) is None:
-            _out[code] = 0
-        _out[code] += (transaction_value/transactionSum)*100.0
-
-    return list(map(lambda _code: {'code': _code[0], 'percentage': _code[1]}, _out.items()))
-
-
-def get_sectors_from_transactions(activity,
-        default_currency, exchange_rates):
-    # Try outgoing commitments
-    transactions_with_sectors = activity.xpath(
-        "transaction[sector[not(@vocabulary) or @vocabulary='1']][transaction-type/@code='2']"
-    )
-    # If no outgoing commitments, try incoming commitments
-    if len(transactions_with_sectors) == 0:
-        transactions_with_sectors = activity.xpath(
-            "transaction[sector[not(@vocabulary) or @vocabulary='1']][transaction-type/@code='11']"
-        )
-    # If there are no transactions, return
-    if len(transactions_with_sectors) == 0: return [{'code': '', 'percentage': 100.0}]
-    transactions = list(map(lambda transaction: (
-        transaction.xpath("sector[not(@vocabulary) or @vocabulary='1']")[0].get('code'),
-        transaction.find("value").get('currency', default_currency),
-        float(transaction.find("value").text),
-        transaction.find("value").get('value-date'),
-    ), transactions_with_sectors))
-
-    return get_codes_from_transactions(transactions, exchange_rates)
-
-
-def get_countries_from_transactions(activity,
-        default_currency, exchange_rates):
-    # Try outgoing commitments
-    transactions_with_countries = activity.xpath(
-        "transaction[recipient-country or recipient-region[not(@vocabulary) or @vocabulary='1']][transaction-type/@code='2']"
-    )
-    # If no outgoing commitments, then try incoming commitments
-    if len(transactions_with_countries) == 0:
-        transactions_with_countries = activity.xpath(
-            "transaction[recipient-country or recipient-region[not(@vocabulary) or @vocabulary='1']][transaction-type/@code='11']"
-        )
-    # If there are no transactions, return
-    if len(transactions_with_countries) == 0: return []
-    transactions = list(map(lambda transaction: (
-        get_first((
-            transaction.xpath("recipient-country"),
-            transaction.xpath("recipient-region[not(@vocabulary) or @vocabulary='1']")
-        ))[0].get('code'),
-        transaction.find("value").get('currency', default_currency),
-        float(transaction.find("value").text),
-        transaction.find("value").get('value-date'),
-    ), transactions_with_countries))
-
-    return get_codes_from_transactions(transactions, exchange_rates)
-
-
-def get_classification_from_transactions(activity, default_currency, exchange_rates, field_name):
-    fields_xpath = {
-        'aid-type': "aid-type[not(@vocabulary) or @vocabulary='1']",
-        'flow-type': 'flow-type',
-        'finance-type': 'finance-type'
-    }
-    classification_xpath = fields_xpath.get(field_name)
-    transactions_with_classifications = activity.xpath(
-        "transaction[{}][transaction-type/@code='2']".format(classification_xpath)
-    )
-
-    if len(transactions_with_classifications) == 0:
-        transactions_with_classifications = activity.xpath(
-            "transaction[{}][transaction-type/@code='11']".format(classification_xpath)
-        )
-
-    if len(transactions_with_classifications) == 0: return [{'code': '', 'percentage': 100.0}]
-    transactions = list(map(lambda transaction: (
-        transaction.xpath(classification_xpath)[0].get('code'),
-        transaction.find("value").get('currency', default_currency),
-        float(transaction.find("value").text),
-        transaction.find("value").get('value-date'),
-    ), transactions_with_classifications))
-
-    return get_codes_from_transactions(transactions, exchange_rates)
+from .utils import get_date
+
+# Activities with at least this many values to convert to USD look up their
+# exchange rates together, with `closest_rates`, rather than one at a time
+VECTORIZE_MIN_VALUES = 256
+
+# The dimensions by which the commitments of an activity are split
+DIMENSIONS = ('sector', 'country_region', 'aid-type', 'flow-type', 'finance-type')
+
+
+def is_default_vocabulary(element):
+    return element.get('vocabulary') in (None, '1')
+
+
+class TransactionIndex():
+    """The transactions of an activity, read in a single pass, from which the
+    splits by sector, by country or region, and by aid, flow and finance type
+    are derived for budgets when the activity does not give them itself.
+
+    Each split is taken from the outgoing commitments (transaction type 2)
+    which give a code for it or, if there are none, from the incoming
+    commitments (type 11). When these are in more than one currency, they are
+    split by their values in USD, each of which is converted once however many
+    splits use it."""
+
+    def read_transaction(self, transaction):
+        types = set()
+        value = None
+        elements = dict.fromkeys(DIMENSIONS)
+        country = region = None
+        for child in transaction.iterchildren():
+            tag = child.tag
+            if tag == 'transaction-type':
+                types.add(child.get('code'))
+            elif tag == 'value':
+                if value is None:
+                    value = child
+            elif tag == 'sector':
+                if (elements['sector'] is None) and is_default_vocabulary(child):
+                    elements['sector'] = child
+            elif tag == 'recipient-country':
+                if country is None:
+                    country = child
+            elif tag == 'recipient-region':
+                if (region is None) and is_default_vocabulary(child):
+                    region = child
+            elif tag == 'aid-type':
+                if (elements['aid-type'] is None) and is_default_vocabulary(child):
+                    elements['aid-type'] = child
+            elif tag in ('flow-type', 'finance-type'):
+                if elements[tag] is None:
+                    elements[tag] = child
+        # a recipient country is used in preference to a region
+        elements['country_region'] = country if country is not None else region
+        for transaction_type in types:
+            if transaction_type in self.commitments:
+                self.commitments[transaction_type].append(len(self.values))
+        self.values.append(value)
+        for dimension in DIMENSIONS:
+            self.elements[dimension].append(elements[dimension])
+
+    def value(self, position):
+        """Returns the currency, value and value date of a transaction"""
+        value = self.values[position]
+        return value.get('currency', self.default_currency), float(value.text), value.get('value-date')
+
+    def values_usd(self, positions, values):
+        """Returns the values of transactions in USD, converting those not converted already
+
+        :param positions: the positions of the transactions
+        :param values: the (currency, value, value date) of each transaction
+        :rtype: [float]
+        """
+        missing = [(position, value) for position, value in zip(positions, values) if position not in self.usd]
+        if len(missing) >= VECTORIZE_MIN_VALUES:
+            exchange_rates, _ = self.exchange_rates.closest_rates(
+                [currency for position, (currency, value, value_date) in missing],
+                [get_date(value_date).toordinal() for position, (currency, value, value_date) in missing])
+            for (position, (currency, value, value_date)), exchange_rate in zip(missing, exchange_rates.tolist()):
+                self.usd[position] = value / exchange_rate
+        else:
+            for position, (currency, value, value_date) in missing:
+                self.usd[position] = value_in_usd(
+                    value=value,
+                    currency=currency,
+                    value_date=get_date(value_date),
+                    exchange_rates=self.exchange_rates)
+        return [self.usd[position] for position in positions]
+
+    def split(self, dimension):
+        """Splits the activity's commitments by the codes they give for a dimension
+
+        :param dimension: one of `DIMENSIONS`
+        :type dimension: str
+        :return: the percentage for each code, or None if no commitments give a code
+        :rtype: [{'code': str, 'percentage': float}]
+        """
+        elements = self.elements[dimension]
+        for transaction_type in ('2', '11'):
+            positions = [position for position in self.commitments[transaction_type]
+                         if elements[position] is not None]
+            if len(positions) > 0:
+                break
+        else:
+            return None
+        codes = [elements[position].get('code') for position in positions]
+        values = [self.value(position) for position in positions]
+
+        # If there is only one code, we just return that one as 100%
+        unique_codes = set(codes)
+        if len(unique_codes) == 1:
+            return [{'percentage': 100.0, 'code': next(iter(unique_codes))}]
+        # If there is only one currency, we can just split by value, ignoring currency conversion
+        if len(set(currency for currency, value, value_date in values)) != 1:
+            amounts = self.values_usd(positions, values)
+        else:
+            amounts = [value for currency, value, value_date in values]
+
+        total = sum(map(float, amounts))
+        _out = {}
+        for code, amount in zip(codes, amounts):
+            if _out.get(code) is None:
+                _out[code] = 0
+            _out[code] += (amount/total)*100.0
+        return list(map(lambda _code: {'code': _code[0], 'percentage': _code[1]}, _out.items()))
+
+    def __init__(self, activity, default_currency, exchange_rates):
+        """
+        :param activity: an `iati-activity` element
+        :type activity: lxml.etree._Element
+        :param default_currency: the currency of values which do not give their own
+        :type default_currency: str
+        :param exchange_rates: exchange rates with `closest_rate` and `closest_rates`
+        :type exchange_rates: lib.rates.MemoizedRates
+        """
+        self.default_currency = default_currency
+        self.exchange_rates = exchange_rates
+        # the positions of the outgoing and incoming commitments
+        self.commitments = {'2': [], '11': []}
+        # the `value` element of each transaction, and its element for each dimension
+        self.values = []
+        self.elements = dict((dimension, []) for dimension in DIMENSIONS)
+        self.usd = {}
+        for transaction in activity.iterchildren('transaction'):
+            self.read_transaction(transaction)
+
+
+def get_sectors_from_transactions(transaction_index):
+    # If there are no commitments with sectors, there is a single empty sector
+    return transaction_index.split('sector') or [{'code': '', 'percentage': 100.0}]
+
+
+def get_countries_from_transactions(transaction_index):
+    return transaction_index.split('country_region') or []
+
+
+def get_classification_from_transactions(transaction_index, field_name):
+    return transaction_index.split(field_name) or [{'code': '', 'percentage': 100.0}]
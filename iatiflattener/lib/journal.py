@@ -0,0 +1,108 @@
+import os
+import json
+
+
+def output_sizes(output_dir):
+    """Returns the size of each CSV file in an output directory
+
+    :return: a dictionary of sizes, keyed by the path relative to `output_dir`
+    :rtype: dict
+    """
+    sizes = {}
+    for subdir in ('csv', os.path.join('csv', 'activities')):
+        if not os.path.isdir(os.path.join(output_dir, subdir)):
+            continue
+        with os.scandir(os.path.join(output_dir, subdir)) as entries:
+            for entry in entries:
+                if entry.name.endswith('.csv') and entry.is_file():
+                    sizes[os.path.join(subdir, entry.name)] = entry.stat().st_size
+    return sizes
+
+
+def remove_output(output_dir):
+    """Removes the CSV files in an output directory, which are created again
+    as rows are written to them"""
+    for filename in output_sizes(output_dir):
+        os.remove(os.path.join(output_dir, filename))
+
+
+def fsync_file(filename):
+    with open(filename, 'rb') as input_file:
+        os.fsync(input_file.fileno())
+
+
+class RunJournal():
+    """A durable record of the packages completed during a run, so that an
+    interrupted run can be resumed rather than started again.
+
+    Each completed package is appended as a line of JSON holding its result
+    and, when rows are appended directly to the CSV files, the new sizes of the
+    files it wrote to. The journal is fsynced after each line."""
+
+    def load(self):
+        """Reads the entries of an existing journal, dropping any partly written last line"""
+        valid_size = 0
+        with open(self.filename, 'rb') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                self.entries[(entry['result']['publisher'], entry['result']['package'])] = entry
+                self.sizes.update(entry.get('sizes', {}))
+                valid_size += len(line)
+        with open(self.filename, 'r+b') as journal_file:
+            journal_file.truncate(valid_size)
+
+    def completed(self, publisher, package):
+        """Returns the result recorded for a package, or None if it has not been completed
+
+        :rtype: dict
+        """
+        entry = self.entries.get((publisher, package))
+        if entry is None:
+            return None
+        return entry['result']
+
+    def record(self, result, sizes=None):
+        """Records a completed package
+
+        :param result: the result from `FlattenIATIData.run_package`
+        :type result: dict
+        :param sizes: the sizes of the CSV files written to, which must already be on disk
+        :type sizes: dict
+        """
+        entry = {'result': result}
+        if sizes is not None:
+            entry['sizes'] = sizes
+            self.sizes.update(sizes)
+        self.entries[(result['publisher'], result['package'])] = entry
+        with open(self.filename, 'a') as journal_file:
+            journal_file.write(json.dumps(entry, sort_keys=True) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def truncate_output(self, output_dir):
+        """Truncates each CSV file to its size after the last completed package
+        which wrote to it, and removes those which no completed package wrote to."""
+        for filename, size in output_sizes(output_dir).items():
+            if filename in self.sizes:
+                with open(os.path.join(output_dir, filename), 'r+b') as csv_file:
+                    csv_file.truncate(self.sizes[filename])
+            else:
+                os.remove(os.path.join(output_dir, filename))
+
+    def remove(self):
+        """Removes the journal once a run has finished"""
+        os.remove(self.filename)
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.entries = {}
+        self.sizes = {}
+        if resume and os.path.exists(filename):
+            self.load()
+        else:
+            open(filename, 'w').close()
@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+
+
+def file_sha1(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class PackageManifest():
+    """Records the size, modification time and content hash of each package
+    whose shard is up to date, along with a fingerprint of the reference data
+    (codelists, exchange rates and languages) used to flatten it.
+
+    If the fingerprint changes, every package is treated as changed."""
+
+    def key(self, publisher, package):
+        return "{}/{}".format(publisher, package)
+
+    def is_unchanged(self, publisher, package, filename):
+        """Checks whether a package is the same as when it was recorded.
+
+        The size and modification time are compared first; the content is only
+        hashed if the modification time has changed but the size has not.
+
+        :param filename: the path to the package
+        :type filename: str
+        :rtype: bool
+        """
+        entry = self.packages.get(self.key(publisher, package))
+        if entry is None:
+            return False
+        stat = os.stat(filename)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns == entry['mtime']:
+            return True
+        if file_sha1(filename) != entry['sha1']:
+            return False
+        entry['mtime'] = stat.st_mtime_ns
+        return True
+
+    def unchanged_result(self, publisher, package):
+        """Returns a result for an unchanged package, in the form returned by `FlattenIATIData.run_package`
+
+        Packages which were skipped because of their IATI version are still reported as skipped.
+        """
+        entry = self.packages[self.key(publisher, package)]
+        result = {
+            'publisher': publisher,
+            'package': package,
+            'status': 'unchanged',
+            'seconds': 0
+        }
+        if 'version' in entry:
+            result['status'] = 'skipped'
+            result['version'] = entry['version']
+        return result
+
+    def record(self, publisher, package, filename, result):
+        """Records a package once its shard has been committed
+
+        :param result: the result from `FlattenIATIData.run_package`
+        :type result: dict
+        """
+        stat = os.stat(filename)
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'sha1': file_sha1(filename)
+        }
+        if result['status'] == 'skipped':
+            entry['version'] = result['version']
+        self.packages[self.key(publisher, package)] = entry
+
+    def remove(self, publisher, package):
+        self.packages.pop(self.key(publisher, package), None)
+
+    def save(self):
+        # written to a temporary file first, so that an interrupted save leaves the previous manifest
+        with open(self.filename + '.tmp', 'w') as json_file:
+            json.dump({
+                'fingerprint': self.fingerprint,
+                'packages': self.packages
+            }, json_file, indent=2, sort_keys=True)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def __init__(self, filename, fingerprint):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.packages = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as json_file:
+                manifest = json.load(json_file)
+            if manifest.get('fingerprint') == fingerprint:
+                self.packages = manifest['packages']
@@ -0,0 +1,46 @@
+import os
+
+
+# The flattener for this worker process, set up once by `init_worker` so that
+# the codelists and exchange rates are not sent with every task.
+_flattener = None
+
+# The state of a flattener which only the parent process uses
+PARENT_ATTRIBUTES = ['reference_data', 'journal', 'manifest', 'run_report', 'package_costs']
+
+
+def init_worker(flattener):
+    """Sets up a worker process
+
+    :param flattener: the flattener, which is inherited by forked workers
+    :type flattener: FlattenIATIData
+    """
+    global _flattener
+    _flattener = flattener
+
+
+def worker_flattener(flattener):
+    """Returns a shallow copy of a flattener without the state only used by
+    the parent process, to be sent to worker processes which are not forked.
+
+    Each such worker unpickles its own copy of the codelists; only the
+    exchange rate table, which is pickled as its location, is mapped rather
+    than copied."""
+    copy = object.__new__(type(flattener))
+    copy.__dict__.update(dict((name, value) for name, value in flattener.__dict__.items()
+        if name not in PARENT_ATTRIBUTES))
+    return copy
+
+
+def make_output_dirs(output_dir):
+    os.makedirs(os.path.join(output_dir, 'csv', 'activities'), exist_ok=True)
+
+
+def process_package(publisher, package, output_dir, byte_range=None):
+    """Runs in a worker process: flattens one package (or a chunk of one) into its own output directory
+
+    :return: the result from `FlattenIATIData.run_package`
+    :rtype: dict
+    """
+    make_output_dirs(output_dir)
+    return _flattener.run_package(publisher, package, output_dir, byte_range)
@@ -0,0 +1,81 @@
+import threading
+
+
+# The most bytes of packages to hold parsed ahead, besides the package being flattened
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class ParseAhead():
+    """Reads and parses packages on a background thread, ahead of the thread
+    flattening them, so that disk reads and parsing (during which lxml releases
+    the GIL) overlap with flattening.
+
+    Packages are parsed in the order given, which must be the order in which
+    they are taken with `get`. At most `max_packages` parsed packages are held
+    waiting to be taken, and no more than `max_bytes` of packages (by file
+    size), although a single larger package is always parsed once the queue is
+    empty."""
+
+    def run(self):
+        for key, size in self.packages:
+            with self.condition:
+                while (not self.closed) and self.queue and (
+                        (len(self.queue) >= self.max_packages) or (self.queued_bytes + size > self.max_bytes)):
+                    self.condition.wait()
+                if self.closed:
+                    return
+            try:
+                result = (self.parse(key), None)
+            except Exception as e:
+                result = (None, e)
+            with self.condition:
+                self.queue[key] = result
+                self.queued_bytes += size
+                self.condition.notify_all()
+
+    def get(self, key):
+        """Returns a parsed package, waiting for it if it has not been parsed yet
+
+        :param key: the package, as given to `parse`
+        :return: the result of `parse` for the package, which is raised if it is an exception
+        """
+        with self.condition:
+            while key not in self.queue:
+                self.condition.wait()
+            result, error = self.queue.pop(key)
+            self.queued_bytes -= self.sizes[key]
+            self.condition.notify_all()
+        if error is not None:
+            raise error
+        return result
+
+    def close(self):
+        """Stops parsing, once any package being parsed has finished"""
+        with self.condition:
+            self.closed = True
+            self.queue = {}
+            self.condition.notify_all()
+        self.thread.join()
+
+    def __init__(self, packages, parse, max_packages=2, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param packages: each package (e.g. its path) and its size, in the order they will be taken
+        :type packages: [(object, int)]
+        :param parse: the function which reads and parses a package
+        :type parse: function
+        :param max_packages: the most parsed packages to hold
+        :type max_packages: int
+        :param max_bytes: the most bytes of packages to hold
+        :type max_bytes: int
+        """
+        self.packages = packages
+        self.sizes = dict(packages)
+        self.parse = parse
+        self.max_packages = max_packages
+        self.max_bytes = max_bytes
+        self.queue = {}
+        self.queued_bytes = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
@@ -0,0 +1,258 @@
+import os
+import csv
+import json
+import shutil
+import weakref
+import datetime
+import functools
+from bisect import bisect_left
+
+from iatiflattener.lib import manifest
+
+
+TABLE_VERSION = 1
+# values in a package mostly share a handful of currencies and value dates
+CLOSEST_RATE_CACHE_SIZE = 4096
+
+
+def read_rates(filename):
+    """Reads a rates CSV file as `exchangerates.CurrencyConverter` does, where
+    a later row for the same currency and date replaces an earlier one.
+
+    :return: a dictionary of {currency: {date ordinal: rate}}
+    :rtype: dict
+    """
+    from exchangerates import make_date_from_iso
+    rates = {}
+    with open(filename, 'r') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        next(csv_reader)
+        for row in csv_reader:
+            rates.setdefault(row[2], {})[make_date_from_iso(row[0]).toordinal()] = float(row[1])
+    return rates
+
+
+def default_table_dir(filename):
+    """Returns the directory to compile a rates CSV file to, next to the file
+    itself (`rates-table` for `rates.csv`), rather than among the output.
+
+    :rtype: str
+    """
+    return os.path.splitext(filename)[0] + '-table'
+
+
+def compile_rates(filename, table_dir):
+    """Compiles a rates CSV file into a binary table: an array of dates (as
+    ordinals) and an array of rates, holding each currency's rates in date
+    order, with an index of where each currency starts and ends.
+
+    :param filename: the rates CSV file
+    :type filename: str
+    :param table_dir: the directory to write the table to, replacing any existing table
+    :type table_dir: str
+    """
+    import numpy as np
+    rates = read_rates(filename)
+    currencies, dates, values = {}, [], []
+    for currency in sorted(rates):
+        start = len(dates)
+        for ordinal in sorted(rates[currency]):
+            dates.append(ordinal)
+            values.append(rates[currency][ordinal])
+        currencies[currency] = [start, len(dates)]
+    # written under a name of its own, as another run may be compiling the same file
+    table_tmp_dir = '{}.tmp-{}'.format(table_dir, os.getpid())
+    shutil.rmtree(table_tmp_dir, ignore_errors=True)
+    os.makedirs(table_tmp_dir)
+    np.save(os.path.join(table_tmp_dir, 'dates.npy'), np.array(dates, dtype=np.int32))
+    np.save(os.path.join(table_tmp_dir, 'rates.npy'), np.array(values, dtype=np.float64))
+    with open(os.path.join(table_tmp_dir, 'index.json'), 'w') as json_file:
+        json.dump({
+            'version': TABLE_VERSION,
+            'source_sha1': manifest.file_sha1(filename),
+            'currencies': currencies
+        }, json_file)
+    shutil.rmtree(table_dir, ignore_errors=True)
+    try:
+        os.rename(table_tmp_dir, table_dir)
+    except OSError:
+        # another run has just put its table in place
+        shutil.rmtree(table_tmp_dir, ignore_errors=True)
+
+
+def load_rates(filename, table_dir):
+    """Returns the rates in a CSV file, compiling them to a table first unless
+    `table_dir` already holds a table compiled from the same file.
+
+    :rtype: RatesTable
+    """
+    try:
+        with open(os.path.join(table_dir, 'index.json'), 'r') as json_file:
+            index = json.load(json_file)
+    except FileNotFoundError:
+        index = {}
+    if (index.get('version') != TABLE_VERSION) or (index.get('source_sha1') != manifest.file_sha1(filename)):
+        compile_rates(filename, table_dir)
+    return RatesTable(table_dir)
+
+
+def unknown_currency(currency):
+    """Returns the exception `exchangerates.CurrencyConverter` raises for a currency without rates
+
+    :rtype: exchangerates.UnknownCurrencyException
+    """
+    from exchangerates import UnknownCurrencyException
+    return UnknownCurrencyException("Unknown currency: {}".format(currency))
+
+
+class RatesTable():
+    """Exchange rates from a table written by `compile_rates`, with the same
+    `closest_rate` and `known_currencies` as `exchangerates.CurrencyConverter`.
+
+    The arrays are memory mapped, so loading the table does not read the rates
+    in, and processes using the same table share its pages.
+
+    NumPy and `exchangerates` are only imported when they are used, as they are
+    slow to import and worker processes import this module to unpickle the table."""
+
+    def known_currencies(self):
+        return ",".join(sorted(self.currencies.keys()))
+
+    def closest_rate(self, currency, date):
+        """Returns the rate for the date closest to `date`, taking the earlier
+        date where two are equally close.
+
+        :type currency: str
+        :type date: datetime.date
+        :return: a dictionary with the `closest_date` and the `conversion_rate`
+        :rtype: dict
+        """
+        if currency == "USD":
+            return {"closest_date": date, "conversion_rate": 1.0}
+        dates, currency_rates = self.currency_rates(currency)
+        ordinal = date.toordinal()
+        position = bisect_left(dates, ordinal)
+        if position == 0:
+            closest = 0
+        elif position == len(dates):
+            closest = len(dates) - 1
+        elif dates[position] - ordinal < ordinal - dates[position - 1]:
+            closest = position
+        else:
+            closest = position - 1
+        return {
+            "closest_date": datetime.date.fromordinal(dates[closest]),
+            "conversion_rate": currency_rates[closest]
+        }
+
+    def closest_rates(self, currencies, ordinals):
+        """Looks up the closest rates for many values at once, as `closest_rate`
+        does for one, with a vectorized search of each currency's dates.
+
+        :param currencies: the currency of each value
+        :type currencies: [str]
+        :param ordinals: the date of each value, as an ordinal
+        :type ordinals: [int]
+        :return: arrays of the rates, and of the closest dates as ordinals
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        import numpy as np
+        currencies = np.array(currencies, dtype=object)
+        ordinals = np.array(ordinals, dtype=np.int64)
+        conversion_rates = np.ones(len(ordinals), dtype=np.float64)
+        closest_dates = ordinals.copy()
+        for currency in set(currencies.tolist()):
+            if currency == "USD":
+                continue
+            if currency not in self.currencies:
+                raise unknown_currency(currency)
+            start, end = self.currencies[currency]
+            matching = (currencies == currency)
+            dates = self.dates[start:end]
+            wanted = ordinals[matching]
+            position = np.searchsorted(dates, wanted)
+            after = np.minimum(position, len(dates) - 1)
+            before = np.maximum(position - 1, 0)
+            closest = np.where(dates[after] - wanted < wanted - dates[before], after, before) + start
+            conversion_rates[matching] = self.rates[closest]
+            closest_dates[matching] = self.dates[closest]
+        return conversion_rates, closest_dates
+
+    def currency_rates(self, currency):
+        """Returns the dates and rates of a currency as lists, which are
+        quicker to search one date at a time than the arrays. Each currency is
+        only read from the table once it is first used."""
+        if currency not in self._currency_rates:
+            if currency not in self.currencies:
+                raise unknown_currency(currency)
+            start, end = self.currencies[currency]
+            self._currency_rates[currency] = (self.dates[start:end].tolist(), self.rates[start:end].tolist())
+        return self._currency_rates[currency]
+
+    def __reduce__(self):
+        # processes started without fork map the table again, rather than being sent copies of the arrays
+        return (RatesTable, (self.table_dir,))
+
+    def __init__(self, table_dir):
+        import numpy as np
+        self.table_dir = table_dir
+        with open(os.path.join(table_dir, 'index.json'), 'r') as json_file:
+            self.currencies = json.load(json_file)['currencies']
+        self.dates = np.load(os.path.join(table_dir, 'dates.npy'), mmap_mode='r')
+        self.rates = np.load(os.path.join(table_dir, 'rates.npy'), mmap_mode='r')
+        self._currency_rates = {}
+
+
+class MemoizedRates():
+    """Wraps a `RatesTable` or `exchangerates.CurrencyConverter`, memoizing
+    `closest_rate` in an LRU cache keyed by currency and date, and with
+    `is_known` to check a currency before looking it up, rather than catching
+    `UnknownCurrencyException`."""
+
+    def known_currencies(self):
+        return self.converter.known_currencies()
+
+    def is_known(self, currency):
+        return currency in self.known
+
+    def closest_rates(self, currencies, ordinals):
+        """Looks up many rates at once, with `RatesTable.closest_rates`, or one
+        at a time for converters which cannot (such as `CurrencyConverter`)
+
+        :return: arrays of the rates, and of the closest dates as ordinals
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        if hasattr(self.converter, 'closest_rates'):
+            return self.converter.closest_rates(currencies, ordinals)
+        import numpy as np
+        closest = [self.closest_rate(currency, datetime.date.fromordinal(ordinal))
+                   for currency, ordinal in zip(currencies, ordinals)]
+        return (np.array([rate['conversion_rate'] for rate in closest], dtype=np.float64),
+                np.array([rate['closest_date'].toordinal() for rate in closest], dtype=np.int64))
+
+    def __reduce__(self):
+        return (MemoizedRates, (self.converter,))
+
+    def __init__(self, converter, maxsize=CLOSEST_RATE_CACHE_SIZE):
+        self.converter = converter
+        # closest_rate always gives a rate for USD, whether or not it is in the rates file
+        self.known = frozenset(converter.known_currencies().split(",")) | {"USD"}
+        self.closest_rate = functools.lru_cache(maxsize=maxsize)(converter.closest_rate)
+
+
+# the wrapper of each converter passed to the model unwrapped, shared by all of its rows
+_memoized = weakref.WeakKeyDictionary()
+
+
+def memoized(exchange_rates):
+    """Returns exchange rates wrapped in `MemoizedRates`, wrapping a converter
+    which is not wrapped already (such as an `exchangerates.CurrencyConverter`)
+    once however many times it is passed
+
+    :rtype: MemoizedRates
+    """
+    if isinstance(exchange_rates, MemoizedRates):
+        return exchange_rates
+    if exchange_rates not in _memoized:
+        _memoized[exchange_rates] = MemoizedRates(exchange_rates)
+    return _memoized[exchange_rates]
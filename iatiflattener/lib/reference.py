@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import threading
+import urllib.parse
+import concurrent.futures
+
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = "__referencecache__"
+DEFAULT_TTL = 12 * 60 * 60
+PREFETCH_THREADS = 8
+
+
+class ReferenceDataUnavailable(Exception):
+    """Raised when reference data is not cached and cannot be downloaded"""
+
+
+class CachedResponse():
+    """The cached response to a request, with the parts of a `requests.Response`
+    that are used for codelists and exchange rates"""
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __init__(self, status_code, filename):
+        self.status_code = status_code
+        self.filename = filename
+        with open(filename, 'rb') as input_file:
+            self.content = input_file.read()
+
+
+class ReferenceDataCache():
+    """An on-disk cache of the codelists and exchange rate files downloaded by
+    `FlattenIATIData` and `GroupFlatIATIData`.
+
+    Responses are stored under a versioned directory, at a path made from their
+    URL, alongside a `.meta.json` file holding their status and validators.
+    Within `ttl` seconds of being fetched a response is used as it is; after
+    that it is revalidated with `If-None-Match` / `If-Modified-Since`. If the
+    network is unavailable, a stale response is used rather than failing.
+
+    In offline mode the network is never used: a cached response is used
+    however old it is, and a file without metadata is treated as a successful
+    response, so a directory of fixture files can stand in for the network.
+    """
+
+    def filename(self, url):
+        parts = urllib.parse.urlsplit(url)
+        return os.path.join(self.cache_dir, "v{}".format(CACHE_VERSION),
+                            parts.netloc, *parts.path.strip('/').split('/'))
+
+    def read_metadata(self, filename):
+        try:
+            with open(filename + '.meta.json', 'r') as json_file:
+                return json.load(json_file)
+        except FileNotFoundError:
+            return None
+
+    def write_response(self, filename, response):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # written to temporary files first, so that an interrupted download is not used
+        with open(filename + '.tmp', 'wb') as output_file:
+            output_file.write(response.content)
+        os.replace(filename + '.tmp', filename)
+        metadata = {
+            'url': response.url,
+            'status_code': response.status_code,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched': time.time()
+        }
+        self.write_metadata(filename, metadata)
+        return metadata
+
+    def write_metadata(self, filename, metadata):
+        with open(filename + '.meta.json.tmp', 'w') as json_file:
+            json.dump(metadata, json_file, indent=2)
+        os.replace(filename + '.meta.json.tmp', filename + '.meta.json')
+
+    def get_session(self):
+        """Returns the session, starting it the first time the network is used"""
+        with self.session_lock:
+            if self.session is None:
+                import requests
+                self.session = requests.Session()
+        return self.session
+
+    def prefetch(self, urls):
+        """Starts getting each of the URLs concurrently, over the same session,
+        so that later calls to `get` only wait for the responses which have
+        not yet arrived.
+
+        :param urls: the URLs of codelists or exchange rate files
+        :type urls: [str]
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_THREADS)
+        for url in urls:
+            if url not in self.prefetched:
+                self.prefetched[url] = executor.submit(self.fetch, url)
+        executor.shutdown(wait=False)
+
+    def get(self, url):
+        """Returns the response for a URL, from the cache where possible
+
+        :param url: the URL of a codelist or exchange rate file
+        :type url: str
+        :rtype: CachedResponse
+        """
+        if url in self.prefetched:
+            return self.prefetched.pop(url).result()
+        return self.fetch(url)
+
+    def fetch(self, url):
+        filename = self.filename(url)
+        metadata = self.read_metadata(filename)
+        cached = os.path.exists(filename)
+        if cached and metadata is None:
+            metadata = {'status_code': 200, 'fetched': 0}
+        if self.offline:
+            if not cached:
+                raise ReferenceDataUnavailable("{} is not cached, and the cache is offline".format(url))
+            return CachedResponse(metadata['status_code'], filename)
+        if cached and (time.time() - metadata['fetched'] < self.ttl):
+            return CachedResponse(metadata['status_code'], filename)
+
+        headers = {}
+        if cached and metadata.get('etag'):
+            headers['If-None-Match'] = metadata['etag']
+        if cached and metadata.get('last_modified'):
+            headers['If-Modified-Since'] = metadata['last_modified']
+        # requests is slow to import, so it is only imported once the network is used
+        import requests
+        try:
+            response = self.get_session().get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            if cached:
+                print("Using cached {}, as it could not be revalidated: {}".format(url, repr(e)))
+                return CachedResponse(metadata['status_code'], filename)
+            raise ReferenceDataUnavailable("{} could not be downloaded: {}".format(url, repr(e)))
+        if cached and response.status_code == 304:
+            metadata['fetched'] = time.time()
+            self.write_metadata(filename, metadata)
+        elif response.status_code in (200, 404):
+            metadata = self.write_response(filename, response)
+        elif cached:
+            print("Using cached {}, as revalidating it returned {}".format(url, response.status_code))
+        else:
+            raise ReferenceDataUnavailable("{} returned {}".format(url, response.status_code))
+        return CachedResponse(metadata['status_code'], filename)
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL, offline=False, timeout=60):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+        self.timeout = timeout
+        self.session = None
+        self.session_lock = threading.Lock()
+        self.prefetched = {}
@@ -0,0 +1,40 @@
+import json
+
+
+class RunReport():
+    """Records the packages which were skipped or failed during a run and, for
+    incremental runs, the number of packages unchanged since the previous run"""
+
+    def add(self, result):
+        """Adds the result of processing a package
+
+        :param result: the dictionary returned by `FlattenIATIData.run_package`
+        :type result: dict
+        """
+        if result['status'] == 'skipped':
+            self.skipped.append({
+                'publisher': result['publisher'],
+                'package': result['package'],
+                'version': result['version']
+            })
+        elif result['status'] == 'failed':
+            self.failed.append({
+                'publisher': result['publisher'],
+                'package': result['package'],
+                'error': result['error']
+            })
+        elif result['status'] == 'unchanged':
+            self.unchanged += 1
+
+    def save(self, filename):
+        with open(filename, 'w') as json_file:
+            json.dump({
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'unchanged': self.unchanged
+            }, json_file, indent=2)
+
+    def __init__(self):
+        self.skipped = []
+        self.failed = []
+        self.unchanged = 0
@@ -0,0 +1,102 @@
+import os
+import json
+
+
+class PackageCosts():
+    """Estimates how long each package will take to flatten, using the
+    per-package timings recorded by earlier runs where they exist and the
+    package size otherwise."""
+
+    def key(self, publisher, package):
+        return "{}/{}".format(publisher, package)
+
+    def seconds_per_byte(self):
+        """The average time taken per byte across the packages with timings"""
+        total_size = sum(timing['size'] for timing in self.timings.values())
+        total_seconds = sum(timing['seconds'] for timing in self.timings.values())
+        if total_size == 0 or total_seconds == 0:
+            return 1.0
+        return total_seconds / total_size
+
+    def estimate(self, publisher, package, size):
+        """Returns the estimated cost of flattening a package
+
+        :param size: the current size of the package, in bytes
+        :type size: int
+        :return: the estimated time taken, in seconds (or in bytes, if there are no timings yet)
+        :rtype: float
+        """
+        timing = self.timings.get(self.key(publisher, package))
+        if timing is not None and timing['size'] > 0:
+            # packages which have changed size since their timing was recorded are scaled
+            return timing['seconds'] * (size / timing['size'])
+        return size * self._seconds_per_byte
+
+    def schedule(self, packages):
+        """Orders packages to be processed largest first, which keeps the time
+        that workers wait for a few heavy packages at the end of a run short.
+
+        :param packages: a list of (publisher, package, size) tuples
+        :type packages: [(str, str, int)]
+        :rtype: [(str, str, int)]
+        """
+        return sorted(packages, key=lambda item: (-self.estimate(*item), item[0], item[1]))
+
+    def record(self, publisher, package, size, seconds):
+        self.timings[self.key(publisher, package)] = {
+            'size': size,
+            'seconds': seconds
+        }
+
+    def save(self):
+        if self.filename is None:
+            return
+        with open(self.filename, 'w') as json_file:
+            json.dump(self.timings, json_file, indent=2, sort_keys=True)
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.timings = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename, 'r') as json_file:
+                self.timings = json.load(json_file)
+        self._seconds_per_byte = self.seconds_per_byte()
+
+
+def parse_node(shard):
+    """Parses a node specification of the form `i/N`, for the i-th of N nodes (counting from 1)
+
+    :rtype: (int, int)
+    """
+    try:
+        index, count = [int(part) for part in shard.split('/')]
+    except ValueError:
+        raise ValueError("Shard must be of the form i/N, not {}".format(shard))
+    if not (1 <= index <= count):
+        raise ValueError("Shard {} is not between 1/{} and {}/{}".format(shard, count, count, count))
+    return index, count
+
+
+def node_publishers(publisher_sizes, index, count):
+    """Returns the publishers to be processed by one of `count` nodes.
+
+    Publishers are assigned largest first to the node with the least data so
+    far, with ties broken by publisher name and node order, so that every node
+    computes the same assignment from the same iatikit cache.
+
+    :param publisher_sizes: the total size of each publisher's packages, in bytes
+    :type publisher_sizes: dict
+    :param index: the node, counting from 1
+    :type index: int
+    :param count: the number of nodes
+    :type count: int
+    :return: the sorted publishers for the node
+    :rtype: [str]
+    """
+    node_sizes = [0] * count
+    nodes = [[] for node in range(count)]
+    for publisher, size in sorted(publisher_sizes.items(), key=lambda item: (-item[1], item[0])):
+        node = node_sizes.index(min(node_sizes))
+        nodes[node].append(publisher)
+        node_sizes[node] += size
+    return sorted(nodes[index - 1])
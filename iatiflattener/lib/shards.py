@@ -0,0 +1,141 @@
+import os
+import shutil
+
+
+# Packages are written to `<shard>.tmp`, which is renamed to `<shard>` once the
+# package has been processed successfully, so a shard is never partly written.
+TEMPORARY_SUFFIX = '.tmp'
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def temporary_dir(shard_dir):
+    return shard_dir + TEMPORARY_SUFFIX
+
+
+def start_shard(shard_dir, chunked=False):
+    """Creates an empty temporary directory to write a shard to
+
+    :param chunked: whether the package is split into chunks, each written to its own subdirectory
+    :type chunked: bool
+    :return: the temporary directory
+    :rtype: str
+    """
+    shard_tmp_dir = temporary_dir(shard_dir)
+    shutil.rmtree(shard_tmp_dir, ignore_errors=True)
+    if chunked:
+        os.makedirs(shard_tmp_dir)
+    else:
+        os.makedirs(os.path.join(shard_tmp_dir, 'csv', 'activities'))
+    return shard_tmp_dir
+
+
+def commit_shard(shard_dir):
+    """Replaces any existing shard with the temporary directory written to"""
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.rename(temporary_dir(shard_dir), shard_dir)
+
+
+def discard_shard(shard_dir):
+    shutil.rmtree(temporary_dir(shard_dir), ignore_errors=True)
+
+
+def remove_shard(shard_dir):
+    """Removes a committed shard, and its publisher directory once that is empty"""
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    publisher_dir = os.path.dirname(shard_dir)
+    if os.path.isdir(publisher_dir) and not os.listdir(publisher_dir):
+        os.rmdir(publisher_dir)
+
+
+def list_shards(shards_dir):
+    """Returns the committed shards in a directory, in sorted publisher and package order
+
+    :return: a list of (publisher, package, shard directory) tuples
+    :rtype: [(str, str, str)]
+    """
+    if not os.path.isdir(shards_dir):
+        return []
+    out = []
+    for publisher in sorted(os.listdir(shards_dir)):
+        publisher_dir = os.path.join(shards_dir, publisher)
+        for package in sorted(os.listdir(publisher_dir)):
+            if package.endswith(TEMPORARY_SUFFIX):
+                continue
+            out.append((publisher, package, os.path.join(publisher_dir, package)))
+    return out
+
+
+def shard_csv_dirs(shard_dir):
+    """Returns the `csv` directories of a shard: one, or one per chunk for packages split into chunks"""
+    if os.path.isdir(os.path.join(shard_dir, 'csv')):
+        return [os.path.join(shard_dir, 'csv')]
+    return [os.path.join(shard_dir, chunk, 'csv') for chunk in sorted(os.listdir(shard_dir))]
+
+
+def copy_data(source_fd, destination_fd, size):
+    """Copies `size` bytes between file descriptors from their current
+    positions, using `os.copy_file_range` where it is available so that the
+    data is not copied through Python."""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while size > 0:
+                copied = os.copy_file_range(source_fd, destination_fd, size)
+                if copied == 0:
+                    break
+                size -= copied
+        except OSError:
+            # e.g. not supported by the file system; carry on from the current positions
+            pass
+    while size > 0:
+        data = os.read(source_fd, min(size, COPY_BLOCK_SIZE))
+        if not data:
+            break
+        size -= len(data)
+        while data:
+            data = data[os.write(destination_fd, data):]
+
+
+def append_files(source_filenames, destination_filename):
+    """Appends each of the source files, in order, to the destination file"""
+    # copy_file_range does not accept files opened for appending, so seek to the end instead
+    destination_fd = os.open(destination_filename, os.O_WRONLY | os.O_CREAT, 0o666)
+    try:
+        os.lseek(destination_fd, 0, os.SEEK_END)
+        for source_filename in source_filenames:
+            with open(source_filename, 'rb') as source:
+                copy_data(source.fileno(), destination_fd, os.fstat(source.fileno()).st_size)
+    finally:
+        os.close(destination_fd)
+
+
+def shard_files(shard_dirs):
+    """Returns the CSV files of the shards, in order, for each output file
+
+    :param shard_dirs: shard directories
+    :type shard_dirs: [str]
+    :return: the paths of the shards' files, keyed by the path of the output file relative to `csv`
+    :rtype: dict
+    """
+    sources = {}
+    for shard_dir in shard_dirs:
+        for csv_dir in shard_csv_dirs(shard_dir):
+            for subdir in ('', 'activities'):
+                if not os.path.isdir(os.path.join(csv_dir, subdir)):
+                    continue
+                for filename in sorted(os.listdir(os.path.join(csv_dir, subdir))):
+                    if filename.endswith('.csv'):
+                        sources.setdefault(os.path.join(subdir, filename), []).append(
+                            os.path.join(csv_dir, subdir, filename))
+    return sources
+
+
+def merge_shards(shard_dirs, output_dir):
+    """Appends the CSV files of each shard, in order, to the matching files in `output_dir`
+
+    :param shard_dirs: shard directories, whose CSV files have no headers
+    :type shard_dirs: [str]
+    :param output_dir: the final output directory
+    :type output_dir: str
+    """
+    for filename, source_filenames in sorted(shard_files(shard_dirs).items()):
+        append_files(source_filenames, os.path.join(output_dir, 'csv', filename))
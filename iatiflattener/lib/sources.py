@@ -0,0 +1,214 @@
+import bz2
+import gzip
+import lzma
+import os
+import tarfile
+import zipfile
+
+
+# Packages are XML files, which may be gzip-compressed
+PACKAGE_EXTENSION = '.xml'
+COMPRESSED_EXTENSION = '.gz'
+
+
+def package_name(filename):
+    """Returns the name of the package in a file, which for a compressed
+    package is its filename without `.gz`, or None if the file is not a package
+
+    :rtype: str
+    """
+    if filename.endswith(PACKAGE_EXTENSION + COMPRESSED_EXTENSION):
+        return filename[:-len(COMPRESSED_EXTENSION)]
+    if filename.endswith(PACKAGE_EXTENSION):
+        return filename
+    return None
+
+
+def open_packages(location):
+    """Returns the packages of an iatikit cache, read from its directory or
+    from a tar or zip archive of it
+
+    :param location: the iatikit cache directory (holding `data`), or the path to an archive
+    :type location: str
+    :rtype: PackageDirectory or PackageArchive
+    """
+    if os.path.isfile(location):
+        return PackageArchive(location)
+    return PackageDirectory(location)
+
+
+class PackageDirectory():
+    """The packages of an iatikit cache directory, in `data/<publisher>/`.
+    Packages compressed as `<package>.gz` are named as if they were not."""
+
+    # packages can be read in any order
+    sequential = False
+
+    def publisher_dir(self, publisher):
+        return os.path.join(self.cache_dir, "data", publisher)
+
+    def publishers(self):
+        return os.listdir(os.path.join(self.cache_dir, "data"))
+
+    def list_packages(self, publisher):
+        """Returns the sorted packages of a publisher, with their sizes on disk
+
+        :return: a list of (package, size) tuples, or None if the publisher is not a directory
+        :rtype: [(str, int)]
+        """
+        try:
+            filenames = os.listdir(self.publisher_dir(publisher))
+        except NotADirectoryError:
+            return None
+        packages = {}
+        for filename in filenames:
+            package = package_name(filename)
+            # an uncompressed package is read in preference to a compressed copy
+            if (package is not None) and ((package not in packages) or (filename == package)):
+                packages[package] = filename
+        return [(package, os.path.getsize(os.path.join(self.publisher_dir(publisher), packages[package])))
+                for package in sorted(packages)]
+
+    def path(self, publisher, package):
+        """Returns the path of the file holding a package, which may be compressed"""
+        filename = os.path.join(self.publisher_dir(publisher), package)
+        if os.path.exists(filename) or not os.path.exists(filename + COMPRESSED_EXTENSION):
+            return filename
+        return filename + COMPRESSED_EXTENSION
+
+    def filename(self, publisher, package):
+        """Returns the path of an uncompressed package, or None if the package is compressed"""
+        filename = self.path(publisher, package)
+        if filename.endswith(COMPRESSED_EXTENSION):
+            return None
+        return filename
+
+    def open(self, publisher, package):
+        """Opens a package for reading, decompressing it as it is read
+
+        :rtype: file-like object
+        """
+        filename = self.path(publisher, package)
+        if filename.endswith(COMPRESSED_EXTENSION):
+            return gzip.open(filename, 'rb')
+        return open(filename, 'rb')
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+
+class PackageArchive():
+    """The packages of an iatikit cache in a tar (optionally compressed) or
+    zip archive, such as one of `__iatikitcache__/registry/data`, which are
+    streamed from the archive rather than unpacked to disk.
+
+    Packages are found by the last two components of their paths in the
+    archive, `<publisher>/<package>`, so `data` may be at any depth, and are
+    named as for `PackageDirectory`. Members of a zip archive can be read in
+    any order; those of a compressed tar archive are decompressed from the
+    start of the archive whenever an earlier member is read, so such archives
+    are best created with their members sorted (`tar --sort=name`), and
+    indexing one reads through the whole archive once. Runs with `workers`
+    read the packages of such an archive in archive order (see `sequential`),
+    so that each worker only reads forward through it.
+
+    Each process opens the archive for itself, so that workers do not share a
+    file position with the parent."""
+
+    def index(self):
+        """Reads the members of the archive which hold packages
+
+        :return: for each publisher, the member holding each package, and whether it is compressed
+        :rtype: dict
+        """
+        members = {}
+        if self.is_zip:
+            entries = [(info.filename, info, info.file_size) for info in self.archive().infolist()
+                       if not info.is_dir()]
+        else:
+            entries = [(info.name, info, info.size) for info in self.archive().getmembers() if info.isfile()]
+        for name, member, size in entries:
+            parts = name.split('/')
+            if len(parts) < 2:
+                continue
+            publisher, filename = parts[-2], parts[-1]
+            package = package_name(filename)
+            if package is None:
+                continue
+            packages = members.setdefault(publisher, {})
+            if (package not in packages) or (filename == package):
+                packages[package] = (member, size, filename != package)
+        return members
+
+    def archive(self):
+        if self.pid != os.getpid():
+            if self.is_zip:
+                self._archive = zipfile.ZipFile(self.archive_filename)
+            else:
+                self._archive = tarfile.open(self.archive_filename)
+            self.pid = os.getpid()
+        return self._archive
+
+    def publishers(self):
+        return list(self.members)
+
+    def in_archive_order(self, packages):
+        """Orders packages as their members are in the archive
+
+        :param packages: a list of (publisher, package, size) tuples
+        :type packages: [(str, str, int)]
+        :rtype: [(str, str, int)]
+        """
+        if self.is_zip:
+            return sorted(packages, key=lambda item: self.members[item[0]][item[1]][0].header_offset)
+        return sorted(packages, key=lambda item: self.members[item[0]][item[1]][0].offset)
+
+    def list_packages(self, publisher):
+        """Returns the sorted packages of a publisher, with their sizes in the archive
+
+        :return: a list of (package, size) tuples
+        :rtype: [(str, int)]
+        """
+        packages = self.members.get(publisher, {})
+        return [(package, packages[package][1]) for package in sorted(packages)]
+
+    def path(self, publisher, package):
+        """Packages in an archive have no path of their own"""
+        return None
+
+    def filename(self, publisher, package):
+        return None
+
+    def open(self, publisher, package):
+        """Opens a package for reading, as a stream from the archive
+
+        :rtype: file-like object
+        """
+        member, size, compressed = self.members[publisher][package]
+        if self.is_zip:
+            stream = self.archive().open(member)
+        else:
+            stream = self.archive().extractfile(member)
+        if compressed:
+            return gzip.GzipFile(fileobj=stream, mode='rb')
+        return stream
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_archive'] = None
+        state['pid'] = None
+        return state
+
+    def __init__(self, archive_filename):
+        """
+        :param archive_filename: the path to a tar or zip archive
+        :type archive_filename: str
+        """
+        self.archive_filename = archive_filename
+        self.is_zip = zipfile.is_zipfile(archive_filename)
+        self._archive = None
+        self.pid = None
+        self.members = self.index()
+        # the members of a compressed tar archive can only be read efficiently in archive order
+        self.sequential = (not self.is_zip) and isinstance(self.archive().fileobj,
+            (gzip.GzipFile, bz2.BZ2File, lzma.LZMAFile))
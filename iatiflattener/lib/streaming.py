@@ -0,0 +1,77 @@
+from lxml import etree
+
+from iatiflattener.lib import chunking
+
+
+def peek_version(source):
+    """Returns the `version` attribute of a package's root element, reading
+    only as far as its opening tag rather than parsing the whole package.
+
+    :param source: a filename or file-like object; file-like objects are returned to the start
+    :return: the version, or None if the root element has no version
+    :rtype: str
+    """
+    try:
+        for event, root in etree.iterparse(source, events=('start',)):
+            return root.get('version')
+    finally:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+
+
+def has_unique_identifiers(source):
+    """Checks that no two activities of a package share an identifier, reading
+    only the identifiers: from the raw bytes of a package file, or otherwise
+    with `iterparse`, clearing each activity as it is read.
+
+    :param source: a filename or file-like object; file-like objects are returned to the start
+    :rtype: bool
+    """
+    if isinstance(source, str):
+        return chunking.package_has_unique_identifiers(source)
+    identifiers = set()
+    try:
+        for event, activity in etree.iterparse(source, events=('end',), tag='iati-activity'):
+            identifier = activity.findtext('iati-identifier')
+            if identifier in identifiers:
+                return False
+            identifiers.add(identifier)
+            clear_activity(activity)
+        return True
+    finally:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+
+
+def clear_activity(activity):
+    """Frees a processed activity, and removes it and any earlier siblings from the tree"""
+    activity.clear(keep_tail=False)
+    parent = activity.getparent()
+    if parent is None:
+        return
+    while activity.getprevious() is not None:
+        del parent[0]
+    parent.remove(activity)
+
+
+def iterparse_activities(source):
+    """Yields each `iati-activity` element of a package, without building the
+    whole document in memory.
+
+    Each activity is yielded once the following activity (or the end of the
+    document) has been parsed, so that it is complete including its tail, and
+    is cleared once the caller has finished with it. Peak memory therefore
+    grows with the largest activity rather than with the whole package.
+
+    :param source: a filename or file-like object
+    :rtype: generator of lxml.etree._Element
+    """
+    previous = None
+    for event, activity in etree.iterparse(source, events=('end',), tag='iati-activity'):
+        if previous is not None:
+            yield previous
+            clear_activity(previous)
+        previous = activity
+    if previous is not None:
+        yield previous
+        clear_activity(previous)
@@ -1,9 +1,10 @@
 from collections import OrderedDict
-import numpy as np
 
 DPORTAL_URL = "https://d-portal.org/q.html?aid={}"
 
 
+# numeric columns give the name of their NumPy dtype, which `dtypes` turns into
+# the dtype itself, so that NumPy is only imported when it is needed
 HEADERS = OrderedDict({
    'iati_identifier': str,
    'title': str,
@@ -20,18 +21,18 @@ HEADERS = OrderedDict({
    'transaction_type': str,
    'value_original': str,
    'currency_original': str,
-   'value_usd': np.float64,
+   'value_usd': 'float64',
    'exchange_rate_date': str,
    'exchange_rate': str,
-   'value_eur': np.float64,
-   'value_local': np.float64,
+   'value_eur': 'float64',
+   'value_local': 'float64',
    'transaction_date': str,
    'country_code': str,
-   'multi_country': np.int32,
+   'multi_country': 'int32',
    'sector_category': str,
    'sector_code': str,
-   'humanitarian': np.int32,
-   'fiscal_year': np.int32,
+   'humanitarian': 'int32',
+   'fiscal_year': 'int32',
    'fiscal_quarter': str,
    'fiscal_year_quarter': str,
    'url': str
@@ -88,13 +89,20 @@ def activity_headers(langs):
    return out
 
 
+def numpy_dtype(dtype):
+   if dtype is str:
+      return str
+   import numpy as np
+   return np.dtype(dtype)
+
+
 def dtypes(langs):
    out = []
    for header, dtype in HEADERS.items():
       if header in MULTILANG_HEADERS:
-         out += [dtype for lang in langs]
+         out += [numpy_dtype(dtype) for lang in langs]
       else:
-         out += [dtype]
+         out += [numpy_dtype(dtype)]
    return out
 
 
@@ -102,9 +110,9 @@ def headers_dtypes(langs):
    out = []
    for header, dtype in HEADERS.items():
       if dtype in MULTILANG_HEADERS:
-         out += [{header: dtype} for lang in langs]
+         out += [{header: numpy_dtype(dtype)} for lang in langs]
       else:
-         out += [{header: dtype}]
+         out += [{header: numpy_dtype(dtype)}]
    return out
 
 def headers_with_langs(langs):
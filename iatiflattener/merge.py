@@ -0,0 +1,47 @@
+import os
+import shutil
+import argparse
+
+from iatiflattener.lib import journal
+from iatiflattener.lib import shards
+
+
+def merge_nodes(node_dirs, output_dir):
+    """Combines the output of the nodes of a multi-node run (`FlattenIATIData(shard='i/N')`)
+    into the CSV files a single-node run would have written.
+
+    Each node's CSV files hold only their headers, and its rows are kept in its
+    shards. The headers are copied, and the shards of every node are then
+    appended in sorted publisher and package order. Any existing `csv`
+    directory in `output_dir` is replaced.
+
+    :param node_dirs: the output directories of the nodes
+    :type node_dirs: [str]
+    :param output_dir: the directory to write the merged CSV files to
+    :type output_dir: str
+    """
+    node_shards = {}
+    for node_dir in node_dirs:
+        if os.path.abspath(node_dir) == os.path.abspath(output_dir):
+            raise ValueError("The output directory must not be one of the node directories")
+        for publisher, package, shard_dir in shards.list_shards(os.path.join(node_dir, 'shards')):
+            if (publisher, package) in node_shards:
+                raise ValueError("Package {}/{} was processed by more than one node".format(publisher, package))
+            node_shards[(publisher, package)] = shard_dir
+
+    shutil.rmtree(os.path.join(output_dir, 'csv'), ignore_errors=True)
+    os.makedirs(os.path.join(output_dir, 'csv', 'activities'))
+    for node_dir in node_dirs:
+        for filename in journal.output_sizes(node_dir):
+            if not os.path.exists(os.path.join(output_dir, filename)):
+                shutil.copyfile(os.path.join(node_dir, filename), os.path.join(output_dir, filename))
+    shards.merge_shards([node_shards[key] for key in sorted(node_shards)], output_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Merge the output of the nodes of a multi-node flattener run")
+    parser.add_argument('output_dir', help="directory to write the merged CSV files to")
+    parser.add_argument('node_dirs', nargs='+', help="output directories of the nodes")
+    args = parser.parse_args()
+    merge_nodes(args.node_dirs, args.output_dir)
@@ -4,12 +4,15 @@ from lxml import etree
 from datequarter import DateQuarter
 
 from iatiflattener.lib.utils import get_date, get_fy_fq, get_fy_fq_numeric, get_first
-from iatiflattener.lib.iati_helpers import clean_countries, clean_sectors, get_narrative, get_org_name, get_sector_category, TRANSACTION_TYPES_RULES, get_narrative_text, filter_none
-from iatiflattener.lib.iati_transaction_helpers import get_classification_from_transactions, get_sectors_from_transactions, get_countries_from_transactions
-from exchangerates import UnknownCurrencyException
+from iatiflattener.lib.iati_helpers import clean_countries, clean_sectors, get_org_name, get_sector_category, TRANSACTION_TYPES_RULES, get_narrative_text, filter_none, get_attributes, ChildIndex, NarrativeCache
+from iatiflattener.lib.rates import memoized
+from iatiflattener.lib.iati_transaction_helpers import TransactionIndex, get_classification_from_transactions, get_sectors_from_transactions, get_countries_from_transactions
 
 DPORTAL_URL = "https://d-portal.org/q.html?aid={}"
 
+# XPath expressions which are not lookups of an element's own children are compiled once
+LOCATIONS_G1 = etree.XPath('location[location-id/@vocabulary="G1"]')
+
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -69,49 +72,170 @@ class ActivityCache:
         self.data = {}
 
 
+class ActivityContext():
+    """The activity-level values of an `iati-activity`, resolved once for all
+    languages and shared by its activity row and by each of its transactions
+    and budgets, which only resolve their own values on top of these.
+
+    Values which are cached by identifier are still read through the
+    activity's `ActivityCacheActivity`, so activities sharing an identifier
+    share them as before. The fallbacks used when a transaction does not
+    give its own countries, sectors or classifications are resolved when
+    first needed. The activity's children are looked up through `children`,
+    a `ChildIndex`. The narratives of its elements are resolved once for
+    all languages, through `narratives`."""
+
+    def country_region_activity(self):
+        """Returns the countries and regions of the activity, cleaned, or [] if it has none"""
+        if self._country_region_activity is None:
+            if (self.activity_cache.countries is not None) or (self.activity_cache.regions is not None):
+                self._country_region_activity = clean_countries(self.activity_cache.countries,
+                    self.activity_cache.regions)
+            else:
+                countries = self.children.all('recipient-country')
+                regions = self.children.default('recipient-region')
+                if (countries or regions):
+                    self.activity_cache.countries = get_attributes(countries)
+                    self.activity_cache.regions = get_attributes(regions)
+                self._country_region_activity = clean_countries(countries, regions) if (countries or regions) else []
+        return self._country_region_activity
+
+    def sector_activity(self):
+        """Returns the sectors of the activity, cleaned, or False if it has none"""
+        if self._sector_activity is None:
+            if (self.activity_cache.sectors is not None):
+                sectors = clean_sectors(self.activity_cache.sectors)
+            else:
+                sectors = self.children.default('sector')
+                if sectors:
+                    self.activity_cache.sectors = get_attributes(sectors)
+                    sectors = clean_sectors(sectors)
+            if not sectors:
+                # not kept, as a transaction without sectors gives the activity a default sector
+                return False
+            self._sector_activity = sectors
+        return self._sector_activity
+
+    def default_field(self, field_name):
+        """Returns the activity's `default-<field_name>` element, or None"""
+        if field_name not in self.default_fields:
+            field_activity = self.children.first('default-{}'.format(field_name))
+            if field_activity is not None:
+                setattr(self.activity_cache, field_name.replace("-", "_"), field_activity.get('code'))
+            self.default_fields[field_name] = field_activity
+        return self.default_fields[field_name]
+
+    def transaction_index(self, exchange_rates):
+        """Returns the index of the activity's transactions, from which budgets
+        are split when the activity does not give their countries, sectors or
+        classifications, reading the transactions on first use
+
+        :rtype: lib.iati_transaction_helpers.TransactionIndex
+        """
+        if self._transaction_index is None:
+            self._transaction_index = TransactionIndex(self.activity, self.default_currency, exchange_rates)
+        return self._transaction_index
+
+    def __init__(self, activity, activity_cache, organisations_cache={}, langs=['en'],
+                 reporting_organisation_groups={}):
+        """
+        :param activity: an `iati-activity` element
+        :type activity: lxml.etree._Element
+        :param activity_cache: the cache of the package's activities
+        :type activity_cache: ActivityCache
+        """
+        self.activity = activity
+        self.children = ChildIndex(activity)
+        self.narratives = NarrativeCache(langs)
+        self.iati_identifier = IATIIdentifier(self.children)
+        self.activity_cache = activity_cache.get(self.iati_identifier.value)
+        self.title = Title(self.children, self.activity_cache, langs, self.narratives)
+        self.reporting_org = ReportingOrg(self.children, self.activity_cache, organisations_cache, langs,
+                                          self.narratives)
+        reporting_org = list(self.reporting_org.value.values())[0]
+        self.reporting_org_ref = SimpleField(reporting_org.get('ref'))
+        self.reporting_org_type = SimpleField(reporting_org.get('type'))
+        self.reporting_org_group = ReportingOrgGroup(self.reporting_org, reporting_organisation_groups)
+        self.url = SimpleField(DPORTAL_URL.format(self.iati_identifier))
+        self.default_currency = activity.get('default-currency')
+        self.humanitarian = activity.get('humanitarian')
+        self._country_region_activity = None
+        self._sector_activity = None
+        self.default_fields = {}
+        self._transaction_index = None
+
+
+def open_csv_file(filename, headers, write_header=True):
+    """Opens a CSV file to append rows to. A file which does not exist yet is
+    created, starting with the headers if `write_header` is True.
+
+    :return: the file, and a csv writer for it
+    :rtype: (file, csv.writer)
+    """
+    _file = open(filename, 'a')
+    _csv = csv.writer(_file)
+    if write_header and _file.tell() == 0:
+        _csv.writerow(headers)
+    return _file, _csv
+
+
 class CSVFilesWriter():
 
     def append(self, country, flat_transaction_budget):
         if country not in self.csv_files:
-            _file = open(
-                os.path.join(self.output_dir,
+            self.csv_files[country] = {
+                'filename': os.path.join(self.output_dir,
                     'csv',
                     '{}-{}.csv'.format(self.budget_transaction, country)),
-                'a')
-            self.csv_files[country] = {
-                'file': _file,
-                'csv': csv.writer(_file),
+                'file': None,
+                'csv': None,
                 'rows': []
             }
         if self.csv_headers:
-            self.csv_files[country]['rows'].append([flat_transaction_budget[header] for header in self.csv_headers])
+            row = [flat_transaction_budget[header] for header in self.csv_headers]
+            if self.conversions is not None:
+                self.conversions.add(row, flat_transaction_budget)
+            self.csv_files[country]['rows'].append(row)
         else:
             self.csv_files[country]['rows'].append(flat_transaction_budget.values())
 
-    def write(self):
+    def flush(self):
+        """Writes out the rows appended so far, keeping the files open"""
         for _filename, _file in self.csv_files.items():
+            if _file['file'] is None:
+                _file['file'], _file['csv'] = open_csv_file(_file['filename'], self.csv_headers, self.write_header)
             _file['csv'].writerows(_file['rows'])
+            _file['rows'] = []
+
+    def write(self):
+        self.flush()
+        for _filename, _file in self.csv_files.items():
             _file['file'].close()
 
-    def __init__(self, budget_transaction='transaction', output_dir='output', headers=[]):
+    def __init__(self, budget_transaction='transaction', output_dir='output', headers=[], conversions=None,
+                 write_header=True):
         self.csv_files = {}
         self.budget_transaction = budget_transaction
         self.csv_headers = headers
         self.output_dir = output_dir
+        # files are only created once rows are written to them, starting with the headers
+        # unless they are shards, whose headers are written as they are merged
+        self.write_header = write_header
+        # with deferred conversion, rows are added to a `lib.conversion.DeferredConversions`
+        # batch, which must be converted before the rows are written
+        self.conversions = conversions
 
 
 class ActivityCSVFilesWriter():
     def append(self, reporting_org, activity):
         if reporting_org not in self.csv_files:
-            _file = open(
-                os.path.join(self.output_dir,
+            self.csv_files[reporting_org] = {
+                'filename': os.path.join(self.output_dir,
                     'csv',
                     'activities',
                     '{}.csv'.format(reporting_org.replace("/", "_"))),
-                'a')
-            self.csv_files[reporting_org] = {
-                'file': _file,
-                'csv': csv.writer(_file),
+                'file': None,
+                'csv': None,
                 'rows': []
             }
         if self.csv_headers:
@@ -119,15 +243,24 @@ class ActivityCSVFilesWriter():
         else:
             self.csv_files[reporting_org]['rows'].append(activity.values())
 
-    def write(self):
+    def flush(self):
+        """Writes out the rows appended so far, keeping the files open"""
         for _filename, _file in self.csv_files.items():
+            if _file['file'] is None:
+                _file['file'], _file['csv'] = open_csv_file(_file['filename'], self.csv_headers, self.write_header)
             _file['csv'].writerows(_file['rows'])
+            _file['rows'] = []
+
+    def write(self):
+        self.flush()
+        for _filename, _file in self.csv_files.items():
             _file['file'].close()
 
-    def __init__(self, output_dir='output', headers=[]):
+    def __init__(self, output_dir='output', headers=[], write_header=True):
         self.csv_files = {}
         self.output_dir = output_dir
         self.csv_headers = headers
+        self.write_header = write_header
 
 
 class FlatBudget:
@@ -146,6 +279,9 @@ class FlatBudget:
         self.flat_budget['value_original'] = (
             budget['value_original'] * pct_adjustment
         )
+        if self.budget.deferred_conversion:
+            self.flat_budget['conversion'] = budget['conversion'] + (pct_adjustment,)
+            return dict([(k, v) for k, v in self.flat_budget.items() if k not in ['countries', 'sectors']])
         self.flat_budget['value_usd'] = (
             budget['value_usd'] * pct_adjustment
         )
@@ -197,7 +333,8 @@ class FlatTransactionBudgetCSV:
 
     def get_local_currency(self, country, flat_transaction_budget):
         """Reduces the 'value_local' list to a single value for just the current country"""
-        flat_transaction_budget['value_local'] = flat_transaction_budget['value_local'].get(country)
+        if flat_transaction_budget['value_local'] is not None:
+            flat_transaction_budget['value_local'] = flat_transaction_budget['value_local'].get(country)
         return flat_transaction_budget
 
     def output(self):
@@ -246,6 +383,9 @@ class FlatTransaction:
         sector_pct_adjustment = (country['percentage']/100) * (sector['percentage']/100)
 
         self.flat_transaction['value_original'] = (self.transaction.value_original.value * sector_pct_adjustment)
+        if self.transaction.deferred_conversion:
+            self.flat_transaction['conversion'] = (self.transaction.value_original.value, 1, 1, sector_pct_adjustment)
+            return dict([(k, v) for k, v in self.flat_transaction.items() if k not in ['countries', 'sectors']])
         self.flat_transaction['value_usd'] = (self.transaction.value_usd.value * sector_pct_adjustment)
         self.flat_transaction['value_eur'] = (self.transaction.value_eur.value * sector_pct_adjustment)
 
@@ -300,15 +440,20 @@ class FinancialValues():
         out = {}
         for country in self.countries.value:
             currency_code = self.currencies.get(country.get('code'))
-            try:
-                closest_exchange_rate = self.exchange_rates.closest_rate(currency_code, self.value_date.value)
-                exchange_rate = closest_exchange_rate.get('conversion_rate')
-                value = self.value_usd.value * exchange_rate
-                out[country.get('code')] = value
-            except UnknownCurrencyException:
+            if not self.exchange_rates.is_known(currency_code):
                 out[country.get('code')] = 0.00
+                continue
+            closest_exchange_rate = self.exchange_rates.closest_rate(currency_code, self.value_date.value)
+            exchange_rate = closest_exchange_rate.get('conversion_rate')
+            value = self.value_usd.value * exchange_rate
+            out[country.get('code')] = value
         return SimpleField(out)
 
+    def _deferred_values(self):
+        """Leaves the converted values empty, to be filled in once the rows have
+        been written, by `lib.conversion.DeferredConversions`"""
+        return SimpleField(None), SimpleField(None), SimpleField(None), SimpleField(None), SimpleField(None)
+
 
 class Common(FinancialValues):
     def _get_first_attrib(self, field, attribute):
@@ -319,35 +464,25 @@ class Common(FinancialValues):
             return list_of_values[0].get(attribute)
         return None
 
-    def _iati_identifier(self):
-        return IATIIdentifier(self.activity)
-
-    def _title(self):
-        return Title(self.activity, self.activity_cache, self.langs)
-
     def _description(self):
-        return Description(self.activity, self.activity_cache, self.langs)
+        return Description(self.context.children, self.activity_cache, self.langs,
+                           narratives=self.context.narratives)
 
     def _locations(self):
-        return Location(self.activity, self.langs)
+        return Location(self.context.children, self.langs)
 
     def _GLIDE(self):
-        return GLIDE(self.activity, self.langs)
+        return GLIDE(self.context.children, self.langs)
 
     def _HRP(self):
-        return HRP(self.activity, self.langs)
-
-    def _reporting_org(self):
-        return ReportingOrg(self.activity, self.activity_cache, self.organisations_cache, self.langs)
-
-    def _reporting_org_group(self, reporting_org, reporting_org_groups):
-        return ReportingOrgGroup(reporting_org, reporting_org_groups)
-
-    def _reporting_org_ref(self):
-        return SimpleField(self._get_first_attrib(self.reporting_org.value, 'ref'))
+        return HRP(self.context.children, self.langs)
 
-    def _reporting_org_type(self):
-        return SimpleField(list(self.reporting_org.value.values())[0].get('type'))
+    def _activity_fields(self):
+        """Sets the fields which are the same for every row of the activity, from its context"""
+        self.iati_identifier = self.context.iati_identifier
+        self.title = self.context.title
+        self.reporting_org = self.context.reporting_org
+        self.reporting_org_group = self.context.reporting_org_group
 
     def _fiscal_year_quarter(self):
         fy, fq = get_fy_fq(self.transaction_date.value)
@@ -360,32 +495,29 @@ class Common(FinancialValues):
 
     def _countries(self, budget=False):
         if budget is False:
-            return CountryRegion(self.activity, self.activity_cache, self.transaction)
-        return CountryRegion(self.activity, self.activity_cache, False, self.activity_currency, self.exchange_rates)
+            return CountryRegion(self.context, self.children)
+        return CountryRegion(self.context, False, self.activity_currency, self.exchange_rates)
 
     def _sectors(self, budget=False):
         if budget is False:
-            return Sector(self.activity, self.activity_cache, self.transaction)
-        return Sector(self.activity, self.activity_cache, False, self.activity_currency, self.exchange_rates)
+            return Sector(self.context, self.children)
+        return Sector(self.context, False, self.activity_currency, self.exchange_rates)
 
     def _humanitarian(self, budget=True):
         if budget is False:
-            return Humanitarian(self.activity, self.transaction)
-        return Humanitarian(self.activity, False)
+            return Humanitarian(self.context, self.transaction)
+        return Humanitarian(self.context, False)
 
     def _default_field(self, field_name, budget=False):
         if budget is False:
-            return DefaultActivityField(self.activity, self.activity_cache, self.transaction, field_name)
-        return DefaultActivityField(self.activity, self.activity_cache, False, field_name, self.activity_currency, self.exchange_rates)
-
-    def _dportal_url(self):
-        return SimpleField(DPORTAL_URL.format(self.iati_identifier))
+            return DefaultActivityField(self.context, self.children, field_name)
+        return DefaultActivityField(self.context, False, field_name, self.activity_currency, self.exchange_rates)
 
     def _start_date(self):
-        return ActivityDate(self.activity, ['2', '1'])
+        return ActivityDate(self.context.children, ['2', '1'])
 
     def _end_date(self):
-        return ActivityDate(self.activity, ['4', '3'])
+        return ActivityDate(self.context.children, ['4', '3'])
 
     def _hash(self):
         return ActivityHash(self.activity)
@@ -434,20 +566,26 @@ class Budget(FinancialValues):
         :rtype: ((datetime.date, datetime.date), BudgetPeriod)
         """
 
-        budget_currency = self.budget_element.find('value').get('currency')
+        children = ChildIndex(self.budget_element)
+        value = children.first('value')
+        budget_currency = value.get('currency')
         if budget_currency is not None:
             self.currency_original = SimpleField(budget_currency)
         else:
             self.currency_original = SimpleField(self.default_currency)
 
-        self.period_start = get_date(self.budget_element.find('period-start').get('iso-date'))
-        self.period_end = get_date(self.budget_element.find('period-end').get('iso-date'))
-        self.value_original = SimpleField(float(self.budget_element.find('value').text))
-        self.value_date = SimpleField(get_date(self.budget_element.find('value').get('value-date')))
+        self.period_start = get_date(children.first('period-start').get('iso-date'))
+        self.period_end = get_date(children.first('period-end').get('iso-date'))
+        self.value_original = SimpleField(float(value.text))
+        self.value_date = SimpleField(get_date(value.get('value-date')))
 
-        self.exchange_rate, self.value_usd, self.exchange_rate_date = self._exchange_rate_usd()
-        self.value_eur = self._exchange_rate_eur()
-        self.value_local = self._values_local()
+        if self.deferred_conversion:
+            (self.exchange_rate, self.value_usd, self.exchange_rate_date,
+             self.value_eur, self.value_local) = self._deferred_values()
+        else:
+            self.exchange_rate, self.value_usd, self.exchange_rate_date = self._exchange_rate_usd()
+            self.value_eur = self._exchange_rate_eur()
+            self.value_local = self._values_local()
         return ((self.period_start, self.period_end),
             BudgetPeriod({
                 'period_start': self.period_start,
@@ -467,13 +605,15 @@ class Budget(FinancialValues):
     def as_dict(self):
         return dict([(field, getattr(getattr(self, field), 'value')) for field in self.fields])
 
-    def __init__(self, budget_element, default_currency, original_revised, countries, exchange_rates, currencies):
+    def __init__(self, budget_element, default_currency, original_revised, countries, exchange_rates, currencies,
+                 deferred_conversion=False):
         self.budget_element = budget_element
         self.default_currency = default_currency
         self.original_revised = original_revised
         self.countries = countries
-        self.exchange_rates = exchange_rates
+        self.exchange_rates = memoized(exchange_rates)
         self.currencies = currencies
+        self.deferred_conversion = deferred_conversion
         self.value = self.generate()
         self.fields = ['period_start', 'default_currency', 'original_revised', 'value']
 
@@ -482,10 +622,10 @@ class ActivityBudget(Common):
     """Reads the budget elements from an IATI activity XML file and flattens them by quarter"""
 
     def _activity_currency(self):
-        return self.activity.get('default-currency')
+        return self.context.default_currency
 
     def _organisation_field(self, provider_receiver):
-        return Organisation(self.activity_cache, self.organisations_cache, self.activity, provider_receiver=='provider', self.langs)
+        return Organisation(self.context, self.organisations_cache, None, provider_receiver=='provider', self.langs)
 
     def _get_list_budget_periods(self, exchange_rates, budgets):
         """Returns a list of budget periods (quarters), with the budget values, exchange rates, etc. specified
@@ -506,9 +646,10 @@ class ActivityBudget(Common):
 
             # calculate how many days in the budget
             days_in_budget = (budget.period_end - budget.period_start).days + 1  # +1 because we need an inclusive count
-            budget_value_per_day = {'value_original': budget.value_original.value / days_in_budget,
-                                    'value_usd': budget.value_usd.value / days_in_budget,
-                                    'value_eur': budget.value_eur.value / days_in_budget}
+            budget_value_per_day = {'value_original': budget.value_original.value / days_in_budget}
+            if not self.deferred_conversion:
+                budget_value_per_day['value_usd'] = budget.value_usd.value / days_in_budget
+                budget_value_per_day['value_eur'] = budget.value_eur.value / days_in_budget
 
             start_quarter = DateQuarter.from_date(budget.period_start)
             end_quarter = DateQuarter.from_date(budget.period_end)
@@ -532,15 +673,20 @@ class ActivityBudget(Common):
                     # the days() generator cycles through all days, so is already inclusive.
                     budget_days_in_quarter = sum(1 for _ in quarter.days())
 
-                value_local = dict([(country, (value_local / days_in_budget) * budget_days_in_quarter)
-                                    for country, value_local in budget.value_local.value.items()])
+                if self.deferred_conversion:
+                    value_usd, value_eur, value_local = None, None, None
+                else:
+                    value_usd = budget_value_per_day['value_usd'] * budget_days_in_quarter
+                    value_eur = budget_value_per_day['value_eur'] * budget_days_in_quarter
+                    value_local = dict([(country, (value_local / days_in_budget) * budget_days_in_quarter)
+                                        for country, value_local in budget.value_local.value.items()])
 
-                out.append({
+                budget_period = {
                     'fiscal_year': quarter.year(),
                     'fiscal_quarter': "Q{}".format(quarter.quarter()),
                     'fiscal_year_quarter': "{} Q{}".format(quarter.year(), quarter.quarter()),
-                    'value_usd': budget_value_per_day['value_usd'] * budget_days_in_quarter,
-                    'value_eur': budget_value_per_day['value_eur'] * budget_days_in_quarter,
+                    'value_usd': value_usd,
+                    'value_eur': value_eur,
                     'value_local': value_local,
                     'value_original': budget_value_per_day['value_original'] * budget_days_in_quarter,
                     'value_date': budget.value_date.value,
@@ -549,7 +695,10 @@ class ActivityBudget(Common):
                     'exchange_rate_date': budget.exchange_rate_date.value,
                     'currency_original': budget.currency_original.value,
                     'original_revised': budget.original_revised
-                })
+                }
+                if self.deferred_conversion:
+                    budget_period['conversion'] = (budget.value_original.value, days_in_budget, budget_days_in_quarter)
+                out.append(budget_period)
 
         return out
 
@@ -560,18 +709,20 @@ class ActivityBudget(Common):
         The matching budget elements from the XML file are passed to `_get_list_budget_periods` which splits by
         quarter and returns a list of dictionaries; this is then returned to the caller."""
 
-        original_budget_els = self.activity.xpath("budget[not(@type) or @type='1']")
-        revised_budget_els = self.activity.findall("budget[@type='2']")
+        original_budget_els = self.context.children.default('budget', 'type', '1')
+        revised_budget_els = self.context.children.select('budget', type='2')
 
         original_budgets = dict(map(lambda budget: Budget(budget,
                                                           self.activity_currency,
                                                           'original',
                                                           self.countries,
                                                           self.exchange_rates,
-                                                          self.currencies).value,
+                                                          self.currencies,
+                                                          self.deferred_conversion).value,
                                     original_budget_els))
         revised_budgets = dict(map(lambda budget: Budget(budget, self.activity_currency,
-            'revised', self.countries, self.exchange_rates, self.currencies).value, revised_budget_els))
+            'revised', self.countries, self.exchange_rates, self.currencies,
+            self.deferred_conversion).value, revised_budget_els))
 
         revised_budget_start_dates = list(map(lambda budget: budget[0], revised_budgets))
         def filter_budgets(budget_item):
@@ -586,41 +737,41 @@ class ActivityBudget(Common):
         return self._get_list_budget_periods(self.exchange_rates, budgets)
 
     def generate(self):
-        self.iati_identifier = self._iati_identifier()
-        self.title = self.update_cache(self._title())
-        self.reporting_org = self.update_cache(self._reporting_org())
-        self.reporting_org_type = self._reporting_org_type()
-        self.reporting_org_group = self._reporting_org_group(self._reporting_org(), self.reporting_organisation_groups)
+        self._activity_fields()
+        self.reporting_org_type = self.context.reporting_org_type
 
         self.activity_currency = self._activity_currency()
-        self.sectors = self.update_cache(self._sectors(budget=True))
-        self.countries = self.update_cache(self._countries(budget=True))
+        self.sectors = self._sectors(budget=True)
+        self.countries = self._countries(budget=True)
         if self.countries.value == False:
             return False
         self.budgets = SimpleField(self._read_budgets_from_xml())
         self.multi_country = self._multi_country()
         self.humanitarian = self._humanitarian(budget=True)
 
-        self.aid_types = self.update_cache(self._default_field('aid-type', budget=True))
-        self.finance_types = self.update_cache(self._default_field('finance-type', budget=True))
-        self.flow_types = self.update_cache(self._default_field('flow-type', budget=True))
+        self.aid_types = self._default_field('aid-type', budget=True)
+        self.finance_types = self._default_field('finance-type', budget=True)
+        self.flow_types = self._default_field('flow-type', budget=True)
 
         self.provider_org = self.update_cache(self._organisation_field('provider'))
         self.provider_org_type = self._provider_org_type()
         self.receiver_org = self.update_cache(self._organisation_field('receiver'))
         self.receiver_org_type = self._receiver_org_type()
         self.transaction_type = SimpleField('budget')
-        self.url = self._dportal_url()
+        self.url = self.context.url
         return self
 
     def __init__(self, activity, activity_cache, exchange_rates, currencies,
-                 organisations_cache={}, langs=['en'], reporting_organisation_groups={}):
+                 organisations_cache={}, langs=['en'], reporting_organisation_groups={},
+                 deferred_conversion=False, activity_context=None):
         self.activity = activity
-        self.activity_cache = activity_cache.get(
-            self._iati_identifier().value
-        )
+        # shared with the activity's other rows, when given
+        self.context = activity_context or ActivityContext(
+            activity, activity_cache, organisations_cache, langs, reporting_organisation_groups)
+        self.activity_cache = self.context.activity_cache
         self.currencies = currencies
-        self.exchange_rates = exchange_rates
+        self.exchange_rates = memoized(exchange_rates)
+        self.deferred_conversion = deferred_conversion
         self.organisations_cache = organisations_cache
         self.langs = langs
         self.csv_fields = ['iati_identifier', 'title', 'reporting_org_group', 'reporting_org',
@@ -649,12 +800,9 @@ class ActivityBudget(Common):
 
 class Activity(Common):
     def generate(self):
-        self.iati_identifier = self._iati_identifier()
-        self.title = self.update_cache(self._title())
+        self._activity_fields()
         self.description = self._description()
-        self.reporting_org = self.update_cache(self._reporting_org())
-        self.reporting_org_ref = self._reporting_org_ref()
-        self.reporting_org_group = self._reporting_org_group(self._reporting_org(), self.reporting_organisation_groups)
+        self.reporting_org_ref = self.context.reporting_org_ref
         self.location = self._locations()
         self.start_date = self._start_date()
         self.end_date = self._end_date()
@@ -664,13 +812,14 @@ class Activity(Common):
 
     def __init__(self, activity, activity_cache,
             organisations_cache={}, langs=['en'],
-            reporting_organisation_groups={}):
+            reporting_organisation_groups={}, activity_context=None):
 
         # type(activity) = lxml.etree._Element
         self.activity = activity
-        self.activity_cache = activity_cache.get(
-            self._iati_identifier().value
-        )
+        # shared with the activity's transactions and budgets, when given
+        self.context = activity_context or ActivityContext(
+            activity, activity_cache, organisations_cache, langs, reporting_organisation_groups)
+        self.activity_cache = self.context.activity_cache
         self.organisations_cache = organisations_cache
         self.langs = langs
         self.csv_fields = ['iati_identifier', 'title', 'description',
@@ -698,68 +847,73 @@ class Activity(Common):
 
 class Transaction(Common):
     def _organisation_field(self, provider_receiver):
-        return Organisation(self.activity_cache, self.organisations_cache, self.transaction, provider_receiver=='provider', self.langs)
+        return Organisation(self.context, self.organisations_cache, self.children, provider_receiver=='provider', self.langs)
 
     def _transaction_type(self):
-        return SimpleField(self.transaction.find('transaction-type').get('code'))
+        return SimpleField(self.children.first('transaction-type').get('code'))
 
     def _value_original(self):
-        return SimpleField(float(self.transaction.find('value').text))
+        return SimpleField(float(self.children.first('value').text))
 
     def _currency_original(self):
-        return Currency(self.activity, self.activity_cache, self.transaction)
+        return Currency(self.context, self.children)
 
     def _value_date(self):
-        return SimpleField(get_date(self.transaction.find('value').get('value-date')))
+        return SimpleField(get_date(self.children.first('value').get('value-date')))
 
     def _transaction_date(self):
-        return SimpleField(self.transaction.find('transaction-date').get('iso-date'))
+        return SimpleField(self.children.first('transaction-date').get('iso-date'))
 
     def generate(self):
-        self.iati_identifier = self._iati_identifier()
-        self.title = self.update_cache(self._title())
-        self.reporting_org = self.update_cache(self._reporting_org())
-        self.reporting_org_type = self._reporting_org_type()
-        self.reporting_org_group = self._reporting_org_group(self._reporting_org(), self.reporting_organisation_groups)
-        self.countries = self.update_cache(self._countries())
+        self._activity_fields()
+        self.reporting_org_type = self.context.reporting_org_type
+        self.countries = self._countries()
         if self.countries.value == False: return False
-        self.sectors = self.update_cache(self._sectors())
+        self.sectors = self._sectors()
         self.multi_country = self._multi_country()
         self.transaction_type = self._transaction_type()
         if self.limit_transaction_types and (self.transaction_type.value not in ['1', '2', '3', '4']):
             return False
-        self.aid_type = self.update_cache(self._default_field('aid-type'))
-        self.finance_type = self.update_cache(self._default_field('finance-type'))
-        self.flow_type = self.update_cache(self._default_field('flow-type'))
+        self.aid_type = self._default_field('aid-type')
+        self.finance_type = self._default_field('finance-type')
+        self.flow_type = self._default_field('flow-type')
         self.humanitarian = self._humanitarian(budget=False)
         self.provider_org = self.update_cache(self._organisation_field('provider'))
         self.provider_org_type = self._provider_org_type()
         self.receiver_org = self.update_cache(self._organisation_field('receiver'))
         self.receiver_org_type = self._receiver_org_type()
         self.value_original = self._value_original()
-        self.currency_original = self.update_cache(self._currency_original())
+        self.currency_original = self._currency_original()
         self.value_date = self._value_date()
         self.transaction_date = self._transaction_date()
         self.fiscal_year, self.fiscal_quarter = self._fiscal_year_quarter()
         self.fiscal_year_quarter = self._fiscal_year_fiscal_quarter()
-        self.exchange_rate, self.value_usd, self.exchange_rate_date = self._exchange_rate_usd()
-        self.value_eur = self._exchange_rate_eur()
-        self.value_local = self._values_local()
-        self.url = self._dportal_url()
+        if self.deferred_conversion:
+            (self.exchange_rate, self.value_usd, self.exchange_rate_date,
+             self.value_eur, self.value_local) = self._deferred_values()
+        else:
+            self.exchange_rate, self.value_usd, self.exchange_rate_date = self._exchange_rate_usd()
+            self.value_eur = self._exchange_rate_eur()
+            self.value_local = self._values_local()
+        self.url = self.context.url
         return self
 
     def __init__(self, activity, transaction, activity_cache, exchange_rates,
             currencies, limit_transaction_types=True, organisations_cache={},
-            langs=['en'], reporting_organisation_groups={}):
+            langs=['en'], reporting_organisation_groups={}, deferred_conversion=False,
+            activity_context=None):
 
         # type(transaction) is lxml.etree._Element
         self.transaction = transaction
+        self.children = ChildIndex(transaction)
         self.activity = activity
-        self.activity_cache = activity_cache.get(
-            self._iati_identifier().value
-        )
+        # shared with the activity's other rows, when given
+        self.context = activity_context or ActivityContext(
+            activity, activity_cache, organisations_cache, langs, reporting_organisation_groups)
+        self.activity_cache = self.context.activity_cache
         self.currencies = currencies
-        self.exchange_rates = exchange_rates
+        self.exchange_rates = memoized(exchange_rates)
+        self.deferred_conversion = deferred_conversion
         self.limit_transaction_types = limit_transaction_types
         self.langs = langs
         self.csv_fields = ['iati_identifier', 'title',
@@ -811,9 +965,8 @@ class SimpleField(Field):
 
 
 class IATIIdentifier(Field):
-    def __init__(self, activity):
-        self.activity = activity
-        self.value = activity.find('iati-identifier').text
+    def __init__(self, activity_children):
+        self.value = activity_children.first('iati-identifier').text
 
 
 class ActivityHash(Field):
@@ -835,14 +988,16 @@ class Title(Field):
     def generate(self):
         if self.activity_cache.title is not None:
             return self.activity_cache.title
-        title = dict([(lang, get_narrative(self.activity.find('title'), lang)) for lang in self.langs])
+        narratives = self.narratives.get(self.activity_children.first('title'))
+        title = dict([(lang, narratives[lang]) for lang in self.langs])
         self.activity_cache.title = title
         return title
 
-    def __init__(self, activity, activity_cache, langs):
-        self.activity = activity
+    def __init__(self, activity_children, activity_cache, langs, narratives=None):
+        self.activity_children = activity_children
         self.activity_cache = activity_cache
         self.langs = langs
+        self.narratives = narratives or NarrativeCache(langs)
         self.value = self.generate()
 
 
@@ -853,17 +1008,20 @@ class Description(Field):
     def generate(self):
         if self.activity_cache.description is not None:
             return self.activity_cache.description
-        if self.activity.find('description[@type="{}"]'.format(self.description_type)) is not None:
-            description = dict([(lang, get_narrative(self.activity.find('description[@type="{}"]'.format(self.description_type)), lang)) for lang in self.langs])
+        descriptions = self.activity_children.select('description', type=self.description_type)
+        if len(descriptions) > 0:
+            narratives = self.narratives.get(descriptions[0])
         else:
-            description = dict([(lang, get_narrative(self.activity.find('description'), lang)) for lang in self.langs])
+            narratives = self.narratives.get(self.activity_children.first('description'))
+        description = dict([(lang, narratives[lang]) for lang in self.langs])
         self.activity_cache.description = description
         return description
 
-    def __init__(self, activity, activity_cache, langs, description_type='1'):
-        self.activity = activity
+    def __init__(self, activity_children, activity_cache, langs, description_type='1', narratives=None):
+        self.activity_children = activity_children
         self.activity_cache = activity_cache
         self.langs = langs
+        self.narratives = narratives or NarrativeCache(langs)
         self.description_type = description_type
         self.value = self.generate()
 
@@ -872,14 +1030,14 @@ class ActivityDate(Field):
     def generate(self):
         pref_attr = None
         for preference in self.preferences:
-            pref_el = self.activity.find(f'activity-date[@type="{preference}"]')
-            if pref_el is not None:
-                pref_attr = pref_el.get('iso-date')
+            pref_els = self.activity_children.select('activity-date', type=preference)
+            if len(pref_els) > 0:
+                pref_attr = pref_els[0].get('iso-date')
                 if pref_attr is not None: break
         return pref_attr
 
-    def __init__(self, activity, preferences):
-        self.activity = activity
+    def __init__(self, activity_children, preferences):
+        self.activity_children = activity_children
         self.preferences = preferences
         self.value = self.generate()
 
@@ -892,11 +1050,11 @@ class Location(Field):
     shapefiles, but this will be a more intensive process.
     """
     def generate(self):
-        locations = self.activity.xpath('location[location-id/@vocabulary="G1"]')
+        locations = LOCATIONS_G1(self.activity_children.element)
         return "; ".join([location.find('location-id').get('code') for location in locations])
 
-    def __init__(self, activity, lang):
-        self.activity = activity
+    def __init__(self, activity_children, lang):
+        self.activity_children = activity_children
         self.value = self.generate()
 
 
@@ -905,11 +1063,11 @@ class GLIDE(Field):
     Finds all GLIDE codes for an activity.
     """
     def generate(self):
-        glides = self.activity.xpath('humanitarian-scope[@type="1"][@vocabulary="1-2"]')
+        glides = self.activity_children.select('humanitarian-scope', type="1", vocabulary="1-2")
         return "; ".join([glide.get('code') for glide in glides])
 
-    def __init__(self, activity, lang):
-        self.activity = activity
+    def __init__(self, activity_children, lang):
+        self.activity_children = activity_children
         self.value = self.generate()
 
 
@@ -918,11 +1076,11 @@ class HRP(Field):
     Finds all HRP codes for an activity.
     """
     def generate(self):
-        hrps = self.activity.xpath('humanitarian-scope[@type="2"][@vocabulary="2-1"]')
+        hrps = self.activity_children.select('humanitarian-scope', type="2", vocabulary="2-1")
         return "; ".join([hrp.get('code') for hrp in hrps])
 
-    def __init__(self, activity, lang):
-        self.activity = activity
+    def __init__(self, activity_children, lang):
+        self.activity_children = activity_children
         self.value = self.generate()
 
 
@@ -942,11 +1100,11 @@ class ReportingOrg(Field):
         return self.value.get(lang).get('display')
 
     def get_reporting_org(self, lang):
-        _ro = self.activity.find("reporting-org")
+        _ro = self.activity_children.first("reporting-org")
         _text = get_org_name(
             organisations=self.organisations.get(lang, {}),
             ref=_ro.get("ref"),
-            text=get_narrative(_ro, lang)
+            text=self.narratives.get(_ro)[lang]
         )
         _type = _ro.get('type')
         _ref = _ro.get('ref')
@@ -965,11 +1123,12 @@ class ReportingOrg(Field):
         self.activity_cache.reporting_org = reporting_org
         return reporting_org
 
-    def __init__(self, activity, activity_cache, organisations, langs):
-        self.activity = activity
+    def __init__(self, activity_children, activity_cache, organisations, langs, narratives=None):
+        self.activity_children = activity_children
         self.activity_cache = activity_cache
         self.organisations = organisations
         self.langs = langs
+        self.narratives = narratives or NarrativeCache(langs)
         self.value = self.generate()
 
 
@@ -991,23 +1150,20 @@ class Organisation(Field):
             }
 
         provider_receiver = {True: 'provider', False: 'receiver'}[self.provider_receiver]
-        if (self.transaction.tag == 'transaction'):
-            transaction = self.transaction
-            activity = transaction.getparent()
-            transaction_type = transaction.find("transaction-type").get("code")
-            if transaction.find('{}-org'.format(provider_receiver)) is not None:
-                _el = transaction.find('{}-org'.format(provider_receiver))
+        if self.transaction is not None:
+            transaction_type = self.transaction.first("transaction-type").get("code")
+            _el = self.transaction.first('{}-org'.format(provider_receiver))
+            if _el is not None:
                 _text = get_org_name(
                     organisations=self.organisations.get(lang, {}),
                     ref=_el.get("ref"),
-                    text=get_narrative(_el, lang)
+                    text=self.context.narratives.get(_el)[lang]
                 )
                 _ref = _el.get("ref")
                 _type = _el.get("type")
                 if (_ref is not None) or (_text is not None):
                     return _make_org_output(_text, _ref, _type)
         else:
-            activity = self.transaction
             transaction_type = 'activity'
 
         role = {
@@ -1018,14 +1174,11 @@ class Organisation(Field):
             or (self.provider_receiver==False and transaction_type in ['1', '11', '13'])):
 
             if self.activity_cache.get('reporting_org') is None:
-                if self.transaction == 'transaction':
-                    _ro = transaction.getparent().find("reporting-org")
-                else:
-                    _ro = activity.find("reporting-org")
+                _ro = self.context.children.first("reporting-org")
                 _text = get_org_name(
                     organisations=self.organisations.get(lang, {}),
                     ref=_ro.get("ref"),
-                    text=get_narrative(_ro, lang)
+                    text=self.context.narratives.get(_ro)[lang]
                 )
                 _type = _ro.get('type')
                 _ref = _ro.get('ref')
@@ -1039,10 +1192,7 @@ class Organisation(Field):
             return self.activity_cache.get('reporting_org').get(lang)
 
         if self.activity_cache.get("participating_org_{}".format(role)) is None:
-            if self.transaction == 'transaction':
-                activity_participating = transaction.getparent().findall("participating-org[@role='{}']".format(role))
-            else:
-                activity_participating = activity.findall("participating-org[@role='{}']".format(role))
+            activity_participating = self.context.children.select("participating-org", role=role)
             if len(activity_participating) == 1:
                 _text = get_org_name(
                         organisations=self.organisations.get(lang, {}),
@@ -1058,7 +1208,7 @@ class Organisation(Field):
                     _text=get_org_name(
                             organisations=self.organisations.get(lang, {}),
                             ref=_org.get("ref"),
-                            text=get_narrative(_org, lang)
+                            text=self.context.narratives.get(_org)[lang]
                     ),
                     _ref=_org.get('ref'),
                     _type=_org.get('type')), activity_participating)
@@ -1094,8 +1244,13 @@ class Organisation(Field):
     def generate(self):
         return dict([(lang, self.get_organisation(lang)) for lang in self.langs])
 
-    def __init__(self, activity_cache, organisations, transaction, provider_receiver, langs):
-        self.activity_cache = activity_cache
+    def __init__(self, activity_context, organisations, transaction, provider_receiver, langs):
+        """
+        :param transaction: the children of a transaction, or None for an activity's own organisations
+        :type transaction: lib.iati_helpers.ChildIndex
+        """
+        self.context = activity_context
+        self.activity_cache = activity_context.activity_cache
         self.organisations = organisations
         self.transaction = transaction
         self.provider_receiver = provider_receiver
@@ -1105,16 +1260,10 @@ class Organisation(Field):
 
 class CountryRegion(Field):
     def country_transaction(self):
-        return self.transaction.xpath('recipient-country')
+        return self.transaction.all('recipient-country')
 
     def region_transaction(self):
-        return self.transaction.xpath("recipient-region[not(@vocabulary) or @vocabulary='1']")
-
-    def country_activity(self):
-        return self.activity.xpath('recipient-country')
-
-    def region_activity(self):
-        return self.activity.xpath("recipient-region[not(@vocabulary) or @vocabulary='1']")
+        return self.transaction.default('recipient-region')
 
     def country_region_transaction(self):
         countries = self.country_transaction()
@@ -1124,25 +1273,10 @@ class CountryRegion(Field):
         return []
 
     def country_region_from_all_transactions(self):
-        return get_countries_from_transactions(
-            self.activity,
-            self.currency_original,
-            self.exchange_rates
-        )
+        return get_countries_from_transactions(self.context.transaction_index(self.exchange_rates))
 
     def country_region_activity(self):
-        if (self.activity_cache.countries is not None) or (self.activity_cache.regions is not None):
-            return clean_countries(self.activity_cache.countries,
-                self.activity_cache.regions)
-        countries = self.country_activity()
-        regions = self.region_activity()
-        if (countries or regions):
-            if countries is not None:
-                self.activity_cache.countries = countries
-            if regions is not None:
-                self.activity_cache.regions = regions
-            return clean_countries(countries, regions)
-        return []
+        return self.context.country_region_activity()
 
     def generate_from_transaction(self):
         country_region_transaction = self.country_region_transaction()
@@ -1162,9 +1296,9 @@ class CountryRegion(Field):
             return country_region_from_transactions
         return False
 
-    def __init__(self, activity, activity_cache, transaction, currency_original=None, exchange_rates=None):
-        self.activity = activity
-        self.activity_cache = activity_cache
+    def __init__(self, activity_context, transaction, currency_original=None, exchange_rates=None):
+        self.context = activity_context
+        self.activity = activity_context.activity
         self.transaction = transaction
         if self.transaction == False:
             self.currency_original = currency_original
@@ -1176,10 +1310,7 @@ class CountryRegion(Field):
 
 class Sector(Field):
     def _sector_transaction(self):
-        return self.transaction.xpath("sector[not(@vocabulary) or @vocabulary='1']")
-
-    def _sector_activity(self):
-        return self.activity.xpath("sector[not(@vocabulary) or @vocabulary='1']")
+        return self.transaction.default('sector')
 
     def sector_transaction(self):
         sectors = self._sector_transaction()
@@ -1188,20 +1319,10 @@ class Sector(Field):
         return False
 
     def sectors_from_all_transactions(self):
-        return get_sectors_from_transactions(
-            self.activity,
-            self.currency_original,
-            self.exchange_rates
-        )
+        return get_sectors_from_transactions(self.context.transaction_index(self.exchange_rates))
 
     def sector_activity(self):
-        if (self.activity_cache.sectors is not None):
-            return clean_sectors(self.activity_cache.sectors)
-        sectors = self._sector_activity()
-        if sectors:
-            self.activity_cache.sectors = sectors
-            return clean_sectors(sectors)
-        return False
+        return self.context.sector_activity()
 
     def generate_from_transaction(self):
         sector_transaction = self.sector_transaction()
@@ -1222,9 +1343,10 @@ class Sector(Field):
     def __str__(self):
         return self.value
 
-    def __init__(self, activity, activity_cache, transaction, currency_original=None, exchange_rates=None):
-        self.activity = activity
-        self.activity_cache = activity_cache
+    def __init__(self, activity_context, transaction, currency_original=None, exchange_rates=None):
+        self.context = activity_context
+        self.activity = activity_context.activity
+        self.activity_cache = activity_context.activity_cache
         self.transaction = transaction
         if self.transaction == False:
             self.exchange_rates = exchange_rates
@@ -1239,7 +1361,7 @@ class Humanitarian(Field):
         return self.transaction.get('humanitarian')
 
     def field_activity(self):
-        return self.activity.get('humanitarian')
+        return self.context.humanitarian
 
     def generate(self):
         if self.transaction is not False:
@@ -1249,18 +1371,18 @@ class Humanitarian(Field):
         if field_activity is not None: return 1 if field_activity in ['true', '1'] else 0
         return False
 
-    def __init__(self, activity, transaction):
-        self.activity = activity
+    def __init__(self, activity_context, transaction):
+        self.context = activity_context
         self.transaction = transaction
         self.value = 1 if self.generate() == True else 0
 
 
 class Currency(Field):
     def field_transaction(self):
-        return self.transaction.find('value').get('currency')
+        return self.transaction.first('value').get('currency')
 
     def field_activity(self):
-        return self.activity.get('default-currency')
+        return self.context.default_currency
 
     def generate(self):
         field_transaction = self.field_transaction()
@@ -1272,28 +1394,23 @@ class Currency(Field):
         else:
             return None
 
-    def __init__(self, activity, activity_cache, transaction):
-        self.activity = activity
-        self.activity_cache = activity_cache
+    def __init__(self, activity_context, transaction):
+        self.context = activity_context
+        self.activity_cache = activity_context.activity_cache
         self.transaction = transaction
         self.value = self.generate()
 
 
 class DefaultActivityField(Field):
     def field_transaction(self):
-        return self.transaction.find(self.field_name)
+        return self.transaction.first(self.field_name)
 
     def field_activity(self):
-        field_activity = self.activity.find('default-{}'.format(self.field_name))
-        if field_activity is not None:
-            setattr(self.activity_cache, self.field_name_underscores, field_activity.get('code'))
-        return field_activity
+        return self.context.default_field(self.field_name)
 
     def field_from_all_transactions(self):
         return get_classification_from_transactions(
-            self.activity,
-            self.currency_original,
-            self.exchange_rates,
+            self.context.transaction_index(self.exchange_rates),
             self.field_name)
 
     def generate_from_transaction(self):
@@ -1316,9 +1433,10 @@ class DefaultActivityField(Field):
             }]
         return self.field_from_all_transactions()
 
-    def __init__(self, activity, activity_cache, transaction, field_name, currency_original=None, exchange_rates=None):
-        self.activity = activity
-        self.activity_cache = activity_cache
+    def __init__(self, activity_context, transaction, field_name, currency_original=None, exchange_rates=None):
+        self.context = activity_context
+        self.activity = activity_context.activity
+        self.activity_cache = activity_context.activity_cache
         self.transaction = transaction
         self.field_name = field_name
         self.field_name_underscores = field_name.replace("-", "_")
@@ -0,0 +1,73 @@
+import os
+import shutil
+
+import pytest
+
+from iatiflattener import FlattenIATIData
+from iatiflattener.lib import reference
+
+
+FIXTURES_DIR = 'iatiflattener/tests/fixtures'
+REFERENCE_DIR = os.path.join(FIXTURES_DIR, 'reference')
+
+# (publisher, package) pairs used to build a small iatikit cache from the fixtures
+CACHE_PACKAGES = [
+    ('beis', 'beis-activity.xml'),
+    ('canada', 'canada-activity.xml'),
+    ('fcdo', 'fcdo-activity.xml'),
+    ('fcdo', 'gdihub-activity.xml'),
+    ('misc', '3fi-activity.xml'),
+    ('misc', 'budget-one-day-activity.xml'),
+    ('misc', 'sr-activity.xml'),
+    ('misc', 'unops-at-activity.xml'),
+    ('usaid', 'usaid-activity.xml'),
+    ('usaid', 'usaid-humanitarian-activity.xml'),
+    ('worldbank', 'ifad-activity.xml'),
+    ('worldbank', 'worldbank-activity.xml'),
+]
+
+
+@pytest.fixture
+def reference_data():
+    """Codelists and exchange rates from a small set of fixture files, so that
+    whole runs can be tested without network access."""
+    return reference.ReferenceDataCache(REFERENCE_DIR, offline=True)
+
+
+@pytest.fixture
+def iatikitcache_dir(tmp_path):
+    """An iatikit cache directory holding copies of the fixture packages"""
+    cache_dir = os.path.join(tmp_path, 'registry')
+    for publisher, package in CACHE_PACKAGES:
+        os.makedirs(os.path.join(cache_dir, 'data', publisher), exist_ok=True)
+        shutil.copy(os.path.join(FIXTURES_DIR, package),
+                    os.path.join(cache_dir, 'data', publisher, package))
+    return cache_dir
+
+
+@pytest.fixture
+def flatten(reference_data, iatikitcache_dir, tmp_path):
+    """Returns a function which runs the flattener over the fixture cache,
+    and returns the contents of the CSV files written."""
+    def _flatten(output='output', **kwargs):
+        output_dir = os.path.join(tmp_path, output)
+        FlattenIATIData(
+            refresh_rates=False,
+            iatikitcache_dir=kwargs.pop('iatikitcache_dir', iatikitcache_dir),
+            output=output_dir,
+            langs=['en', 'fr'],
+            exchange_rates_filename=os.path.join(FIXTURES_DIR, 'rates.csv'),
+            reference_data=reference_data,
+            **kwargs)
+        return read_csv_files(output_dir)
+    return _flatten
+
+
+def read_csv_files(output_dir):
+    out = {}
+    for root, dirs, files in os.walk(os.path.join(output_dir, 'csv')):
+        for filename in files:
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as csv_file:
+                out[os.path.relpath(path, output_dir)] = csv_file.read()
+    return out
@@ -0,0 +1,81 @@
+import os
+import json
+import pytest
+from lxml import etree
+from iatiflattener.lib import chunking
+
+
+BEIS_PACKAGE = 'iatiflattener/tests/fixtures/beis-activity.xml'
+
+
+class TestChunking():
+
+    @pytest.fixture
+    def byte_ranges(self):
+        return chunking.split_package(BEIS_PACKAGE, 50000)
+
+    def test_split_package(self, byte_ranges):
+        assert len(byte_ranges) > 1
+        assert sum(chunking.range_size(byte_range) for byte_range in byte_ranges) < 267003
+        for previous, current in zip(byte_ranges, byte_ranges[1:]):
+            assert previous[2] == current[1]
+
+    def test_chunks_hold_all_activities(self, byte_ranges):
+        """Each chunk is a complete document, and the chunks hold every activity once, in order"""
+        identifiers = []
+        for byte_range in byte_ranges:
+            root = etree.fromstring(chunking.read_chunk(BEIS_PACKAGE, byte_range))
+            assert root.get('version') == '2.03'
+            identifiers += root.xpath('//iati-activity/iati-identifier/text()')
+        assert identifiers == etree.parse(BEIS_PACKAGE).xpath('//iati-activity/iati-identifier/text()')
+
+    def test_single_activity_not_split(self):
+        assert chunking.split_package('iatiflattener/tests/fixtures/fcdo-activity.xml', 100) is None
+
+    @pytest.fixture
+    def duplicate_identifier(self, iatikitcache_dir):
+        """Gives the last activity of the BEIS package the identifier of the first, and its own title"""
+        package = os.path.join(iatikitcache_dir, 'data', 'beis', 'beis-activity.xml')
+        doc = etree.parse(package)
+        activities = doc.findall('iati-activity')
+        activities[-1].find('iati-identifier').text = activities[0].find('iati-identifier').text
+        activities[-1].find('title/narrative').text = 'SECOND TITLE'
+        doc.write(package, xml_declaration=True, encoding='UTF-8')
+        return package
+
+    def test_repeated_identifier_not_split(self, duplicate_identifier):
+        assert chunking.split_package(BEIS_PACKAGE, 10000) is not None
+        assert chunking.split_package(duplicate_identifier, 10000) is None
+
+    def test_repeated_identifier_matches_serial(self, flatten, duplicate_identifier):
+        """Activities sharing an identifier share cached values, so they are not processed in separate chunks"""
+        assert flatten(output='chunks', workers=2, chunk_size=10000) == flatten(output='serial')
+
+    def test_chunked_output_matches_serial(self, flatten):
+        assert flatten(output='chunks', workers=2, chunk_size=10000) == flatten(output='serial')
+
+    def test_malformed_package_fails_alone(self, flatten, iatikitcache_dir, tmp_path):
+        """A malformed package larger than `chunk_size` is recorded as failed, and the run carries on"""
+        os.makedirs(os.path.join(iatikitcache_dir, 'data', 'broken'))
+        with open(os.path.join(iatikitcache_dir, 'data', 'broken', 'broken.xml'), 'wb') as xml_file:
+            xml_file.write(b'\x00not xml' * 5000)
+        output = flatten(output='chunks', workers=2, chunk_size=10000)
+        with open(os.path.join(tmp_path, 'chunks', 'run-report.json')) as json_file:
+            report = json.load(json_file)
+        assert [(item['publisher'], item['package']) for item in report['failed']] == [('broken', 'broken.xml')]
+        assert output == flatten(output='serial')
+
+    def test_failed_chunks_reported_once(self, flatten, iatikitcache_dir, tmp_path):
+        """A package whose chunks all fail is reported as one failed package"""
+        package = os.path.join(iatikitcache_dir, 'data', 'beis', 'beis-activity.xml')
+        doc = etree.parse(package)
+        for description in doc.findall('iati-activity/description'):
+            description.getparent().remove(description)
+        doc.write(package, xml_declaration=True, encoding='UTF-8')
+        assert len(chunking.split_package(package, 10000)) > 1
+        for output, kwargs in [('chunks', {'workers': 2, 'chunk_size': 10000}), ('serial', {})]:
+            flatten(output=output, **kwargs)
+            with open(os.path.join(tmp_path, output, 'run-report.json')) as json_file:
+                report = json.load(json_file)
+            assert [(item['publisher'], item['package']) for item in report['failed']] == [
+                ('beis', 'beis-activity.xml')]
@@ -0,0 +1,50 @@
+import datetime
+import pytest
+import exchangerates
+from iatiflattener.lib import conversion
+from iatiflattener.lib import rates
+
+
+class TestDeferredConversions():
+
+    @pytest.mark.parametrize("streaming", [False, True])
+    def test_output_matches(self, flatten, streaming):
+        assert (flatten(output='deferred', deferred_conversion=True, streaming=streaming) ==
+                flatten(output='serial', streaming=streaming))
+
+    def test_convert(self, tmp_path):
+        exchange_rates = rates.MemoizedRates(
+            rates.load_rates('iatiflattener/tests/fixtures/rates.csv', str(tmp_path / 'table')))
+        headers = ['country_code', 'exchange_rate', 'exchange_rate_date', 'value_usd', 'value_eur', 'value_local']
+        conversions = conversion.DeferredConversions(exchange_rates, {'GB': 'GBP', 'XX': 'ZZZ'}, headers)
+        value_date = datetime.date(2020, 5, 17)
+        rows = []
+        for country_code, currency in (('GB', 'EUR'), ('XX', 'USD')):
+            row = [country_code, None, None, None, None, None]
+            conversions.add(row, {'country_code': country_code, 'currency_original': currency,
+                                  'value_date': value_date, 'conversion': (1000.0, 90, 30, 0.5)})
+            rows.append(row)
+        conversions.convert()
+
+        closest_eur = exchange_rates.closest_rate('EUR', value_date)
+        value_usd = 1000.0 / closest_eur['conversion_rate']
+        assert rows[0][1:] == [
+            closest_eur['conversion_rate'],
+            closest_eur['closest_date'].isoformat(),
+            ((value_usd / 90) * 30) * 0.5,
+            (((value_usd * closest_eur['conversion_rate']) / 90) * 30) * 0.5,
+            (((value_usd * exchange_rates.closest_rate('GBP', value_date)['conversion_rate']) / 90) * 30) * 0.5
+        ]
+        # there are no exchange rates for the currency of XX
+        assert rows[1][1:] == [1.0, '2020-05-17', ((1000.0 / 90) * 30) * 0.5,
+                               (((1000.0 * closest_eur['conversion_rate']) / 90) * 30) * 0.5, 0.0]
+
+    def test_unknown_currency(self, tmp_path):
+        exchange_rates = rates.MemoizedRates(
+            rates.load_rates('iatiflattener/tests/fixtures/rates.csv', str(tmp_path / 'table')))
+        conversions = conversion.DeferredConversions(exchange_rates, {},
+            ['exchange_rate', 'exchange_rate_date', 'value_usd', 'value_eur', 'value_local'])
+        conversions.add([None] * 5, {'country_code': 'GB', 'currency_original': 'ZZZ',
+                                     'value_date': datetime.date(2020, 5, 17), 'conversion': (1.0, 1, 1, 1.0)})
+        with pytest.raises(exchangerates.UnknownCurrencyException):
+            conversions.convert()
@@ -1,5 +1,9 @@
+import io
+import os
+import csv
 import pytest
 from iatiflattener import FlattenIATIData
+from iatiflattener.lib import reference
 
 
 class TestFlattenIATIData():
@@ -9,9 +13,96 @@ class TestFlattenIATIData():
         ("en", '44000', "The World Bank"),
         ("fr", '44000', "Banque mondiale")
     ])
-    def test_setup_codelists(self, lang, code, name):
+    def test_setup_codelists(self, lang, code, name, tmp_path, monkeypatch):
         fid = FlattenIATIData
-        fid.langs = ['en', 'fr']
-        fid.get_exchange_rates = lambda a: a
+        # set on the class for this test only, so that later tests get the real methods
+        monkeypatch.setattr(fid, 'langs', ['en', 'fr'], raising=False)
+        monkeypatch.setattr(fid, 'reference_data',
+            reference.ReferenceDataCache(os.path.join(tmp_path, 'reference')), raising=False)
+        monkeypatch.setattr(fid, 'get_exchange_rates', lambda a: a)
         fid.setup_codelists(fid, False)
         assert fid.organisations[lang][code] == name
+
+
+class TestOutputFiles():
+
+    def test_files_created_lazily(self, flatten):
+        output = flatten()
+        # only countries and reporting organisations with rows have files, each starting with its header
+        assert 'csv/transaction-LR.csv' in output
+        assert 'csv/budget-289.csv' not in output
+        assert all(data.startswith(b'iati_identifier,') for data in output.values())
+        assert len(output) < 100
+
+    @pytest.mark.parametrize("kwargs", [{}, {'shards': True}, {'workers': 2}])
+    def test_empty_files(self, flatten, tmp_path, kwargs):
+        output = flatten(empty_files=True, **kwargs)
+        lazy_output = flatten(output='lazy')
+        # a file for every country and region in the codelists, even those without rows
+        assert 'csv/budget-289.csv' not in lazy_output
+        assert output['csv/budget-289.csv'].count(b'\n') == 1
+        assert dict((filename, data) for filename, data in output.items() if filename in lazy_output) == lazy_output
+
+    def test_earlier_output_removed(self, flatten, tmp_path):
+        os.makedirs(os.path.join(tmp_path, 'output', 'csv'))
+        with open(os.path.join(tmp_path, 'output', 'csv', 'transaction-LR.csv'), 'w') as csv_file:
+            csv_file.write('earlier run\n')
+        assert flatten() == flatten(output='fresh')
+
+
+REPEATED_IDENTIFIER_PACKAGE = b"""<?xml version="1.0"?>
+<iati-activities version="2.03">
+  <iati-activity default-currency="USD">
+    <iati-identifier>GB-GOV-1-X</iati-identifier>
+    <reporting-org type="10" ref="GB-GOV-1"><narrative>Test</narrative></reporting-org>
+    <title><narrative>First</narrative></title>
+    <description><narrative>First</narrative></description>
+    <recipient-country code="BD"/>
+    <budget type="1">
+      <period-start iso-date="2019-01-01"/>
+      <period-end iso-date="2019-12-31"/>
+      <value value-date="2019-01-01">1000</value>
+    </budget>
+    <transaction>
+      <transaction-type code="2"/>
+      <transaction-date iso-date="2019-01-01"/>
+      <value value-date="2019-01-01">1000</value>
+      <sector code="15110" vocabulary="1"/>
+    </transaction>
+  </iati-activity>
+  <iati-activity default-currency="USD">
+    <iati-identifier>GB-GOV-1-X</iati-identifier>
+    <reporting-org type="10" ref="GB-GOV-1"><narrative>Test</narrative></reporting-org>
+    <title><narrative>Second</narrative></title>
+    <description><narrative>Second</narrative></description>
+    <recipient-country code="BD"/>
+    <transaction>
+      <transaction-type code="3"/>
+      <transaction-date iso-date="2019-01-01"/>
+      <value value-date="2019-01-01">500</value>
+    </transaction>
+  </iati-activity>
+</iati-activities>
+"""
+
+
+class TestRepeatedIdentifiers():
+    """Activities sharing an identifier share the values cached for it, so
+    their rows depend on the order in which the rows are generated"""
+
+    @pytest.fixture
+    def repeated_identifier(self, iatikitcache_dir):
+        os.makedirs(os.path.join(iatikitcache_dir, 'data', 'repeated'))
+        with open(os.path.join(iatikitcache_dir, 'data', 'repeated', 'repeated.xml'), 'wb') as xml_file:
+            xml_file.write(REPEATED_IDENTIFIER_PACKAGE)
+
+    @pytest.mark.parametrize("kwargs", [{}, {'streaming': True}, {'deferred_conversion': True}, {'workers': 2}])
+    def test_rows_in_original_order(self, flatten, repeated_identifier, kwargs):
+        """The budget is split by the sectors of all the identifier's
+        transactions, which are read before any budget"""
+        output = flatten(**kwargs)
+        budget_rows = [row for row in csv.DictReader(io.StringIO(output['csv/budget-BD.csv'].decode('utf-8')))
+                       if row['iati_identifier'] == 'GB-GOV-1-X']
+        assert budget_rows
+        for row in budget_rows:
+            assert (row['sector_category'], row['sector_code']) == ('', '')
@@ -1,5 +1,7 @@
+import os
 import pytest
 from iatiflattener.group_data import GroupFlatIATIData
+from iatiflattener.lib import reference
 
 
 class TestGroupData():
@@ -9,10 +11,18 @@ class TestGroupData():
         ("ReportingOrganisation", "en", 'XM-DAC-41119', "United Nations Population Fund"),
         ("ReportingOrganisation", "fr", 'XM-DAC-41119', None)
     ])
-    def test_get_codelist_with_fallback(self, codelist_name, language, code, item_name):
+    def test_get_codelist_with_fallback(self, codelist_name, language, code, item_name, tmp_path, monkeypatch):
         gfd = GroupFlatIATIData
+        monkeypatch.setattr(gfd, 'reference_data',
+            reference.ReferenceDataCache(os.path.join(tmp_path, 'reference')), raising=False)
         req = gfd.get_codelist_with_fallback(gfd, lang=language, codelist_name=codelist_name)
         assert req.status_code == 200
         data = req.json()
         item = next(filter(lambda codelistitem: codelistitem['code'] == code, data['data']) )
         assert item['name'] == item_name
+
+    def test_missing_csv_file_is_empty(self, tmp_path):
+        """The flattener only writes CSV files for countries and regions with data"""
+        gfd = GroupFlatIATIData.__new__(GroupFlatIATIData)
+        gfd.output_folder = str(tmp_path)
+        assert gfd.get_dataframe('XX', 'transaction', 'en').empty
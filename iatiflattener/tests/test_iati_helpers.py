@@ -0,0 +1,72 @@
+import pytest
+from lxml import etree
+from iatiflattener.lib import iati_helpers
+from iatiflattener.lib.iati_helpers import ChildIndex, NarrativeCache, get_narrative, get_narratives
+
+
+@pytest.mark.parametrize("publisher", ["fcdo", "canada", "usaid", "worldbank"])
+class TestChildIndex():
+
+    @pytest.fixture()
+    def elements(self, publisher):
+        doc = etree.parse('iatiflattener/tests/fixtures/{}-activity.xml'.format(publisher))
+        return doc.xpath('//iati-activity | //iati-activity/transaction | //iati-activity/budget')
+
+    def test_matches_find(self, elements):
+        for element in elements:
+            children = ChildIndex(element)
+            for tag in set(child.tag for child in element.iterchildren(tag=etree.Element)) | {'missing'}:
+                assert children.all(tag) == element.findall(tag)
+                assert children.first(tag) is element.find(tag)
+
+    def test_matches_xpath(self, elements):
+        for element in elements:
+            children = ChildIndex(element)
+            for tag in ('sector', 'recipient-region', 'aid-type'):
+                assert children.default(tag) == element.xpath("{}[not(@vocabulary) or @vocabulary='1']".format(tag))
+            assert children.default('budget', 'type', '1') == element.xpath("budget[not(@type) or @type='1']")
+            for role in ('1', '2', '3', '4'):
+                assert children.select('participating-org', role=role) == element.findall(
+                    "participating-org[@role='{}']".format(role))
+            assert children.select('humanitarian-scope', type='1', vocabulary='1-2') == element.xpath(
+                'humanitarian-scope[@type="1"][@vocabulary="1-2"]')
+            # selections are kept once made
+            assert children.default('sector') is children.default('sector')
+
+
+def narratives(*langs_texts):
+    return etree.fromstring('<title>{}</title>'.format("".join(
+        '<narrative>{}</narrative>'.format(text) if lang is None else
+        '<narrative xml:lang="{}">{}</narrative>'.format(lang, text) for lang, text in langs_texts)))
+
+
+class TestNarratives():
+
+    @pytest.mark.parametrize("container, expected", [
+        (narratives(), {'en': '', 'fr': '', 'es': '', 'pt': ''}),
+        (narratives(('fr', ' Titre ')), {'en': 'Titre', 'fr': 'Titre', 'es': 'Titre', 'pt': 'Titre'}),
+        (narratives(('fr', '')), {'en': '', 'fr': '', 'es': '', 'pt': ''}),
+        (narratives(('fr', 'Titre'), (None, 'Title'), ('ES', 'Título'), ('es', 'Título 2')),
+         {'en': 'Title', 'fr': 'Titre', 'es': 'Título', 'pt': 'Title'}),
+        (narratives(('fr', 'Titre'), ('EN', 'Title'), ('en', 'Title 2')),
+         {'en': 'Title', 'fr': 'Titre', 'es': 'Title', 'pt': 'Title'}),
+        (narratives(('fr', 'Titre'), ('pt', 'Título'), ('pt', 'Título 2')),
+         {'en': 'Titre', 'fr': 'Titre', 'es': 'Titre', 'pt': 'Título'}),
+        (narratives(('de', ''), ('fr', 'Titre')), {'en': '', 'fr': 'Titre', 'es': '', 'pt': ''}),
+    ])
+    def test_get_narratives(self, container, expected):
+        assert get_narratives(container, list(expected)) == expected
+        for lang, text in expected.items():
+            assert get_narrative(container, lang) == text
+
+    def test_narratives_read_once(self, monkeypatch):
+        calls = []
+        def count_narratives(container):
+            calls.append(container)
+            return container.findall('narrative')
+        monkeypatch.setattr(iati_helpers, 'NARRATIVES', count_narratives)
+        container = narratives(('fr', 'Titre'), (None, 'Title'))
+        cache = NarrativeCache(['en', 'fr', 'es', 'pt'])
+        assert cache.get(container) == {'en': 'Title', 'fr': 'Titre', 'es': 'Title', 'pt': 'Title'}
+        assert cache.get(container) is cache.get(container)
+        assert len(calls) == 1
@@ -0,0 +1,37 @@
+import sys
+import json
+import subprocess
+
+
+HEAVY_MODULES = ['pandas', 'numpy', 'requests', 'exchangerates', 'iatikit', 'pyexcelerate', 'openpyxl']
+
+
+def imported_modules(code, modules=HEAVY_MODULES):
+    """Runs code in a new interpreter, returning which of the modules (the heavy modules by default) it imported"""
+    output = subprocess.run([sys.executable, '-c', code + """
+import sys, json
+print(json.dumps([module for module in {} if module in sys.modules]))""".format(modules)],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+class TestImports():
+
+    def test_import_is_light(self):
+        """Importing the flattener, as each worker process does, imports none of the heavy modules"""
+        assert imported_modules("import iatiflattener") == []
+
+    def test_import_leaves_pandas_modules(self):
+        """The modules of the package which use pandas, and the HTTP stack, are only imported when used"""
+        assert imported_modules("import iatiflattener", [
+            'iatiflattener.group_data', 'iatiflattener.data_quality', 'urllib3']) == []
+
+    def test_flatten_does_not_import_pandas(self, iatikitcache_dir, tmp_path):
+        modules = imported_modules("""
+from iatiflattener import FlattenIATIData
+from iatiflattener.lib import reference
+FlattenIATIData(iatikitcache_dir={!r}, output={!r}, langs=['en', 'fr'],
+    exchange_rates_filename='iatiflattener/tests/fixtures/rates.csv',
+    reference_data=reference.ReferenceDataCache('iatiflattener/tests/fixtures/reference', offline=True))
+""".format(str(iatikitcache_dir), str(tmp_path / 'output')))
+        assert 'pandas' not in modules
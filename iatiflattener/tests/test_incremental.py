@@ -0,0 +1,58 @@
+import os
+import json
+import pytest
+from iatiflattener.lib import manifest
+
+
+class TestIncremental():
+
+    def run_report(self, tmp_path, output):
+        with open(os.path.join(tmp_path, output, 'run-report.json')) as json_file:
+            return json.load(json_file)
+
+    @pytest.mark.parametrize("workers", [None, 2])
+    def test_incremental_output_matches(self, flatten, iatikitcache_dir, tmp_path, workers):
+        assert flatten(output='incremental', incremental=True, workers=workers) == flatten(output='full')
+        first_report = self.run_report(tmp_path, 'incremental')
+
+        # an unchanged run reprocesses nothing, and still reports skipped packages
+        assert flatten(output='incremental', incremental=True, workers=workers) == flatten(output='full')
+        report = self.run_report(tmp_path, 'incremental')
+        data_dir = os.path.join(iatikitcache_dir, 'data')
+        packages = sum(len(os.listdir(os.path.join(data_dir, publisher))) for publisher in os.listdir(data_dir))
+        assert report['unchanged'] == packages - len(report['skipped'])
+        assert report['skipped'] == first_report['skipped']
+
+        # changed and deleted packages
+        os.remove(os.path.join(data_dir, 'canada', os.listdir(os.path.join(data_dir, 'canada'))[0]))
+        fcdo_package = os.path.join(data_dir, 'fcdo', os.listdir(os.path.join(data_dir, 'fcdo'))[0])
+        with open(fcdo_package) as xml_file:
+            xml = xml_file.read()
+        with open(fcdo_package, 'w') as xml_file:
+            xml_file.write(xml.replace('GB-1-103662-101', 'GB-1-CHANGED'))
+        assert flatten(output='incremental', incremental=True, workers=workers) == flatten(output='full')
+        assert not os.path.exists(os.path.join(tmp_path, 'incremental', 'shards', 'canada'))
+
+    def test_is_unchanged(self, tmp_path):
+        package = os.path.join(tmp_path, 'package.xml')
+        with open(package, 'w') as xml_file:
+            xml_file.write('<iati-activities/>')
+        package_manifest = manifest.PackageManifest(os.path.join(tmp_path, 'manifest.json'), 'abc')
+        assert package_manifest.is_unchanged('publisher', 'package.xml', package) is False
+        package_manifest.record('publisher', 'package.xml', package, {'status': 'processed'})
+        assert package_manifest.is_unchanged('publisher', 'package.xml', package) is True
+
+        # a new modification time, but the same content
+        os.utime(package, ns=(0, 0))
+        assert package_manifest.is_unchanged('publisher', 'package.xml', package) is True
+        with open(package, 'w') as xml_file:
+            xml_file.write('<iati-activities></iati-activities>')
+        assert package_manifest.is_unchanged('publisher', 'package.xml', package) is False
+
+    def test_fingerprint_changed(self, tmp_path):
+        filename = os.path.join(tmp_path, 'manifest.json')
+        package_manifest = manifest.PackageManifest(filename, 'abc')
+        package_manifest.packages['publisher/package.xml'] = {}
+        package_manifest.save()
+        assert manifest.PackageManifest(filename, 'abc').packages == {'publisher/package.xml': {}}
+        assert manifest.PackageManifest(filename, 'def').packages == {}
@@ -0,0 +1,26 @@
+import os
+import pytest
+from iatiflattener.lib import scheduling
+from iatiflattener import merge
+from iatiflattener.tests.conftest import read_csv_files
+
+
+class TestMerge():
+
+    @pytest.mark.parametrize("count", [2, 3])
+    def test_merged_output_matches(self, flatten, tmp_path, count):
+        for index in range(1, count + 1):
+            flatten(output='node-{}'.format(index), shard='{}/{}'.format(index, count))
+        merge.merge_nodes([os.path.join(tmp_path, 'node-{}'.format(index)) for index in range(1, count + 1)],
+                          os.path.join(tmp_path, 'merged'))
+        assert read_csv_files(os.path.join(tmp_path, 'merged')) == flatten(output='single')
+
+    def test_node_publishers(self):
+        publisher_sizes = {'a': 100, 'b': 60, 'c': 50, 'd': 30, 'e': 20}
+        nodes = [scheduling.node_publishers(publisher_sizes, index, 2) for index in (1, 2)]
+        assert nodes == [['a', 'd'], ['b', 'c', 'e']]
+
+    @pytest.mark.parametrize("shard", ["0/2", "3/2", "1", "a/b"])
+    def test_parse_node_invalid(self, shard):
+        with pytest.raises(ValueError):
+            scheduling.parse_node(shard)
@@ -0,0 +1,47 @@
+import gc
+import pytest
+from iatiflattener import FlattenIATIData
+from iatiflattener.lib import parallel
+
+
+class TestParallel():
+
+    @pytest.fixture
+    def serial_output(self, flatten):
+        return flatten(output='serial')
+
+    def test_serial_output_has_rows(self, serial_output):
+        assert serial_output['csv/transaction-LR.csv'].count(b'\n') > 1
+        assert serial_output['csv/budget-BD.csv'].count(b'\n') > 1
+        assert serial_output['csv/activities/GB-GOV-1.csv'].count(b'\n') > 1
+
+    @pytest.mark.parametrize("workers", [2, 4])
+    def test_workers_output_matches_serial(self, flatten, serial_output, workers):
+        """Output files do not depend on the number of workers"""
+        assert flatten(output='workers', workers=workers) == serial_output
+
+    @pytest.mark.parametrize("start_method", ["spawn", "forkserver"])
+    def test_start_method_output_matches_serial(self, flatten, serial_output, start_method):
+        """Workers which are not forked are sent a copy of the flattener"""
+        assert flatten(output='workers', workers=2, start_method=start_method) == serial_output
+
+    @pytest.mark.parametrize("start_method", ["fork", "spawn"])
+    def test_pool_cleaned_up_on_failure(self, flatten, monkeypatch, start_method):
+        """The parent's heap is unfrozen even if the pool run fails"""
+        def fail(*args):
+            raise RuntimeError("finish_shard failed")
+        monkeypatch.setattr(FlattenIATIData, 'finish_shard', fail)
+        with pytest.raises(RuntimeError):
+            flatten(output='workers', workers=2, start_method=start_method)
+        assert gc.get_freeze_count() == 0
+
+    def test_worker_flattener(self):
+        flattener = FlattenIATIData.__new__(FlattenIATIData)
+        for name in parallel.PARENT_ATTRIBUTES:
+            setattr(flattener, name, {name: [1, 2]})
+        flattener.organisations = {'en': {}}
+        flattener.langs = ['en']
+        worker_flattener = parallel.worker_flattener(flattener)
+        assert not any(hasattr(worker_flattener, name) for name in parallel.PARENT_ATTRIBUTES)
+        assert worker_flattener.organisations is flattener.organisations
+        assert worker_flattener.langs == ['en']
@@ -0,0 +1,45 @@
+import time
+import threading
+import pytest
+from iatiflattener.lib import parsing
+
+
+class TestParseAhead():
+
+    def test_output_matches(self, flatten):
+        assert flatten(output='parse-ahead', parse_ahead=2) == flatten(output='serial')
+
+    def test_parsed_in_order(self):
+        parser = parsing.ParseAhead([('a', 1), ('b', 1), ('c', 1)], str.upper)
+        assert [parser.get(filename) for filename in 'abc'] == ['A', 'B', 'C']
+        parser.close()
+
+    def test_error_raised_by_get(self):
+        def parse(filename):
+            if filename == 'b':
+                raise ValueError(filename)
+            return filename
+        parser = parsing.ParseAhead([('a', 1), ('b', 1), ('c', 1)], parse)
+        assert parser.get('a') == 'a'
+        with pytest.raises(ValueError):
+            parser.get('b')
+        assert parser.get('c') == 'c'
+        parser.close()
+
+    @pytest.mark.parametrize("max_packages, max_bytes, parsed_ahead", [(2, 1000, 2), (3, 250, 2), (3, 50, 1)])
+    def test_bounded(self, max_packages, max_bytes, parsed_ahead):
+        """Packages are only parsed ahead up to the number and size limits, but always one at a time"""
+        parsed = []
+        lock = threading.Lock()
+        def parse(filename):
+            with lock:
+                parsed.append(filename)
+            return filename
+        parser = parsing.ParseAhead([(str(n), 100) for n in range(6)], parse, max_packages, max_bytes)
+        time.sleep(0.2)
+        assert len(parsed) == parsed_ahead
+        parser.get('0')
+        time.sleep(0.2)
+        assert len(parsed) == parsed_ahead + 1
+        parser.close()
+        assert len(parsed) == parsed_ahead + 1
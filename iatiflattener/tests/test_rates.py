@@ -0,0 +1,119 @@
+import os
+import random
+import pickle
+import datetime
+import pytest
+import exchangerates
+from iatiflattener.lib import rates
+
+
+@pytest.fixture
+def rates_filename(tmp_path):
+    """A rates file with irregular dates, repeated dates and equally close dates"""
+    rows = []
+    generator = random.Random(1)
+    for currency in ('EUR', 'GBP', 'CAD', 'XOF'):
+        date = datetime.date(2000, 1, 1)
+        for month in range(120):
+            date += datetime.timedelta(days=generator.choice([2, 28, 30, 31]))
+            rows.append((date.isoformat(), repr(generator.uniform(0.1, 1000)), currency))
+        rows.append((rows[-3][0], '1.5', currency))
+    generator.shuffle(rows)
+    filename = os.path.join(tmp_path, 'rates.csv')
+    with open(filename, 'w') as csv_file:
+        csv_file.write('Date,Rate,Currency,Frequency,Source\n')
+        for date, rate, currency in rows:
+            csv_file.write('{},{},{},M,IMF\n'.format(date, rate, currency))
+    return filename
+
+
+class TestRatesTable():
+
+    def test_closest_rate_matches(self, rates_filename, tmp_path):
+        converter = exchangerates.CurrencyConverter(update=False, source=rates_filename)
+        table = rates.load_rates(rates_filename, os.path.join(tmp_path, 'table'))
+        assert table.known_currencies() == converter.known_currencies()
+        for currency in ('EUR', 'GBP', 'CAD', 'XOF', 'USD'):
+            date = datetime.date(1999, 11, 1)
+            while date < datetime.date(2011, 3, 1):
+                assert table.closest_rate(currency, date) == converter.closest_rate(currency, date)
+                date += datetime.timedelta(days=1)
+
+    def test_closest_rates_matches(self, rates_filename, tmp_path):
+        table = rates.load_rates(rates_filename, os.path.join(tmp_path, 'table'))
+        currencies, dates = [], []
+        date = datetime.date(1999, 11, 1)
+        while date < datetime.date(2011, 3, 1):
+            for currency in ('EUR', 'GBP', 'USD'):
+                currencies.append(currency)
+                dates.append(date)
+            date += datetime.timedelta(days=1)
+        conversion_rates, closest_dates = table.closest_rates(currencies, [date.toordinal() for date in dates])
+        assert [{"closest_date": datetime.date.fromordinal(closest_date), "conversion_rate": conversion_rate}
+                for conversion_rate, closest_date in zip(conversion_rates.tolist(), closest_dates.tolist())] == [
+                table.closest_rate(currency, date) for currency, date in zip(currencies, dates)]
+
+    def test_unknown_currency(self, rates_filename, tmp_path):
+        table = rates.load_rates(rates_filename, os.path.join(tmp_path, 'table'))
+        with pytest.raises(exchangerates.UnknownCurrencyException):
+            table.closest_rate('ZZZ', datetime.date(2005, 1, 1))
+
+    def test_recompiled_when_changed(self, rates_filename, tmp_path):
+        table_dir = os.path.join(tmp_path, 'table')
+        rates.load_rates(rates_filename, table_dir)
+        mtime = os.stat(os.path.join(table_dir, 'index.json')).st_mtime_ns
+        rates.load_rates(rates_filename, table_dir)
+        assert os.stat(os.path.join(table_dir, 'index.json')).st_mtime_ns == mtime
+        with open(rates_filename, 'a') as csv_file:
+            csv_file.write('2020-01-01,2.0,NEW,M,IMF\n')
+        assert 'NEW' in rates.load_rates(rates_filename, table_dir).known_currencies()
+
+    def test_memoized_once(self, rates_filename):
+        converter = exchangerates.CurrencyConverter(update=False, source=rates_filename)
+        memoized = rates.memoized(converter)
+        assert isinstance(memoized, rates.MemoizedRates)
+        assert rates.memoized(converter) is memoized
+        assert rates.memoized(memoized) is memoized
+
+    def test_table_not_in_output(self, flatten, tmp_path):
+        """The table is kept next to the rates file, rather than among the published output"""
+        assert rates.default_table_dir('data/rates.csv') == 'data/rates-table'
+        flatten(output='output')
+        assert not os.path.exists(os.path.join(tmp_path, 'output', 'rates-table'))
+        assert os.path.exists(os.path.join('iatiflattener', 'tests', 'fixtures', 'rates-table', 'index.json'))
+
+    def test_pickle(self, rates_filename, tmp_path):
+        table = rates.load_rates(rates_filename, os.path.join(tmp_path, 'table'))
+        unpickled = pickle.loads(pickle.dumps(table))
+        assert unpickled.closest_rate('EUR', datetime.date(2005, 1, 1)) == table.closest_rate('EUR', datetime.date(2005, 1, 1))
+        assert len(pickle.dumps(table)) < 1000
+
+
+class TestMemoizedRates():
+
+    def test_closest_rate_memoized(self, rates_filename, tmp_path):
+        table = rates.load_rates(rates_filename, os.path.join(tmp_path, 'table'))
+        memoized = rates.MemoizedRates(table)
+        date = datetime.date(2005, 1, 1)
+        assert memoized.closest_rate('EUR', date) == table.closest_rate('EUR', date)
+        memoized.closest_rate('EUR', date)
+        assert memoized.closest_rate.cache_info().hits == 1
+
+    def test_is_known(self, rates_filename, tmp_path):
+        memoized = rates.MemoizedRates(exchangerates.CurrencyConverter(update=False, source=rates_filename))
+        assert memoized.is_known('EUR')
+        assert memoized.is_known('USD')
+        assert not memoized.is_known('ZZZ')
+        assert not memoized.is_known(None)
+
+    def test_table_not_in_output(self, flatten, tmp_path):
+        """The table is kept next to the rates file, rather than among the published output"""
+        assert rates.default_table_dir('data/rates.csv') == 'data/rates-table'
+        flatten(output='output')
+        assert not os.path.exists(os.path.join(tmp_path, 'output', 'rates-table'))
+        assert os.path.exists(os.path.join('iatiflattener', 'tests', 'fixtures', 'rates-table', 'index.json'))
+
+    def test_pickle(self, rates_filename, tmp_path):
+        memoized = rates.MemoizedRates(rates.load_rates(rates_filename, os.path.join(tmp_path, 'table')))
+        unpickled = pickle.loads(pickle.dumps(memoized))
+        assert unpickled.closest_rate('EUR', datetime.date(2005, 1, 1)) == memoized.closest_rate('EUR', datetime.date(2005, 1, 1))
@@ -0,0 +1,116 @@
+import os
+import json
+import threading
+import pytest
+import requests
+from iatiflattener.lib import reference
+from iatiflattener.group_data import GroupFlatIATIData
+from iatiflattener.tests.conftest import REFERENCE_DIR
+
+
+URL = "https://codelists.codeforiati.org/api/json/en/Country.json"
+
+
+class FakeResponse():
+    def __init__(self, url, status_code, content=b'', headers={}):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+
+class FakeSession():
+    """Returns the queued responses in turn, recording the request headers"""
+    def get(self, url, headers={}, timeout=None):
+        self.requests.append(headers)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+
+class TestReferenceDataCache():
+
+    @pytest.fixture
+    def cache(self, tmp_path):
+        def _cache(responses, **kwargs):
+            reference_data = reference.ReferenceDataCache(os.path.join(tmp_path, 'reference'), **kwargs)
+            reference_data.session = FakeSession(responses)
+            return reference_data
+        return _cache
+
+    def test_cached_within_ttl(self, cache):
+        reference_data = cache([FakeResponse(URL, 200, b'{"data": []}', {'ETag': '"a"'})])
+        assert reference_data.get(URL).json() == {'data': []}
+        assert reference_data.get(URL).json() == {'data': []}
+        assert len(reference_data.session.requests) == 1
+        assert os.path.exists(os.path.join(reference_data.cache_dir, 'v1', 'codelists.codeforiati.org',
+                                           'api', 'json', 'en', 'Country.json'))
+
+    def test_revalidated_after_ttl(self, cache):
+        reference_data = cache([
+            FakeResponse(URL, 200, b'{"data": []}', {'ETag': '"a"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}),
+            FakeResponse(URL, 304),
+            FakeResponse(URL, 200, b'{"data": [1]}', {'ETag': '"b"'})
+        ], ttl=0)
+        reference_data.get(URL)
+        assert reference_data.get(URL).json() == {'data': []}
+        assert reference_data.session.requests[1] == {
+            'If-None-Match': '"a"', 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+        assert reference_data.get(URL).json() == {'data': [1]}
+
+    def test_stale_used_if_network_fails(self, cache):
+        reference_data = cache([
+            FakeResponse(URL, 200, b'{"data": []}'),
+            requests.ConnectionError(),
+            FakeResponse(URL, 500)
+        ], ttl=0)
+        reference_data.get(URL)
+        assert reference_data.get(URL).json() == {'data': []}
+        assert reference_data.get(URL).json() == {'data': []}
+
+    def test_unavailable(self, cache):
+        with pytest.raises(reference.ReferenceDataUnavailable):
+            cache([requests.ConnectionError()]).get(URL)
+
+    def test_offline(self, cache):
+        reference_data = cache([], offline=True)
+        with pytest.raises(reference.ReferenceDataUnavailable):
+            reference_data.get(URL)
+        # fixture files without metadata are treated as successful responses
+        reference_data.cache_dir = REFERENCE_DIR
+        assert reference_data.get(URL).status_code == 200
+        assert reference_data.session.requests == []
+
+    def test_group_data_fallback(self, cache, monkeypatch):
+        """Codelists which are not translated fall back to English, and the 404 is cached too"""
+        french_url = "https://codelists.codeforiati.org/api/json/fr/Country.json"
+        reference_data = cache([
+            FakeResponse(french_url, 404, b'Not found'),
+            FakeResponse(URL, 200, json.dumps({'data': [{'code': 'AF', 'name': 'Afghanistan'}]}).encode())
+        ])
+        monkeypatch.setattr(GroupFlatIATIData, 'reference_data', reference_data, raising=False)
+        for attempt in range(2):
+            req = GroupFlatIATIData.get_codelist_with_fallback(GroupFlatIATIData, 'fr', 'Country')
+            assert req.json()['data'][0]['name'] == 'Afghanistan'
+        assert len(reference_data.session.requests) == 2
+
+    def test_prefetch(self, cache):
+        """Prefetched URLs are fetched at the same time, and read by `get`"""
+        urls = ["https://codelists.codeforiati.org/api/json/en/{}.json".format(codelist)
+                for codelist in ("Country", "Region", "Sector", "SectorGroup")]
+        barrier = threading.Barrier(len(urls), timeout=10)
+        class ConcurrentSession():
+            def get(self, url, headers={}, timeout=None):
+                # only returns once every URL is being fetched at once
+                barrier.wait()
+                return FakeResponse(url, 200, json.dumps({'url': url}).encode())
+        reference_data = cache([])
+        reference_data.session = ConcurrentSession()
+        reference_data.prefetch(urls)
+        assert [reference_data.get(url).json()['url'] for url in urls] == urls
+        assert reference_data.prefetched == {}
@@ -0,0 +1,54 @@
+import os
+import pytest
+from iatiflattener import FlattenIATIData
+from iatiflattener.lib import journal
+
+
+def interrupt_after(monkeypatch, count):
+    """Interrupts the run after a number of activities, as if it had been killed"""
+    process_activity = FlattenIATIData.process_activity
+    calls = []
+    def interrupted_process_activity(self, csvwriter, activity, *args):
+        calls.append(activity)
+        if len(calls) > count:
+            raise KeyboardInterrupt
+        return process_activity(self, csvwriter, activity, *args)
+    monkeypatch.setattr(FlattenIATIData, 'process_activity', interrupted_process_activity)
+
+
+class TestResume():
+
+    @pytest.mark.parametrize("use_shards", [False, True])
+    @pytest.mark.parametrize("count", [5, 12])
+    def test_resume(self, flatten, tmp_path, use_shards, count):
+        expected = flatten(output='full', shards=use_shards)
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            interrupt_after(monkeypatch, count)
+            with pytest.raises(KeyboardInterrupt):
+                flatten(output='resumed', streaming=True, shards=use_shards, resume=True)
+        assert os.path.exists(os.path.join(tmp_path, 'resumed', 'journal.jsonl'))
+        assert flatten(output='resumed', streaming=True, shards=use_shards, resume=True) == expected
+        assert not os.path.exists(os.path.join(tmp_path, 'resumed', 'journal.jsonl'))
+
+    def test_not_journaled_without_resume(self, flatten, tmp_path, monkeypatch):
+        """Runs appending rows directly to the CSV files only sync them, and
+        record their sizes, when they can be resumed"""
+        monkeypatch.setattr(journal, 'fsync_file', lambda filename: pytest.fail("fsynced " + filename))
+        with pytest.MonkeyPatch.context() as interrupted:
+            interrupt_after(interrupted, 12)
+            with pytest.raises(KeyboardInterrupt):
+                flatten(output='interrupted')
+        with open(os.path.join(tmp_path, 'interrupted', 'journal.jsonl')) as journal_file:
+            assert journal_file.read() == ''
+
+    def test_partial_journal_line(self, tmp_path):
+        filename = os.path.join(tmp_path, 'journal.jsonl')
+        run_journal = journal.RunJournal(filename)
+        run_journal.record({'publisher': 'a', 'package': 'a.xml', 'status': 'processed'}, {'csv/transaction-AF.csv': 10})
+        with open(filename, 'a') as journal_file:
+            journal_file.write('{"result": {"publisher": "b"')
+        run_journal = journal.RunJournal(filename, resume=True)
+        assert run_journal.completed('a', 'a.xml')['status'] == 'processed'
+        assert run_journal.sizes == {'csv/transaction-AF.csv': 10}
+        run_journal.record({'publisher': 'b', 'package': 'b.xml', 'status': 'processed'})
+        assert journal.RunJournal(filename, resume=True).completed('b', 'b.xml') is not None
@@ -0,0 +1,22 @@
+import os
+import json
+import pytest
+
+
+class TestRunReport():
+
+    @pytest.fixture
+    def legacy_packages(self, iatikitcache_dir):
+        os.makedirs(os.path.join(iatikitcache_dir, 'data', 'legacy'))
+        with open(os.path.join(iatikitcache_dir, 'data', 'legacy', 'legacy-105.xml'), 'w') as xml_file:
+            xml_file.write('<iati-activities version="1.05"><iati-activity><iati-identifier>X</iati-identifier></iati-activity></iati-activities>')
+        with open(os.path.join(iatikitcache_dir, 'data', 'legacy', 'legacy-broken.xml'), 'w') as xml_file:
+            xml_file.write('<iati-activities version="2.03"><iati-activity>')
+
+    @pytest.mark.parametrize("workers", [None, 2])
+    def test_run_report(self, flatten, legacy_packages, tmp_path, workers):
+        flatten(workers=workers)
+        with open(os.path.join(tmp_path, 'output', 'run-report.json')) as json_file:
+            report = json.load(json_file)
+        assert {'publisher': 'legacy', 'package': 'legacy-105.xml', 'version': '1.05'} in report['skipped']
+        assert [(item['publisher'], item['package']) for item in report['failed']] == [('legacy', 'legacy-broken.xml')]
@@ -0,0 +1,41 @@
+import os
+import pytest
+from iatiflattener.lib.scheduling import PackageCosts
+
+
+class TestPackageCosts():
+
+    @pytest.fixture
+    def packages(self):
+        return [
+            ('aaa', 'small.xml', 1000),
+            ('aaa', 'large.xml', 50000),
+            ('bbb', 'medium.xml', 10000),
+        ]
+
+    def test_schedule_by_size_without_timings(self, packages):
+        costs = PackageCosts()
+        assert [item[1] for item in costs.schedule(packages)] == ['large.xml', 'medium.xml', 'small.xml']
+
+    def test_schedule_uses_timings(self, packages, tmp_path):
+        filename = os.path.join(tmp_path, 'package-timings.json')
+        costs = PackageCosts(filename)
+        costs.record('aaa', 'small.xml', 1000, 30.0)
+        costs.record('aaa', 'large.xml', 50000, 5.0)
+        costs.save()
+
+        costs = PackageCosts(filename)
+        # medium.xml has no timing, so is estimated from the average time per byte
+        assert costs.estimate('bbb', 'medium.xml', 10000) == pytest.approx(10000 * (35.0 / 51000))
+        assert [item[1] for item in costs.schedule(packages)] == ['small.xml', 'medium.xml', 'large.xml']
+
+    def test_estimate_scales_with_size(self):
+        costs = PackageCosts()
+        costs.record('aaa', 'small.xml', 1000, 2.0)
+        assert costs.estimate('aaa', 'small.xml', 2000) == 4.0
+
+    def test_run_records_timings(self, flatten, tmp_path):
+        flatten(workers=2)
+        costs = PackageCosts(os.path.join(tmp_path, 'output', 'package-timings.json'))
+        assert costs.timings['fcdo/fcdo-activity.xml']['size'] == 9117
+        assert costs.timings['fcdo/fcdo-activity.xml']['seconds'] > 0
@@ -0,0 +1,64 @@
+import os
+import pytest
+from iatiflattener.lib import shards
+
+
+FCDO_PACKAGE = 'iatiflattener/tests/fixtures/fcdo-activity.xml'
+
+
+class TestShards():
+
+    @pytest.fixture
+    def broken_package(self, iatikitcache_dir):
+        """A package which fails after its first activity has been streamed out"""
+        with open(FCDO_PACKAGE) as xml_file:
+            xml = xml_file.read().replace('GB-1-103662-101', 'XX-BROKEN-1')
+        activity = xml[xml.index('<iati-activity '):xml.index('</iati-activities>')]
+        os.makedirs(os.path.join(iatikitcache_dir, 'data', 'broken'))
+        with open(os.path.join(iatikitcache_dir, 'data', 'broken', 'broken.xml'), 'w') as xml_file:
+            xml_file.write('<iati-activities version="2.03">' + activity + activity + '<iati-activity>')
+
+    def test_shard_output_matches(self, flatten):
+        assert flatten(output='shards', shards=True) == flatten(output='serial')
+
+    @pytest.mark.parametrize("use_shards, partial", [(False, True), (True, False)])
+    def test_failed_package_discarded(self, flatten, broken_package, tmp_path, use_shards, partial):
+        output = flatten(streaming=True, shards=use_shards)
+        assert any(b'XX-BROKEN-1' in data for data in output.values()) is partial
+        assert not os.path.exists(os.path.join(tmp_path, 'output', 'shards'))
+
+    def test_merge_shards(self, tmp_path):
+        for shard, chunks in (('a', [None]), ('b', ['00000', '00001'])):
+            for chunk in chunks:
+                csv_dir = os.path.join(tmp_path, shard, chunk or '', 'csv')
+                os.makedirs(os.path.join(csv_dir, 'activities'))
+                with open(os.path.join(csv_dir, 'transaction-AF.csv'), 'w') as csv_file:
+                    csv_file.write('{},{}\n'.format(shard, chunk))
+        os.makedirs(os.path.join(tmp_path, 'output', 'csv'))
+        with open(os.path.join(tmp_path, 'output', 'csv', 'transaction-AF.csv'), 'w') as csv_file:
+            csv_file.write('header\n')
+        shards.merge_shards([os.path.join(tmp_path, 'a'), os.path.join(tmp_path, 'b')],
+                            os.path.join(tmp_path, 'output'))
+        with open(os.path.join(tmp_path, 'output', 'csv', 'transaction-AF.csv')) as csv_file:
+            assert csv_file.read() == 'header\na,None\nb,00000\nb,00001\n'
+
+    def test_commit_shard(self, tmp_path):
+        shard_dir = os.path.join(tmp_path, 'publisher', 'package.xml')
+        shard_tmp_dir = shards.start_shard(shard_dir)
+        assert shards.list_shards(str(tmp_path)) == []
+        shards.commit_shard(shard_dir)
+        assert not os.path.exists(shard_tmp_dir)
+        assert shards.list_shards(str(tmp_path)) == [('publisher', 'package.xml', shard_dir)]
+
+    @pytest.mark.parametrize("copy_file_range", [True, False])
+    def test_append_files(self, tmp_path, monkeypatch, copy_file_range):
+        if not copy_file_range:
+            monkeypatch.delattr(os, 'copy_file_range', raising=False)
+        data = os.urandom(3 * shards.COPY_BLOCK_SIZE + 1)
+        with open(os.path.join(tmp_path, 'source'), 'wb') as source_file:
+            source_file.write(data)
+        with open(os.path.join(tmp_path, 'destination'), 'wb') as destination_file:
+            destination_file.write(b'header\n')
+        shards.append_files([os.path.join(tmp_path, 'source')] * 2, os.path.join(tmp_path, 'destination'))
+        with open(os.path.join(tmp_path, 'destination'), 'rb') as destination_file:
+            assert destination_file.read() == b'header\n' + data + data
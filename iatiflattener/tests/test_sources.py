@@ -0,0 +1,80 @@
+import os
+import gzip
+import shutil
+import tarfile
+import zipfile
+import pytest
+from iatiflattener.lib import sources
+
+
+def compress_packages(data_dir):
+    """Replaces each package in an iatikit cache's `data` directory with a gzip-compressed copy"""
+    for root, dirs, files in os.walk(data_dir):
+        for filename in files:
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as package_file, gzip.open(path + '.gz', 'wb') as compressed_file:
+                shutil.copyfileobj(package_file, compressed_file)
+            os.remove(path)
+
+
+class TestSources():
+
+    @pytest.fixture
+    def serial_output(self, flatten):
+        return flatten(output='serial')
+
+    def test_compressed_packages(self, flatten, serial_output, iatikitcache_dir):
+        compress_packages(os.path.join(iatikitcache_dir, 'data'))
+        assert sources.PackageDirectory(iatikitcache_dir).list_packages('fcdo')[0][0] == 'fcdo-activity.xml'
+        assert flatten(output='compressed') == serial_output
+        assert flatten(output='compressed-parse-ahead', parse_ahead=2) == serial_output
+
+    @pytest.mark.parametrize("mode", ["w:gz", "w"])
+    def test_tar_archive(self, flatten, serial_output, iatikitcache_dir, tmp_path, mode):
+        archive_filename = os.path.join(tmp_path, 'data.tar')
+        with tarfile.open(archive_filename, mode) as archive:
+            archive.add(os.path.join(iatikitcache_dir, 'data'), arcname='data')
+        assert flatten(output='tar', iatikitcache_dir=archive_filename) == serial_output
+        assert flatten(output='tar-workers', iatikitcache_dir=archive_filename, workers=2) == serial_output
+
+    def test_compressed_tar_scheduled_in_archive_order(self, flatten, serial_output, iatikitcache_dir, tmp_path,
+                                                       monkeypatch):
+        """Pool runs read the packages of a compressed tar archive forward, rather than largest first"""
+        archive_filename = os.path.join(tmp_path, 'data.tar.gz')
+        with tarfile.open(archive_filename, 'w:gz') as archive:
+            # members in reverse order, so that archive order differs from sorted order
+            for root, dirs, files in sorted(os.walk(os.path.join(iatikitcache_dir, 'data')), reverse=True):
+                for filename in sorted(files, reverse=True):
+                    archive.add(os.path.join(root, filename), arcname=os.path.relpath(
+                        os.path.join(root, filename), iatikitcache_dir))
+        package_source = sources.open_packages(archive_filename)
+        assert package_source.sequential
+        packages = [(publisher, package, size) for publisher in sorted(package_source.publishers())
+                    for package, size in package_source.list_packages(publisher)]
+        assert package_source.in_archive_order(packages) == packages[::-1]
+        def largest_first(*args):
+            raise AssertionError("a compressed tar archive is scheduled in archive order")
+        monkeypatch.setattr('iatiflattener.lib.scheduling.PackageCosts.schedule', largest_first)
+        assert flatten(output='tar-gz-workers', iatikitcache_dir=archive_filename, workers=2) == serial_output
+
+    def test_zip_archive_of_compressed_packages(self, flatten, serial_output, iatikitcache_dir, tmp_path):
+        compress_packages(os.path.join(iatikitcache_dir, 'data'))
+        archive_filename = os.path.join(tmp_path, 'data.zip')
+        with zipfile.ZipFile(archive_filename, 'w') as archive:
+            for root, dirs, files in os.walk(iatikitcache_dir):
+                for filename in files:
+                    archive.write(os.path.join(root, filename),
+                        os.path.relpath(os.path.join(root, filename), os.path.dirname(iatikitcache_dir)))
+        package_source = sources.open_packages(archive_filename)
+        assert not package_source.sequential
+        assert sorted(package_source.publishers()) == ['beis', 'canada', 'fcdo', 'misc', 'usaid', 'worldbank']
+        assert flatten(output='zip', iatikitcache_dir=archive_filename, parse_ahead=2) == serial_output
+        assert flatten(output='zip-workers', iatikitcache_dir=archive_filename, workers=2,
+                       start_method='spawn') == serial_output
+
+    def test_incremental_needs_directory(self, flatten, iatikitcache_dir, tmp_path):
+        archive_filename = os.path.join(tmp_path, 'data.tar')
+        with tarfile.open(archive_filename, 'w') as archive:
+            archive.add(os.path.join(iatikitcache_dir, 'data'), arcname='data')
+        with pytest.raises(ValueError):
+            flatten(output='incremental', iatikitcache_dir=archive_filename, incremental=True)
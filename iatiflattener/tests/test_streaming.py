@@ -0,0 +1,59 @@
+import io
+import pytest
+from lxml import etree
+from iatiflattener.lib import streaming
+
+
+BEIS_PACKAGE = 'iatiflattener/tests/fixtures/beis-activity.xml'
+
+
+class TestStreaming():
+
+    def test_iterparse_activities(self):
+        """Activities are complete when yielded, including their tails"""
+        expected = [etree.tostring(activity) for activity in etree.parse(BEIS_PACKAGE).xpath('//iati-activity')]
+        assert [etree.tostring(activity) for activity in streaming.iterparse_activities(BEIS_PACKAGE)] == expected
+
+    def test_iterparse_activities_clears(self):
+        """Earlier activities are removed from the tree as parsing continues"""
+        for activity in streaming.iterparse_activities(BEIS_PACKAGE):
+            # the current activity, the next activity, and perhaps the start of the one after
+            assert len(activity.getparent()) <= 3
+        assert len(activity) == 0
+        assert activity.getparent() is None
+
+    def test_streaming_output_matches(self, flatten):
+        assert flatten(output='streaming', streaming=True) == flatten(output='tree')
+
+    @pytest.mark.parametrize("identifiers, unique", [
+        ([b'A', b'B'], True),
+        ([b'A', b'B', b'A'], False),
+        ([b'A &amp; B', b'B'], True),
+    ])
+    def test_has_unique_identifiers(self, tmp_path, identifiers, unique):
+        xml = b'<iati-activities version="2.03">' + b''.join(
+            b'<iati-activity><iati-identifier>' + identifier + b'</iati-identifier></iati-activity>'
+            for identifier in identifiers) + b'</iati-activities>'
+        source = io.BytesIO(xml)
+        assert streaming.has_unique_identifiers(source) == unique
+        assert source.tell() == 0
+        filename = str(tmp_path / 'package.xml')
+        with open(filename, 'wb') as xml_file:
+            xml_file.write(xml)
+        # escaped identifiers cannot be compared in the raw bytes, so are taken to be repeated
+        assert streaming.has_unique_identifiers(filename) == (unique and not any(b'&' in identifier
+                                                                                 for identifier in identifiers))
+
+    @pytest.mark.parametrize("xml, version", [
+        (b'<?xml version="1.0"?>\n<!-- comment --><iati-activities version="1.05"><iati-activity>', '1.05'),
+        (b'<iati-activities version="2.03"><iati-activity>', '2.03'),
+        (b'<iati-activities><iati-activity>', None),
+    ])
+    def test_peek_version(self, xml, version):
+        """Only the opening tag is read, so the rest of the package need not be well-formed"""
+        source = io.BytesIO(xml)
+        assert streaming.peek_version(source) == version
+        assert source.tell() == 0
+
+    def test_peek_version_file(self):
+        assert streaming.peek_version(BEIS_PACKAGE) == '2.03'
@@ -204,3 +204,25 @@ class TestModel:
                         assert (transaction_entry['value_local'][country_code] ==
                                 pytest.approx(expected_data[publisher][country_code][sector_code]))
 
+
+    @pytest.mark.parametrize("publisher", ["fcdo", "canada", "usaid", "worldbank", "finddiagnostics"])
+    def test_shared_activity_context(self, publisher, node):
+        """Transactions sharing their activity's context give the same rows as
+        transactions which each resolve the activity-level values themselves"""
+        activity = node.getparent()
+
+        def as_dicts(share_context):
+            activity_cache = model.ActivityCache()
+            activity_context = model.ActivityContext(activity, activity_cache) if share_context else None
+            out = []
+            for transaction_node in activity.iterchildren('transaction'):
+                transaction = model.Transaction(activity, transaction_node, activity_cache,
+                                                exchange_rates, countries_currencies,
+                                                activity_context=activity_context).generate()
+                if transaction is not False:
+                    out.append(transaction.as_dict())
+                    if share_context:
+                        assert transaction.title is activity_context.title
+            return out
+
+        assert as_dicts(share_context=True) == as_dicts(share_context=False)
@@ -0,0 +1,115 @@
+import pytest
+import exchangerates
+from lxml import etree
+from iatiflattener.lib import rates
+from iatiflattener.lib import iati_transaction_helpers
+from iatiflattener.lib.iati_helpers import value_in_usd
+from iatiflattener.lib.utils import get_date, get_first
+
+exchange_rates = rates.MemoizedRates(
+    exchangerates.CurrencyConverter(update=False, source="iatiflattener/tests/fixtures/rates.csv"))
+
+ACTIVITY = """<iati-activity default-currency="GBP">
+  <iati-identifier>XM-TEST-1</iati-identifier>
+  {}
+</iati-activity>"""
+
+TRANSACTION = """<transaction>
+  <transaction-type code="{transaction_type}"/>
+  <value{currency} value-date="{value_date}">{value}</value>
+  {children}
+</transaction>"""
+
+CHILDREN = [
+    '<sector vocabulary="2" code="110"/><sector code="15110"/><recipient-country code="LR"/>'
+    '<aid-type code="C01"/><flow-type code="10"/><finance-type code="110"/>',
+    '<sector vocabulary="1" code="12220"/><recipient-region code="298"/><aid-type vocabulary="2" code="1"/>'
+    '<aid-type code="B02"/>',
+    '<recipient-region vocabulary="2" code="9"/><recipient-country code="BD"/><finance-type code="410"/>',
+    '<sector code="15110"/><flow-type code="20"/>',
+    '',
+]
+
+
+def reference_split(activity, xpath, code_xpaths, default_currency):
+    """The split of an activity's commitments as computed before the
+    transaction index, with an XPath for each transaction type and dimension"""
+    transactions = activity.xpath("transaction[{}][transaction-type/@code='2']".format(xpath))
+    if len(transactions) == 0:
+        transactions = activity.xpath("transaction[{}][transaction-type/@code='11']".format(xpath))
+    if len(transactions) == 0:
+        return None
+    transactions = [(
+        get_first([transaction.xpath(code_xpath) for code_xpath in code_xpaths])[0].get('code'),
+        transaction.find("value").get('currency', default_currency),
+        float(transaction.find("value").text),
+        transaction.find("value").get('value-date')) for transaction in transactions]
+    if len(set(transaction[0] for transaction in transactions)) == 1:
+        return [{'percentage': 100.0, 'code': transactions[0][0]}]
+    if len(set(transaction[1] for transaction in transactions)) != 1:
+        transactions = [(code, 'USD', value_in_usd(value, currency, get_date(value_date), exchange_rates), value_date)
+                        for code, currency, value, value_date in transactions]
+    total = sum(float(transaction[2]) for transaction in transactions)
+    out = {}
+    for code, currency, value, value_date in transactions:
+        out[code] = out.get(code, 0) + (value/total)*100.0
+    return [{'code': code, 'percentage': percentage} for code, percentage in out.items()]
+
+
+REGION = "recipient-region[not(@vocabulary) or @vocabulary='1']"
+
+# for each dimension, the XPath selecting the transactions which give it, and those of its codes in order of preference
+XPATHS = {
+    'sector': ("sector[not(@vocabulary) or @vocabulary='1']", ["sector[not(@vocabulary) or @vocabulary='1']"]),
+    'country_region': ("recipient-country or " + REGION, ["recipient-country", REGION]),
+    'aid-type': ("aid-type[not(@vocabulary) or @vocabulary='1']", ["aid-type[not(@vocabulary) or @vocabulary='1']"]),
+    'flow-type': ('flow-type', ['flow-type']),
+    'finance-type': ('finance-type', ['finance-type']),
+}
+
+
+def make_activity(transaction_types, currencies):
+    transactions = []
+    for number, (transaction_type, currency) in enumerate(zip(transaction_types, currencies)):
+        transactions.append(TRANSACTION.format(
+            transaction_type=transaction_type,
+            currency='' if currency is None else ' currency="{}"'.format(currency),
+            value_date="2020-0{}-15".format(number % 9 + 1),
+            value=1000 * (number + 1),
+            children=CHILDREN[number % len(CHILDREN)]))
+    return etree.fromstring(ACTIVITY.format("".join(transactions)))
+
+
+class TestTransactionIndex():
+
+    @pytest.mark.parametrize("transaction_types, currencies", [
+        (['2', '2', '2', '2', '2'], [None, None, None, None, None]),
+        (['2', '3', '2', '2', '11', '2'], [None, 'USD', 'EUR', None, 'CAD', 'USD']),
+        (['11', '11', '11', '3', '11'], ['EUR', None, 'USD', 'EUR', 'CAD']),
+        (['3', '4', '1'], [None, None, None]),
+    ])
+    @pytest.mark.parametrize("vectorize_min_values", [1, iati_transaction_helpers.VECTORIZE_MIN_VALUES])
+    def test_matches_reference(self, monkeypatch, transaction_types, currencies, vectorize_min_values):
+        monkeypatch.setattr(iati_transaction_helpers, 'VECTORIZE_MIN_VALUES', vectorize_min_values)
+        activity = make_activity(transaction_types, currencies)
+        transaction_index = iati_transaction_helpers.TransactionIndex(activity, 'GBP', exchange_rates)
+        for dimension, (xpath, code_xpaths) in XPATHS.items():
+            assert transaction_index.split(dimension) == reference_split(activity, xpath, code_xpaths, 'GBP')
+
+    def test_vectorized_with_rates_table(self, monkeypatch, tmp_path):
+        """Values converted together with `RatesTable.closest_rates` match those converted one at a time"""
+        table_rates = rates.MemoizedRates(
+            rates.load_rates("iatiflattener/tests/fixtures/rates.csv", str(tmp_path / 'rates-table')))
+        activity = make_activity(['2'] * 12, ['USD', 'EUR', None, 'CAD'] * 3)
+        splits = iati_transaction_helpers.TransactionIndex(activity, 'GBP', table_rates).split('sector')
+        monkeypatch.setattr(iati_transaction_helpers, 'VECTORIZE_MIN_VALUES', 1)
+        assert iati_transaction_helpers.TransactionIndex(activity, 'GBP', table_rates).split('sector') == splits
+
+    def test_values_converted_once(self):
+        activity = make_activity(['2', '2', '2', '2', '2'], ['USD', 'EUR', 'GBP', 'EUR', 'CAD'])
+        transaction_index = iati_transaction_helpers.TransactionIndex(activity, 'GBP', exchange_rates)
+        transaction_index.split('sector')
+        converted = dict(transaction_index.usd)
+        assert len(converted) == 3
+        transaction_index.split('country_region')
+        assert all(transaction_index.usd[position] is value for position, value in converted.items())